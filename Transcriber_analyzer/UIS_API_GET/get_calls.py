@@ -4,27 +4,49 @@ import requests
 from datetime import datetime, timedelta
 import time
 
+from rate_limiter import get_limiter
+
 ACCESS_TOKEN = '*'
 
+# Адреса UIS можно переопределить через окружение (например, на локальные заглушки из benchmarks/)
+UIS_DATA_API_URL = os.environ.get('UIS_DATA_API_URL', 'https://dataapi.comagic.ru/v2.0')
+UIS_MEDIA_URL_TEMPLATE = os.environ.get(
+    'UIS_MEDIA_URL_TEMPLATE',
+    'https://app.comagic.ru/system/media/wav/{comm_id}/{wav_id}/'
+)
+
+# UIS Data API сообщает об ошибках объектом error JSON-RPC в ответе с HTTP 200.
+# Превышение лимитов запросов - перегрузка (лимит снижается, запрос повторяется),
+# внутренние ошибки сервиса повторяются, остальные (неверные параметры, токен) - нет.
+UIS_THROTTLE_ERROR_CODES = {-32029}
+UIS_RETRYABLE_ERROR_CODES = {-32603, -32000}
+
 def log(msg):
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
-def get_call_data(comm_id=None, minutes=10):
+def classify_rpc_response(response):
+    """Исход ответа Data API для лимитера: ошибки JSON-RPC приходят с HTTP 200"""
+    if response.status_code != 200:
+        return None
+    try:
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        return 'error'
+    if not error:
+        return 'success'
+    mnemonic = str((error.get('data') or {}).get('mnemonic', ''))
+    if error.get('code') in UIS_THROTTLE_ERROR_CODES or mnemonic.endswith('limit_exceeded'):
+        return 'throttled'
+    if error.get('code') in UIS_RETRYABLE_ERROR_CODES:
+        return 'error'
+    return 'success'
+
+def get_calls_report(date_from, date_till, limit=1000, offset=0, filter=None):
     """
-    Получает данные о звонках. Если указан comm_id, ищет конкретный звонок за последние minutes минут.
-    Если comm_id не указан, возвращает все звонки за последние 24 часа.
+    Одна страница get.calls_report за период [date_from, date_till] (datetime).
+    filter - фильтр Data API ({"field": ..., "operator": ..., "value": ...}).
+    Возвращает ответ API (dict) или None при ошибке.
     """
-    # Если ищем конкретный звонок - смотрим за последние 120 минут и увеличиваем лимит
-    if comm_id:
-        minutes = 120
-        limit = 1000
-    else:
-        limit = 100
-    date_till = datetime.now()
-    date_from = date_till - timedelta(minutes=minutes if comm_id else 1440)
-    
-    url = 'https://dataapi.comagic.ru/v2.0'
-    headers = {'Content-Type': 'application/json'}
     payload = {
         "jsonrpc": "2.0",
         "id": 1,
@@ -34,13 +56,80 @@ def get_call_data(comm_id=None, minutes=10):
             "date_from": date_from.strftime('%Y-%m-%d %H:%M:%S'),
             "date_till": date_till.strftime('%Y-%m-%d %H:%M:%S'),
             "limit": limit,
-            "offset": 0,
+            "offset": offset,
         }
     }
-    
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
+    if filter:
+        payload["params"]["filter"] = filter
+    response = get_limiter('uis_data').request(
+        requests.post, UIS_DATA_API_URL, headers={'Content-Type': 'application/json'},
+        data=json.dumps(payload), timeout=60, classify=classify_rpc_response
+    )
+    if response.status_code != 200:
+        print(f"Ошибка: {response.status_code}")
+        print(response.text)
+        return None
+    try:
         data = response.json()
+    except ValueError:
+        print(f"Ошибка: некорректный ответ API: {response.text[:500]}")
+        return None
+    if data.get('error'):
+        print(f"Ошибка API: {json.dumps(data['error'], ensure_ascii=False)}")
+        return None
+    return data
+
+def iter_calls_report(date_from, date_till, page_size=1000):
+    """
+    Все звонки за период постранично.
+    Возвращает список звонков или None, если какую-то страницу получить не удалось.
+    """
+    calls = []
+    offset = 0
+    while True:
+        data = get_calls_report(date_from, date_till, page_size, offset)
+        if not data or 'result' not in data:
+            return None
+        page = data['result'].get('data', [])
+        calls.extend(page)
+        if len(page) < page_size:
+            return calls
+        offset += page_size
+
+def find_call_report(comm_id, date_from, date_till):
+    """
+    Строка выгрузки одного звонка за период: запрос с фильтром по communication_id,
+    без постраничного перебора всех звонков периода.
+    Возвращает (найден, данные звонка или None); найден=None, если выгрузку получить не удалось.
+    """
+    value = int(comm_id) if str(comm_id).isdigit() else comm_id
+    data = get_calls_report(
+        date_from, date_till, limit=10,
+        filter={"field": "communication_id", "operator": "=", "value": value}
+    )
+    if not data or 'result' not in data:
+        return None, None
+    for call in data['result'].get('data', []):
+        if str(call.get('communication_id')) == str(comm_id):
+            return True, call
+    return False, None
+
+def get_call_data(comm_id=None, minutes=10):
+    """
+    Получает данные о звонках. Если указан comm_id, ищет конкретный звонок за последние minutes минут.
+    Если comm_id не указан, возвращает все звонки за последние 24 часа.
+    """
+    # Если ищем конкретный звонок - смотрим за последние 120 минут и увеличиваем лимит
+    if comm_id:
+        minutes = 120
+        limit = 1000
+    else:
+        limit = 100
+    date_till = datetime.now()
+    date_from = date_till - timedelta(minutes=minutes if comm_id else 1440)
+    
+    data = get_calls_report(date_from, date_till, limit)
+    if data is not None:
         if comm_id:
             # Если ищем конкретный звонок, возвращаем только его данные
             found = False
@@ -59,10 +148,7 @@ def get_call_data(comm_id=None, minutes=10):
                 print(f"[get_call_data] Полный ответ API при поиске звонка {comm_id}: {data_str}")
             return None
         return data
-    else:
-        print(f"Ошибка: {response.status_code}")
-        print(response.text)
-        return None
+    return None
 
 def find_call_with_retries(comm_id, minutes=10, retries=3, delay=300):
     """
@@ -86,6 +172,15 @@ def find_call_with_retries(comm_id, minutes=10, retries=3, delay=300):
     log(f"Звонок {comm_id} не найден после {retries} попыток.")
     return None
 
+def _fetch_to_file(url, fname):
+    """GET с записью тела в файл; слот лимитера занят на все время скачивания"""
+    r = requests.get(url, stream=True, timeout=60)
+    if r.status_code == 200:
+        with open(fname, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                f.write(chunk)
+    return r
+
 def download_call(comm_id, wav_ids, result_dir='result'):
     """Скачивает аудиозаписи конкретного звонка."""
     log(f"Начинаю загрузку аудиозаписей для звонка {comm_id}...")
@@ -95,7 +190,7 @@ def download_call(comm_id, wav_ids, result_dir='result'):
         log(f'Нет двух дорожек для звонка {comm_id} (wav_ids: {wav_ids})')
         return False
         
-    url_template = 'https://app.comagic.ru/system/media/wav/{comm_id}/{wav_id}/'
+    url_template = UIS_MEDIA_URL_TEMPLATE
     client_wav_url = url_template.format(comm_id=comm_id, wav_id=wav_ids[0])
     staff_wav_url = url_template.format(comm_id=comm_id, wav_id=wav_ids[1])
     
@@ -127,11 +222,8 @@ def download_call(comm_id, wav_ids, result_dir='result'):
             
         log(f"Пробую скачать {who} ({url_}) для звонка {comm_id}...")
         try:
-            r = requests.get(url_, stream=True)
+            r = get_limiter('uis_media').request(_fetch_to_file, url_, fname)
             if r.status_code == 200:
-                with open(fname, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
                 # Проверяем размер скачанного файла
                 file_size = os.path.getsize(fname)
                 log(f'{who} для звонка {comm_id} сохранён: {fname} (размер: {file_size} байт)')
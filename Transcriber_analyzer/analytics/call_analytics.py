@@ -0,0 +1,210 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from transcribe_calls import (
+    CLIENT_SPEAKER,
+    STAFF_SPEAKER,
+    channel_segments,
+    merge_transcripts,
+    screen_channel,
+)
+
+ANALYTICS_BATCH_SIZE = 200
+
+
+def log(msg):
+    print(f"[call_analytics] {msg}")
+
+
+def _to_arrays(segments):
+    """Начала, концы и число слов сегментов в виде массивов NumPy"""
+    starts = np.fromiter((s.start for s in segments), dtype=np.float64, count=len(segments))
+    ends = np.fromiter((s.end for s in segments), dtype=np.float64, count=len(segments))
+    words = np.fromiter((len(s.text.split()) for s in segments), dtype=np.int64, count=len(segments))
+    return starts, np.maximum(ends, starts), words
+
+
+def speech_union(starts, ends):
+    """Суммарная длительность объединения интервалов [start, end)"""
+    if not len(starts):
+        return 0.0
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    running_end = np.maximum.accumulate(ends)
+    # Новый блок речи начинается там, где сегмент стартует после конца всех предыдущих
+    new_block = np.empty(len(starts), dtype=bool)
+    new_block[0] = True
+    new_block[1:] = starts[1:] > running_end[:-1]
+    block_idx = np.flatnonzero(new_block)
+    block_ends = np.maximum.reduceat(ends, block_idx)
+    return float((block_ends - starts[block_idx]).sum())
+
+
+def channel_energy(audio_file, screening=None):
+    """
+    Энергия канала. Берется из статистики проверки канала, сохраненной в транскрипте (screening),
+    WAV читается (блоками, тем же screen_channel) только для транскриптов без нее.
+    Returns:
+        (длительность в секундах, средний RMS в dBFS, доля активных кадров)
+    """
+    if not screening or 'active_ratio' not in screening:
+        if not audio_file or not os.path.exists(audio_file):
+            return None, None, None
+        screening = screen_channel(audio_file)
+    return screening['duration'], screening['rms_db'], screening['active_ratio']
+
+
+def _screening(transcript):
+    """Статистика проверки канала из транскрипта или None"""
+    return (transcript or {}).get('screening')
+
+
+def _silent_verdict(transcript):
+    """1, если канал признан мертвым до транскрипции, 0 - если нет, None - проверки не было"""
+    screening = _screening(transcript)
+    return int(screening['silent']) if screening else None
+
+
+def compute_metrics(client_transcript, staff_transcript, client_audio=None, staff_audio=None):
+    """Метрики разговора по транскриптам каналов и аудиофайлам"""
+    client = channel_segments(client_transcript, CLIENT_SPEAKER)
+    staff = channel_segments(staff_transcript, STAFF_SPEAKER)
+    turns = merge_transcripts(client_transcript, staff_transcript)
+
+    c_starts, c_ends, c_words = _to_arrays(client)
+    s_starts, s_ends, s_words = _to_arrays(staff)
+    client_talk = speech_union(c_starts, c_ends)
+    staff_talk = speech_union(s_starts, s_ends)
+    total_speech = speech_union(np.concatenate([c_starts, s_starts]), np.concatenate([c_ends, s_ends]))
+
+    client_seconds, client_rms, client_active = channel_energy(client_audio, _screening(client_transcript))
+    staff_seconds, staff_rms, staff_active = channel_energy(staff_audio, _screening(staff_transcript))
+    last_end = max(c_ends.max(initial=0.0), s_ends.max(initial=0.0))
+    duration = max(client_seconds or 0.0, staff_seconds or 0.0, last_end)
+
+    metrics = {
+        'duration': round(duration, 2),
+        'client_talk_time': round(client_talk, 2),
+        'staff_talk_time': round(staff_talk, 2),
+        'talk_ratio_client': round(client_talk / (client_talk + staff_talk), 4) if client_talk + staff_talk else None,
+        'silence_share': round(1 - total_speech / duration, 4) if duration else None,
+        'client_wpm': round(c_words.sum() / client_talk * 60, 1) if client_talk else None,
+        'staff_wpm': round(s_words.sum() / staff_talk * 60, 1) if staff_talk else None,
+        'client_rms_db': client_rms,
+        'staff_rms_db': staff_rms,
+        'client_active_share': client_active,
+        'staff_active_share': staff_active,
+        'client_silent': _silent_verdict(client_transcript),
+        'staff_silent': _silent_verdict(staff_transcript),
+        'longest_monologue': None,
+        'longest_monologue_speaker': None,
+        'interruptions': 0,
+        'client_interruptions': 0,
+        'staff_interruptions': 0,
+        'response_latency_mean': None,
+        'response_latency_median': None,
+    }
+    if not turns:
+        return metrics
+
+    t_starts = np.fromiter((t.start for t in turns), dtype=np.float64, count=len(turns))
+    t_ends = np.fromiter((t.end for t in turns), dtype=np.float64, count=len(turns))
+    is_client = np.fromiter((t.speaker == CLIENT_SPEAKER for t in turns), dtype=bool, count=len(turns))
+    overlap = np.fromiter((t.overlap for t in turns), dtype=bool, count=len(turns))
+
+    lengths = t_ends - t_starts
+    longest = int(np.argmax(lengths))
+    metrics['longest_monologue'] = round(float(lengths[longest]), 2)
+    metrics['longest_monologue_speaker'] = turns[longest].speaker
+    metrics['interruptions'] = int(overlap.sum())
+    metrics['client_interruptions'] = int((overlap & is_client).sum())
+    metrics['staff_interruptions'] = int((overlap & ~is_client).sum())
+
+    # Задержка ответа - пауза между концом реплики и началом реплики собеседника (без перебиваний)
+    switch = (is_client[1:] != is_client[:-1]) & ~overlap[1:]
+    gaps = t_starts[1:][switch] - t_ends[:-1][switch]
+    gaps = gaps[gaps >= 0]
+    if len(gaps):
+        metrics['response_latency_mean'] = round(float(gaps.mean()), 3)
+        metrics['response_latency_median'] = round(float(np.median(gaps)), 3)
+    return metrics
+
+
+def _load_transcript(folder, name):
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def analyze_calls(calls):
+    """
+    Расчет метрик для пачки звонков.
+    Args:
+        calls: словари с communication_id, transcript_path, client_audio_path, staff_audio_path
+    Returns:
+        list: строки для Database.save_call_metrics (звонки с ошибками пропускаются)
+    """
+    results = []
+    for call in calls:
+        comm_id = call['communication_id']
+        folder = call.get('transcript_path')
+        if not folder or not os.path.isdir(folder):
+            log(f"Нет папки транскрипции для звонка {comm_id}: {folder}")
+            continue
+        try:
+            client_transcript = _load_transcript(folder, 'client_transcript.json')
+            staff_transcript = _load_transcript(folder, 'staff_transcript.json')
+            metrics = compute_metrics(
+                client_transcript,
+                staff_transcript,
+                call.get('client_audio_path'),
+                call.get('staff_audio_path')
+            )
+        except Exception as e:
+            log(f"Ошибка расчета метрик для звонка {comm_id}: {e}")
+            continue
+        metrics['communication_id'] = comm_id
+        results.append(metrics)
+    return results
+
+
+def analyze_and_store(calls, database=None):
+    """Расчет и сохранение метрик пачки звонков. Возвращает число сохраненных строк."""
+    if database is None:
+        from database import db as database
+    metrics = analyze_calls(calls)
+    database.save_call_metrics(metrics)
+    return len(metrics)
+
+
+def main(batch_size=ANALYTICS_BATCH_SIZE):
+    """Досчитывает метрики для всех транскрибированных звонков без них"""
+    from database import db
+    from audio_store import AudioStore
+
+    audio_store = AudioStore(db)
+    after_id = ''
+    total = 0
+    while True:
+        batch = db.get_calls_without_metrics(batch_size, after_id)
+        if not batch:
+            break
+        # Записи старых звонков могут лежать в холодном уровне - возвращаем их на время расчета
+        paths = [call[key] for call in batch for key in ('client_audio_path', 'staff_audio_path') if call.get(key)]
+        for path in paths:
+            audio_store.ensure_hot(path)
+        total += analyze_and_store(batch, db)
+        audio_store.release(paths, demote=True)
+        after_id = batch[-1]['communication_id']
+        log(f"Обработано до {after_id}, сохранено метрик: {total}")
+    log(f"Готово, сохранено метрик: {total}")
+
+
+if __name__ == "__main__":
+    # Необязательный аргумент - размер пачки
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ANALYTICS_BATCH_SIZE)
@@ -0,0 +1,278 @@
+"""
+Двухуровневое хранение аудиозаписей звонков.
+
+Горячий уровень - WAV в result/ (их читают транскрипция и аналитика), его объем ограничен
+AUDIO_HOT_BUDGET_MB. Холодный уровень - сжатые копии в AUDIO_COLD_DIR (отдельный том или
+смонтированное объектное хранилище): FLAC без потерь, а для файлов, которые FLAC не принимает, - gzip.
+Транскрибированные звонки и давно не использованные файлы уходят в холодный уровень, при превышении
+бюджета вытесняются наименее давно использованные (LRU). Файл, который нужен UI или выгрузке,
+возвращается в горячий уровень по тому же пути (ensure_hot).
+
+Состояние хранится в таблице audio_files, переносы забираются атомарно - несколько процессов
+работают с одним хранилищем без повторных переносов. Перенос, брошенный упавшим процессом
+(запись в состоянии moving дольше AUDIO_MOVE_TIMEOUT), восстанавливается по тому, какой из
+файлов остался на диске (repair_moves).
+"""
+import gzip
+import logging
+import os
+import shutil
+import time
+
+import soundfile as sf
+
+logger = logging.getLogger(__name__)
+
+# Бюджет горячего уровня, МБ
+AUDIO_HOT_BUDGET = int(float(os.environ.get('AUDIO_HOT_BUDGET_MB', 2048)) * 1024 * 1024)
+# Каталог холодного уровня
+AUDIO_COLD_DIR = os.environ.get('AUDIO_COLD_DIR', 'cold_audio')
+# Файлы без обращений дольше этого срока уходят в холодный уровень, секунды
+AUDIO_HOT_MAX_AGE = float(os.environ.get('AUDIO_HOT_MAX_AGE', 86400))
+# Как часто проверять бюджет и возраст файлов, секунды
+AUDIO_SWEEP_INTERVAL = float(os.environ.get('AUDIO_SWEEP_INTERVAL', 300))
+# Аренда файла на время обработки звонка и на время чтения из UI/выгрузки, секунды
+AUDIO_PROCESSING_LEASE = float(os.environ.get('AUDIO_PROCESSING_LEASE', 3600))
+AUDIO_READ_LEASE = float(os.environ.get('AUDIO_READ_LEASE', 600))
+# Сколько ждать, пока файл переносит другой процесс, секунды
+AUDIO_MOVE_WAIT = 60
+# Перенос дольше этого срока считается брошенным упавшим процессом и восстанавливается
+# по файлам на диске, секунды. Должен быть больше времени сжатия самой длинной записи.
+AUDIO_MOVE_TIMEOUT = float(os.environ.get('AUDIO_MOVE_TIMEOUT', 1800))
+
+# Разрядности WAV, которые FLAC хранит без потерь
+FLAC_SUBTYPES = ('PCM_S8', 'PCM_16', 'PCM_24')
+# Размер блока при перекодировании, кадров
+TRANSCODE_BLOCK = 65536
+
+
+def _compress(src, dst_base):
+    """Сжимает файл в FLAC или gzip. Возвращает путь к сжатой копии."""
+    try:
+        info = sf.info(src)
+        flac_ok = info.format == 'WAV' and info.subtype in FLAC_SUBTYPES
+    except RuntimeError:
+        flac_ok = False
+    if flac_ok:
+        dst = dst_base + '.flac'
+        with sf.SoundFile(src) as source, \
+                sf.SoundFile(dst + '.tmp', 'w', samplerate=source.samplerate, channels=source.channels,
+                             format='FLAC', subtype=source.subtype) as target:
+            for block in source.blocks(TRANSCODE_BLOCK, dtype='int32'):
+                target.write(block)
+    else:
+        dst = dst_base + '.gz'
+        with open(src, 'rb') as source, gzip.open(dst + '.tmp', 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target)
+    os.replace(dst + '.tmp', dst)
+    return dst
+
+
+def _decompress(src, dst):
+    """Восстанавливает исходный файл из сжатой копии"""
+    if src.endswith('.flac'):
+        with sf.SoundFile(src) as source, \
+                sf.SoundFile(dst + '.tmp', 'w', samplerate=source.samplerate, channels=source.channels,
+                             format='WAV', subtype=source.subtype) as target:
+            for block in source.blocks(TRANSCODE_BLOCK, dtype='int32'):
+                target.write(block)
+    else:
+        with gzip.open(src, 'rb') as source, open(dst + '.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target)
+    os.replace(dst + '.tmp', dst)
+
+
+class AudioStore:
+    def __init__(self, database, hot_budget=AUDIO_HOT_BUDGET, cold_dir=AUDIO_COLD_DIR,
+                 max_age=AUDIO_HOT_MAX_AGE):
+        self.database = database
+        self.hot_budget = hot_budget
+        self.cold_dir = cold_dir
+        self.max_age = max_age
+
+    def register(self, paths, communication_id=None, lease=AUDIO_PROCESSING_LEASE):
+        """Учитывает скачанные файлы в горячем уровне; на время обработки файлы не вытесняются"""
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            old_cold = self.database.register_audio_file(
+                path, communication_id, os.path.getsize(path), time.time() + lease if lease else None
+            )
+            # Файл скачан заново - старая сжатая копия больше не нужна
+            if old_cold and os.path.exists(old_cold):
+                os.remove(old_cold)
+        self.enforce_budget()
+
+    def release(self, paths, demote=False):
+        """Снимает аренду; demote - сразу перенести в холодный уровень (звонок обработан)"""
+        self.database.touch_audio_files(paths)
+        if demote:
+            for path in paths:
+                self.demote(path)
+
+    def ensure_hot(self, path, lease=AUDIO_READ_LEASE):
+        """
+        Путь к файлу в горячем уровне: при необходимости восстанавливает его из холодного.
+        Returns:
+            str: path или None, если файла нет ни в одном уровне
+        """
+        if not path:
+            return None
+        deadline = time.time() + AUDIO_MOVE_WAIT
+        while True:
+            record = self.database.get_audio_file(path)
+            if record is None:
+                if not os.path.exists(path):
+                    return None
+                # Файл из прошлых версий, еще не учтенный хранилищем
+                self.database.register_audio_file(path, None, os.path.getsize(path), time.time() + lease)
+                return path
+            if record['tier'] == 'hot' and os.path.exists(path):
+                self.database.touch_audio_files([path], time.time() + lease)
+                return path
+            if record['tier'] == 'cold' and self.database.claim_audio_move(path, 'cold'):
+                return self._restore(path, record, lease)
+            if record['tier'] == 'hot':
+                # Запись есть, файла нет (удален вручную) - восстанавливать неоткуда
+                return None
+            if record['tier'] == 'moving' and self._is_stale(record):
+                self._repair(record)
+                continue
+            if time.time() > deadline:
+                logger.warning(f"Audio file {path} is still being moved by another process")
+                return None
+            time.sleep(0.2)
+
+    def ensure_hot_many(self, paths, lease=AUDIO_READ_LEASE):
+        """ensure_hot для набора файлов (выгрузка, архивирование). Возвращает пути, которые есть в горячем уровне."""
+        hot = [path for path in paths if self.ensure_hot(path, lease)]
+        if len(hot) < len(paths):
+            logger.warning(f"{len(paths) - len(hot)} of {len(paths)} audio files are missing in both tiers")
+        return hot
+
+    def _restore(self, path, record, lease):
+        cold_path = record['cold_path']
+        try:
+            _decompress(cold_path, path)
+        except Exception as e:
+            logger.error(f"Could not restore {path} from {cold_path}: {e}")
+            self.database.finish_audio_move(path, 'cold')
+            return None
+        os.remove(cold_path)
+        self.database.finish_audio_move(path, 'hot', size=os.path.getsize(path), lease_until=time.time() + lease)
+        logger.info(f"Audio {path} restored from cold tier")
+        self.enforce_budget()
+        return path
+
+    def demote(self, path, ignore_lease=False):
+        """Переносит файл в холодный уровень. False, если файл занят или уже перенесен."""
+        if not self.database.claim_audio_move(path, 'hot', ignore_lease):
+            return False
+        try:
+            os.makedirs(self.cold_dir, exist_ok=True)
+            cold_path = _compress(path, os.path.join(self.cold_dir, os.path.basename(path)))
+        except Exception as e:
+            logger.error(f"Could not move {path} to cold tier: {e}")
+            self.database.finish_audio_move(path, 'hot')
+            return False
+        cold_size = os.path.getsize(cold_path)
+        os.remove(path)
+        self.database.finish_audio_move(path, 'cold', cold_path=cold_path, cold_size=cold_size)
+        logger.info(f"Audio {path} moved to cold tier ({cold_size} bytes)")
+        return True
+
+    def enforce_budget(self):
+        """Вытесняет наименее давно использованные файлы, пока горячий уровень больше бюджета"""
+        excess = self.database.get_audio_usage()['hot']['bytes'] - self.hot_budget
+        while excess > 0:
+            candidates = self.database.get_lru_hot_audio(limit=50)
+            if not candidates:
+                # Все оставшиеся файлы заняты обработкой
+                logger.warning(f"Hot audio tier is over budget by {excess} bytes, all files are leased")
+                return
+            moved = False
+            for path, size in candidates:
+                if excess <= 0:
+                    break
+                if self.demote(path):
+                    excess -= size
+                    moved = True
+            if not moved:
+                return
+
+    def sweep(self):
+        """Чинит брошенные переносы, переносит давно не использованные файлы и приводит горячий уровень к бюджету"""
+        self.repair_moves()
+        aged_before = time.time() - self.max_age
+        while True:
+            aged = self.database.get_lru_hot_audio(limit=100, accessed_before=aged_before)
+            moved = [path for path, _ in aged if self.demote(path)]
+            if not moved:
+                break
+        self.enforce_budget()
+
+    def _is_stale(self, record):
+        return record['moving_since'] is None or record['moving_since'] < time.time() - AUDIO_MOVE_TIMEOUT
+
+    def _cold_candidates(self, record):
+        """Возможные сжатые копии файла: из записи и те, что создает demote"""
+        base = os.path.join(self.cold_dir, os.path.basename(record['path']))
+        candidates = [record['cold_path']] if record['cold_path'] else []
+        return candidates + [base + ext for ext in ('.flac', '.gz') if base + ext != record['cold_path']]
+
+    def _repair(self, record):
+        """
+        Восстанавливает состояние зависшего переноса по файлам на диске. Перенос заменяет целевой
+        файл атомарно (os.replace) и только потом удаляет исходный, поэтому существующий WAV всегда
+        целый: есть WAV - файл горячий, иначе холодный, если осталась сжатая копия.
+        """
+        path = record['path']
+        started_before = time.time() - AUDIO_MOVE_TIMEOUT
+        cold_paths = [p for p in self._cold_candidates(record) if os.path.exists(p)]
+        if os.path.exists(path):
+            tier, repaired = 'hot', self.database.repair_audio_move(
+                path, started_before, 'hot', size=os.path.getsize(path)
+            )
+            # Копии, сделанные до падения, больше не нужны
+            leftovers = cold_paths
+        elif cold_paths:
+            cold_path = cold_paths[0]
+            tier, repaired = 'cold', self.database.repair_audio_move(
+                path, started_before, 'cold', cold_path=cold_path, cold_size=os.path.getsize(cold_path)
+            )
+            leftovers = []
+        else:
+            tier, repaired = 'lost', self.database.repair_audio_move(path, started_before)
+            leftovers = []
+        if not repaired:
+            # Перенос уже завершил или починил другой процесс
+            return False
+        for leftover in leftovers + [path + '.tmp'] + [p + '.tmp' for p in self._cold_candidates(record)]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        if tier == 'lost':
+            logger.warning(f"Audio {path} was lost in an interrupted move, record removed")
+        else:
+            logger.warning(f"Audio {path} recovered from an interrupted move as {tier}")
+        return True
+
+    def repair_moves(self):
+        """Чинит переносы, брошенные упавшими процессами. Возвращает число исправленных записей."""
+        records = self.database.get_stale_audio_moves(time.time() - AUDIO_MOVE_TIMEOUT)
+        return sum(1 for record in records if self._repair(record))
+
+    def scan(self, hot_dir):
+        """Учитывает WAV, которые уже лежат в горячем каталоге (до появления хранилища)"""
+        if not os.path.isdir(hot_dir):
+            return
+        files = []
+        for entry in os.scandir(hot_dir):
+            if entry.is_file() and entry.name.endswith('.wav'):
+                stat = entry.stat()
+                files.append((os.path.abspath(entry.path), stat.st_size, stat.st_mtime))
+        self.database.register_untracked_audio_files(files)
+
+    def stats(self):
+        usage = self.database.get_audio_usage()
+        usage['hot_budget'] = self.hot_budget
+        return usage
@@ -0,0 +1,286 @@
+"""
+Локальные заглушки внешних сервисов для бенчмарков и нагрузочных тестов:
+  - UIS Data API (JSON-RPC get.calls_report)       POST /v2.0
+  - медиасервер UIS с WAV-записями                  GET  /system/media/wav/{comm_id}/{wav_id}/
+  - OpenAI Whisper (audio/transcriptions)           POST /v1/audio/transcriptions
+  - OpenAI Chat Completions (GPT-анализ диалогов)   POST /v1/chat/completions
+
+Задержки и доля ошибок настраиваются отдельно для каждого сервиса.
+Запуск:
+    python fake_upstreams.py --port 9100 --calls 100 --whisper-latency 0.8 --whisper-error-rate 0.05
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import soundfile as sf
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 8000
+FIRST_COMM_ID = 1000000
+
+PHRASES = [
+    "Здравствуйте, слушаю вас.",
+    "Я хотел бы уточнить статус заказа.",
+    "Подскажите, пожалуйста, номер договора.",
+    "Да, конечно, одну минуту.",
+    "Спасибо, всё понятно.",
+    "Давайте я вам перезвоню.",
+]
+
+
+class UpstreamProfile:
+    """Задержка (секунды) и доля ошибок для одной заглушки"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+
+    async def simulate(self, extra_latency: float = 0.0):
+        """Ждет заданную задержку. Возвращает код ошибки или None."""
+        self.requests += 1
+        delay = self.latency + extra_latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return self.error_status
+        return None
+
+    def stats(self):
+        return {
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+            'errors': self.errors
+        }
+
+
+def generate_calls(count: int, min_duration: int = 20, max_duration: int = 300, seed: int = 42):
+    """Синтетическая выгрузка get.calls_report: звонки равномерно за последние 2 часа"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    calls = []
+    for i in range(count):
+        comm_id = FIRST_COMM_ID + i
+        start = now - timedelta(seconds=rng.uniform(0, 7200))
+        duration = rng.randint(min_duration, max_duration)
+        calls.append({
+            'id': comm_id,
+            'communication_id': comm_id,
+            'start_time': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'finish_time': (start + timedelta(seconds=duration)).strftime('%Y-%m-%d %H:%M:%S'),
+            'direction': rng.choice(['in', 'out']),
+            'contact_phone_number': f"7999{rng.randint(0, 9999999):07d}",
+            'virtual_phone_number': '74950000000',
+            'total_duration': duration,
+            'talk_duration': max(duration - 5, 0),
+            'employees': [{'employee_id': rng.randint(1, 50), 'employee_full_name': 'Сотрудник'}],
+            'wav_call_records': [f"{comm_id}01", f"{comm_id}02"],
+        })
+    calls.sort(key=lambda c: c['start_time'])
+    return calls
+
+
+def make_wav(duration: float, seed: int = 0) -> bytes:
+    """Моно WAV 8 кГц: чередование «речи» (шумовые пачки) и тишины"""
+    rng = np.random.default_rng(seed)
+    samples = int(duration * SAMPLE_RATE)
+    signal = rng.normal(0, 0.01, samples).astype(np.float32)
+    burst = SAMPLE_RATE * 2
+    for offset in range(0, samples, burst * 2):
+        end = min(offset + burst, samples)
+        signal[offset:end] += rng.normal(0, 0.2, end - offset).astype(np.float32)
+    buf = io.BytesIO()
+    sf.write(buf, signal, SAMPLE_RATE, format='WAV', subtype='PCM_16')
+    return buf.getvalue()
+
+
+def make_transcript(audio_seconds: float, seed: int = 0) -> dict:
+    """Ответ Whisper в формате verbose_json с сегментами по ~3 секунды"""
+    rng = random.Random(seed)
+    segments = []
+    t = 0.0
+    while t < audio_seconds:
+        length = min(rng.uniform(1.5, 4.0), audio_seconds - t)
+        segments.append({
+            'id': len(segments),
+            'start': round(t, 2),
+            'end': round(t + length, 2),
+            'text': ' ' + rng.choice(PHRASES)
+        })
+        t += length + rng.uniform(0.5, 3.0)
+    return {
+        'task': 'transcribe',
+        'language': 'russian',
+        'duration': audio_seconds,
+        'text': ''.join(s['text'] for s in segments).strip(),
+        'segments': segments
+    }
+
+
+def make_analysis(dialogs: list, seed: int = 0) -> dict:
+    """Ответ Chat Completions с оценками для каждого переданного диалога"""
+    rng = random.Random(seed)
+    results = [{
+        'id': d.get('id'),
+        'quality_score': rng.randint(0, 10),
+        'politeness': rng.randint(0, 10),
+        'needs_identified': rng.randint(0, 10),
+        'objection_handling': rng.randint(0, 10),
+        'outcome': rng.choice(['sale', 'callback', 'refusal', 'info', 'other']),
+        'summary': 'Клиент уточнил статус заказа.'
+    } for d in dialogs]
+    return {
+        'id': f'chatcmpl-fake-{seed}',
+        'object': 'chat.completion',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': json.dumps({'results': results}, ensure_ascii=False)},
+            'finish_reason': 'stop'
+        }],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    }
+
+
+def create_app(calls, uis: UpstreamProfile, media: UpstreamProfile, whisper: UpstreamProfile,
+               whisper_realtime_factor: float = 0.0, gpt: UpstreamProfile = None) -> FastAPI:
+    """
+    whisper_realtime_factor - дополнительная задержка Whisper на секунду аудио
+    (0.05 = минута записи распознается за 3 секунды).
+    """
+    gpt = gpt or UpstreamProfile()
+    app = FastAPI(title="Fake UIS/OpenAI upstreams")
+    by_id = {str(c['communication_id']): c for c in calls}
+    wav_cache = {}
+
+    def wav_for(comm_id: str) -> bytes:
+        call = by_id.get(comm_id)
+        duration = call['total_duration'] if call else 30
+        if duration not in wav_cache:
+            wav_cache[duration] = make_wav(duration, seed=duration)
+        return wav_cache[duration]
+
+    @app.post("/v2.0")
+    async def calls_report(request: Request):
+        payload = await request.json()
+        status = await uis.simulate()
+        if status:
+            return JSONResponse({'error': 'simulated failure'}, status_code=status)
+        params = payload.get('params', {})
+        date_from = params.get('date_from', '')
+        date_till = params.get('date_till', '9999')
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 1000))
+        selected = [c for c in calls if date_from <= c['start_time'] <= date_till]
+        # Поддерживается только фильтр по равенству поля, как в поиске одного звонка
+        flt = params.get('filter')
+        if flt:
+            selected = [c for c in selected if str(c.get(flt['field'])) == str(flt['value'])]
+        return {
+            'jsonrpc': '2.0',
+            'id': payload.get('id'),
+            'result': {
+                'data': selected[offset:offset + limit],
+                'metadata': {'total_items': len(selected)}
+            }
+        }
+
+    @app.get("/system/media/wav/{comm_id}/{wav_id}/")
+    async def media_record(comm_id: str, wav_id: str):
+        status = await media.simulate()
+        if status:
+            return Response(status_code=status)
+        return Response(content=wav_for(comm_id), media_type='audio/wav')
+
+    @app.post("/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        body = await request.body()
+        # Длительность оцениваем по размеру PCM_16 моно 8 кГц, не разбирая multipart
+        audio_seconds = max(len(body) / (SAMPLE_RATE * 2), 1.0)
+        status = await whisper.simulate(audio_seconds * whisper_realtime_factor)
+        if status:
+            return JSONResponse({'error': {'message': 'simulated failure'}}, status_code=status)
+        return make_transcript(audio_seconds, seed=len(body))
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        try:
+            dialogs = json.loads(payload['messages'][-1]['content'])
+        except (KeyError, IndexError, ValueError):
+            dialogs = []
+        status = await gpt.simulate()
+        if status:
+            return JSONResponse({'error': {'message': 'simulated failure'}}, status_code=status)
+        return make_analysis(dialogs, seed=len(dialogs))
+
+    @app.get("/stats")
+    async def upstream_stats():
+        return {
+            'calls': len(calls),
+            'uis': uis.stats(),
+            'media': media.stats(),
+            'whisper': whisper.stats(),
+            'gpt': gpt.stats()
+        }
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Локальные заглушки UIS и OpenAI")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--calls', type=int, default=100,
+                        help="Количество звонков в выгрузке")
+    parser.add_argument('--min-duration', type=int, default=20)
+    parser.add_argument('--max-duration', type=int, default=300)
+    for name, latency in [('uis', 0.2), ('media', 0.05), ('whisper', 1.0), ('gpt', 2.0)]:
+        parser.add_argument(f'--{name}-latency', type=float, default=latency)
+        parser.add_argument(f'--{name}-jitter', type=float, default=0.0)
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0)
+        parser.add_argument(f'--{name}-error-status', type=int, default=500)
+    parser.add_argument('--whisper-realtime-factor', type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiles = {
+        name: UpstreamProfile(
+            latency=getattr(args, f'{name}_latency'),
+            jitter=getattr(args, f'{name}_jitter'),
+            error_rate=getattr(args, f'{name}_error_rate'),
+            error_status=getattr(args, f'{name}_error_status')
+        )
+        for name in ('uis', 'media', 'whisper', 'gpt')
+    }
+    calls = generate_calls(args.calls, args.min_duration, args.max_duration)
+    logger.info(f"Fake upstreams: {len(calls)} calls, profiles: "
+                f"{json.dumps({k: v.stats() for k, v in profiles.items()})}")
+    app = create_app(calls, profiles['uis'], profiles['media'], profiles['whisper'],
+                     args.whisper_realtime_factor, profiles['gpt'])
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Нагрузочный тест webhook-сервера без обращения к внешним сервисам.
+
+Скрипт раскладывает модули в плоскую рабочую директорию (как Dockerfile.transcriber в /app),
+поднимает заглушки из fake_upstreams.py, запускает webhook_server через uvicorn
+и подает POST /webhook/call с заданной частотой (открытая модель нагрузки).
+В конце печатает JSON-отчет: пропускная способность, перцентили задержек,
+коды ответов, CPU и память процесса сервера.
+
+Пример:
+    python load_test.py --rate 5 --duration 60 --calls 100 --whisper-latency 1.5
+    python load_test.py --web-workers 2 --queue-workers 4 --rate 10
+
+С --queue-workers сервер работает в режиме SERVICE_MODE=ingest, звонки обрабатывают отдельные
+процессы call_worker.py, а задержка считается до появления transcript_path (опрос /call/{id}).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import psutil
+except ImportError:  # psutil не обязателен, без него читаем /proc
+    psutil = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+
+# Модули, которые Dockerfile.transcriber копирует в /app
+APP_MODULES = [
+    'UIS_API_GET/get_calls.py',
+    'transcriber/transcribe_calls.py',
+    'webhook_server/webhook_server.py',
+    'db/database.py',
+    'audio_store/audio_store.py',
+    'export/columnar_export.py',
+    'export/export_cache.py',
+    'analytics/call_analytics.py',
+    'gpt_analysis/gpt_analysis.py',
+    'rate_limiter/rate_limiter.py',
+    'retry_scheduler/retry_scheduler.py',
+    'reconcile_poller/reconcile_poller.py',
+    'single_flight/single_flight.py',
+    'priority_scheduler/priority_scheduler.py',
+    'pipeline/call_pipeline.py',
+    'worker/call_worker.py',
+    'webhook_server/archive_system.py',
+]
+
+FIRST_COMM_ID = 1000000
+
+
+def stage_app(workdir):
+    """Плоская раскладка модулей (симлинки) как в контейнере"""
+    for rel_path in APP_MODULES:
+        src = os.path.join(PROJECT_DIR, rel_path)
+        dst = os.path.join(workdir, os.path.basename(rel_path))
+        if os.path.exists(src) and not os.path.exists(dst):
+            os.symlink(src, dst)
+    os.makedirs(os.path.join(workdir, 'result'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class ResourceSampler(threading.Thread):
+    """Периодически снимает суммарные CPU и RSS процессов сервера и воркеров"""
+
+    def __init__(self, pids, interval=0.5):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def _read(self):
+        if psutil:
+            procs = []
+            for pid in self.pids:
+                proc = psutil.Process(pid)
+                procs += [proc] + proc.children(recursive=True)
+            cpu = sum(p.cpu_times().user + p.cpu_times().system for p in procs)
+            rss = sum(p.memory_info().rss for p in procs)
+            return cpu, rss
+        # Без psutil дочерние процессы uvicorn --workers не учитываются
+        cpu = 0.0
+        rss = 0
+        for pid in self.pids:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        return cpu, rss
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.samples.append((time.time(),) + self._read())
+            except (OSError, ValueError, IndexError):
+                pass
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def report(self):
+        if len(self.samples) < 2:
+            return {}
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [s[2] for s in self.samples]
+        return {
+            'cpu_seconds': round(cpu1 - cpu0, 3),
+            'cpu_utilization': round((cpu1 - cpu0) / (t1 - t0), 3) if t1 > t0 else None,
+            'rss_max_mb': round(max(rss) / 2 ** 20, 1),
+            'rss_avg_mb': round(sum(rss) / len(rss) / 2 ** 20, 1),
+        }
+
+
+def wait_processed(base_url, comm_id, deadline, interval=0.5):
+    """Опрашивает /call/{id}, пока у звонка не появится transcript_path. Возвращает код ответа."""
+    while time.time() < deadline:
+        try:
+            r = requests.get(f'{base_url}/call/{comm_id}', timeout=10)
+            if r.status_code == 200 and r.json().get('transcript_path'):
+                return 200
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    return 'Timeout'
+
+
+def drive(base_url, rate, duration, calls, timeout, workers):
+    """
+    Открытая модель: запросы уходят по расписанию независимо от ответов сервера.
+    Ответ 202 (звонок в очереди или отложен) дожидается обработки опросом /call/{id}.
+    """
+    results = []
+    lock = threading.Lock()
+    comm_ids = [str(FIRST_COMM_ID + i) for i in range(calls)]
+    random.shuffle(comm_ids)
+
+    def fire(comm_id, scheduled):
+        started = time.time()
+        try:
+            r = requests.post(f'{base_url}/webhook/call', json={'communication_id': comm_id},
+                              timeout=timeout)
+            status = r.status_code
+            if status == 202:
+                status = wait_processed(base_url, comm_id, started + timeout)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        finished = time.time()
+        with lock:
+            results.append({
+                'comm_id': comm_id,
+                'status': status,
+                'latency': finished - started,
+                'queue_delay': started - scheduled
+            })
+
+    total = int(rate * duration)
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(total):
+            scheduled = begin + i / rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, comm_ids[i % len(comm_ids)], scheduled)
+    return results, time.time() - begin
+
+
+def summarize(results, elapsed):
+    statuses = {}
+    for r in results:
+        statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+    ok = [r['latency'] for r in results if r['status'] == 200]
+    all_latencies = [r['latency'] for r in results]
+    return {
+        'requests': len(results),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_rps': round(len(ok) / elapsed, 3) if elapsed else None,
+        'statuses': statuses,
+        'latency_ok': {f'p{p}': percentile(ok, p) for p in (50, 90, 95, 99)},
+        'latency_all': {f'p{p}': percentile(all_latencies, p) for p in (50, 90, 99)},
+        'max_client_queue_delay': max((r['queue_delay'] for r in results), default=None),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /webhook/call на заглушках")
+    parser.add_argument('--rate', type=float, default=2.0, help="Запросов в секунду")
+    parser.add_argument('--duration', type=float, default=30.0, help="Длительность подачи, секунды")
+    parser.add_argument('--calls', type=int, default=100)
+    parser.add_argument('--server-port', type=int, default=8800)
+    parser.add_argument('--upstream-port', type=int, default=9100)
+    parser.add_argument('--request-timeout', type=float, default=600.0)
+    parser.add_argument('--client-workers', type=int, default=256)
+    parser.add_argument('--web-workers', type=int, default=1, help="Процессов uvicorn")
+    parser.add_argument('--queue-workers', type=int, default=0,
+                        help="Отдельных процессов call_worker.py (сервер в режиме ingest)")
+    parser.add_argument('--keep-workdir', action='store_true')
+    parser.add_argument('--output', help="Файл для JSON-отчета")
+    # Остальные параметры передаются заглушкам как есть (--whisper-latency 1.5 и т.п.)
+    args, upstream_args = parser.parse_known_args(argv)
+    if args.web_workers > 1 and not args.queue_workers:
+        # В режиме all каждый процесс uvicorn запускал бы свои фоновые задачи и лимитеры
+        parser.error("--web-workers > 1 требует --queue-workers (сервер в режиме ingest)")
+    return args, upstream_args
+
+
+def main(argv=None):
+    args, upstream_args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='call_analyzer_bench_')
+    stage_app(workdir)
+    upstream_url = f'http://127.0.0.1:{args.upstream_port}'
+    server_url = f'http://127.0.0.1:{args.server_port}'
+
+    env = dict(os.environ)
+    env.update({
+        'DB_PATH': os.path.join(workdir, 'data', 'calls.db'),
+        'UIS_DATA_API_URL': f'{upstream_url}/v2.0',
+        'UIS_MEDIA_URL_TEMPLATE': upstream_url + '/system/media/wav/{comm_id}/{wav_id}/',
+        'OPENAI_TRANSCRIPTIONS_URL': f'{upstream_url}/v1/audio/transcriptions',
+        'OPENAI_CHAT_URL': f'{upstream_url}/v1/chat/completions',
+        'OPENAI_USE_PROXY': '0',
+        'PYTHONUNBUFFERED': '1',
+        # Сверка с выгрузкой подхватила бы все звонки заглушки в обход webhook-ов
+        'RECONCILE_ENABLED': '0',
+        # Модули подключены симлинками - для call_worker.py sys.path[0] указывал бы на исходную папку
+        'PYTHONPATH': os.pathsep.join(filter(None, [workdir, os.environ.get('PYTHONPATH')])),
+    })
+
+    processes = []
+    try:
+        upstream = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'fake_upstreams.py'),
+             '--port', str(args.upstream_port), '--calls', str(args.calls)] + upstream_args,
+            env=env
+        )
+        processes.append(upstream)
+        server_log = open(os.path.join(workdir, 'server.log'), 'w')
+        server_env = dict(env, SERVICE_MODE='ingest' if args.queue_workers else 'all',
+                          WEB_CONCURRENCY=str(args.web_workers))
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'webhook_server:app',
+             '--host', '127.0.0.1', '--port', str(args.server_port), '--log-level', 'warning',
+             '--workers', str(args.web_workers)],
+            cwd=workdir, env=server_env, stdout=server_log, stderr=subprocess.STDOUT
+        )
+        processes.append(server)
+        worker_pids = []
+        for _ in range(args.queue_workers):
+            worker = subprocess.Popen(
+                [sys.executable, 'call_worker.py'],
+                cwd=workdir, env=dict(env, SERVICE_MODE='worker'),
+                stdout=server_log, stderr=subprocess.STDOUT
+            )
+            processes.append(worker)
+            worker_pids.append(worker.pid)
+        if not wait_for(f'{upstream_url}/stats') or not wait_for(f'{server_url}/health'):
+            print("Заглушки или сервер не запустились, см. server.log в " + workdir, file=sys.stderr)
+            return 1
+
+        sampler = ResourceSampler([server.pid] + worker_pids)
+        sampler.start()
+        results, elapsed = drive(server_url, args.rate, args.duration, args.calls,
+                                 args.request_timeout, args.client_workers)
+        sampler.stop()
+
+        report = {
+            'config': {'rate': args.rate, 'duration': args.duration, 'calls': args.calls,
+                       'web_workers': args.web_workers, 'queue_workers': args.queue_workers,
+                       'upstream_args': upstream_args},
+            'results': summarize(results, elapsed),
+            'server_resources': sampler.report(),
+            'upstreams': requests.get(f'{upstream_url}/stats', timeout=5).json(),
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(output)
+        return 0
+    finally:
+        for proc in reversed(processes):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if args.keep_workdir:
+            print(f"Рабочая директория сохранена: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Микробенчмарки горячих функций: merge_transcripts, save_dialog_format, screen_channel и методы Database.
+Для screen_channel заодно проверяется вердикт на синтетических каналах.
+
+Запуск:
+    python micro_bench.py --segments 50 500 5000 --rows 10000
+Результат - JSON с лучшим и медианным временем одного вызова (timeit.repeat).
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import soundfile as sf
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+
+# В контейнере модули лежат в одной директории, здесь - по подпапкам проекта
+for subdir in ('transcriber', 'db', 'UIS_API_GET', 'rate_limiter'):
+    sys.path.insert(0, os.path.join(PROJECT_DIR, subdir))
+
+# Модуль database создает экземпляр при импорте - направляем его во временный файл
+_tmp_dir = tempfile.mkdtemp(prefix='call_analyzer_micro_')
+os.environ.setdefault('DB_PATH', os.path.join(_tmp_dir, 'import.db'))
+
+from transcribe_calls import merge_transcripts, save_dialog_format, screen_channel  # noqa: E402
+from database import Database  # noqa: E402
+
+
+def make_channel(n_segments, seed):
+    """Транскрипт одного канала в формате Whisper verbose_json"""
+    rng = random.Random(seed)
+    segments = []
+    t = rng.uniform(0, 2)
+    for i in range(n_segments):
+        length = rng.uniform(0.8, 5.0)
+        segments.append({
+            'id': i,
+            'start': round(t, 2),
+            'end': round(t + length, 2),
+            'text': ' Тестовая фраза номер {} для проверки скорости.'.format(i)
+        })
+        t += length + rng.uniform(0.2, 4.0)
+    return {'text': '', 'segments': segments}
+
+
+def measure(func, number, repeat=5):
+    timings = [t / number for t in timeit.repeat(func, number=number, repeat=repeat)]
+    return {
+        'best_us': round(min(timings) * 1e6, 2),
+        'median_us': round(statistics.median(timings) * 1e6, 2),
+        'calls_per_run': number
+    }
+
+
+def bench_transcripts(segment_counts):
+    results = {}
+    out_file = os.path.join(_tmp_dir, 'dialog.txt')
+    for n in segment_counts:
+        client = make_channel(n, seed=1)
+        staff = make_channel(n, seed=2)
+        number = max(1, 20000 // n)
+        results[f'merge_transcripts[{n}x2]'] = measure(
+            lambda: merge_transcripts(client, staff), number)
+        results[f'save_dialog_format[{n}x2]'] = measure(
+            lambda: save_dialog_format(client, staff, out_file), max(1, number // 4))
+    return results
+
+
+def make_screen_channel(path, seconds, speech_seconds, sample_rate=8000, seed=4):
+    """
+    WAV PCM_16: шум на уровне -60 dB и speech_seconds секунд тона на -10 dBFS
+    пачками по 0.5 с, равномерно по записи (короткие ответы собеседника)
+    """
+    rng = np.random.default_rng(seed)
+    signal = rng.normal(0, 10 ** (-60 / 20), int(seconds * sample_rate)).astype(np.float32)
+    burst = int(0.5 * sample_rate)
+    tone = (10 ** (-10 / 20) * np.sqrt(2) * np.sin(2 * np.pi * 440 * np.arange(burst) / sample_rate))
+    bursts = int(round(speech_seconds / 0.5))
+    for offset in np.linspace(0, len(signal) - burst, bursts + 2, dtype=np.int64)[1:-1]:
+        signal[offset:offset + burst] += tone.astype(np.float32)
+    sf.write(path, signal, sample_rate, subtype='PCM_16')
+
+
+def bench_screening():
+    """Время screen_channel и проверка вердикта: (длительность, секунды речи, ожидаемый silent)"""
+    cases = [
+        (60, 0.0, True),
+        (1200, 0.0, True),
+        (1200, 1.0, True),
+        # Клиент отвечает «да/нет» на 5 секунд за 20 минут разговора - канал не мертвый
+        (1200, 5.0, False),
+        (60, 20.0, False),
+    ]
+    results = {}
+    for seconds, speech_seconds, expected in cases:
+        path = os.path.join(_tmp_dir, f'screen_{seconds}_{speech_seconds}.wav')
+        make_screen_channel(path, seconds, speech_seconds)
+        verdict = screen_channel(path)
+        if verdict['silent'] != expected:
+            raise AssertionError(
+                f"screen_channel({seconds} s, {speech_seconds} s speech): silent={verdict['silent']}, "
+                f"expected {expected}: {verdict}"
+            )
+        results[f'screen_channel[{seconds}s, speech {speech_seconds}s]'] = measure(
+            lambda: screen_channel(path), 3, repeat=3)
+    return results
+
+
+def bench_database(rows):
+    db = Database(os.path.join(_tmp_dir, f'bench_{rows}.db'))
+    rng = random.Random(3)
+    call_data = {
+        'communication_id': 0,
+        'start_time': '2024-01-01 12:00:00',
+        'contact_phone_number': '79990000000',
+        'total_duration': 120,
+        'wav_call_records': ['1', '2']
+    }
+    for i in range(rows):
+        call_data['communication_id'] = i
+        db.add_call(str(i), call_data)
+        if rng.random() < 0.8:
+            db.update_call_paths(str(i), transcript_path=f'/app/result/transcribed_call{i}_x')
+
+    counter = iter(range(rows, rows * 100))
+    ids = [str(rng.randrange(rows)) for _ in range(1000)]
+    id_iter = iter(ids * 1000)
+    return {
+        f'add_call[{rows} rows]': measure(lambda: db.add_call(str(next(counter)), call_data), 200),
+        f'update_call_paths[{rows} rows]': measure(
+            lambda: db.update_call_paths(next(id_iter), '/c.wav', '/s.wav'), 200),
+        f'get_call[{rows} rows]': measure(lambda: db.get_call(next(id_iter)), 500),
+        f'get_processed_communication_ids[{rows} rows]': measure(
+            db.get_processed_communication_ids, 5),
+        f'get_calls_for_analysis[{rows} rows]': measure(
+            lambda: db.get_calls_for_analysis('2000-01-01', '2100-01-01'), 3),
+        f'get_calls_older_than[{rows} rows]': measure(lambda: db.get_calls_older_than(0), 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки Call_analyzer")
+    parser.add_argument('--segments', type=int, nargs='+', default=[50, 500, 5000],
+                        help="Сегментов на канал для merge_transcripts/save_dialog_format")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                        help="Размер таблицы calls для методов Database")
+    parser.add_argument('--output', help="Файл для JSON-отчета")
+    args = parser.parse_args(argv)
+
+    report = bench_transcripts(args.segments)
+    report.update(bench_screening())
+    for rows in args.rows:
+        report.update(bench_database(rows))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
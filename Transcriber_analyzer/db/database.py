@@ -3,6 +3,7 @@ import json
 from datetime import datetime
 import logging
 import os
+import time
 
 # Настройка логирования
 logging.basicConfig(
@@ -11,6 +12,144 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Колонки таблицы call_metrics (кроме communication_id и computed_at)
+CALL_METRICS_COLUMNS = (
+    'duration',
+    'client_talk_time',
+    'staff_talk_time',
+    'talk_ratio_client',
+    'longest_monologue',
+    'longest_monologue_speaker',
+    'silence_share',
+    'interruptions',
+    'client_interruptions',
+    'staff_interruptions',
+    'response_latency_mean',
+    'response_latency_median',
+    'client_wpm',
+    'staff_wpm',
+    'client_rms_db',
+    'staff_rms_db',
+    'client_active_share',
+    'staff_active_share',
+    'client_silent',
+    'staff_silent',
+)
+
+# Метрики, по которым фильтруют и сортируют дашборды
+CALL_METRICS_INDEXED = (
+    'talk_ratio_client',
+    'longest_monologue',
+    'silence_share',
+    'interruptions',
+    'response_latency_median',
+    'staff_wpm',
+)
+
+# Оценки GPT-анализа звонка (кроме служебных колонок)
+CALL_ANALYSIS_COLUMNS = (
+    'quality_score',
+    'politeness',
+    'needs_identified',
+    'objection_handling',
+    'outcome',
+    'summary',
+)
+
+# Сколько ждать освобождения блокировки БД другим процессом, секунды
+SQLITE_BUSY_TIMEOUT = 30
+
+# Типизированные поля звонка, извлекаемые из строки выгрузки UIS (см. extract_call_fields)
+CALL_FIELD_COLUMNS = (
+    'call_date',
+    'client_phone',
+    'staff_phone',
+    'duration',
+    'direction',
+    'employee_id',
+)
+
+# Колонки, доступные в выборке списка звонков (status вычисляется из transcript_path)
+CALL_LIST_COLUMNS = (
+    'communication_id',
+    'call_date',
+    'client_phone',
+    'staff_phone',
+    'duration',
+    'direction',
+    'employee_id',
+    'client_audio_path',
+    'staff_audio_path',
+    'transcript_path',
+    'metadata',
+    'created_at',
+    'is_archived',
+    'archive_path',
+    'archive_date',
+    'status',
+)
+
+# Колонки списка звонков по умолчанию (metadata - тяжелый JSON, только по запросу)
+CALL_LIST_DEFAULT_COLUMNS = tuple(c for c in CALL_LIST_COLUMNS if c != 'metadata')
+
+# Статус обработки звонка: вычисление и условия фильтра
+CALL_STATUS_SQL = '''CASE
+    WHEN transcript_path = 'NO_WAV' THEN 'no_wav'
+    WHEN transcript_path IS NULL OR transcript_path = '' THEN 'pending'
+    ELSE 'processed'
+END'''
+CALL_STATUS_FILTERS = {
+    'processed': "transcript_path IS NOT NULL AND transcript_path NOT IN ('', 'NO_WAV')",
+    'no_wav': "transcript_path = 'NO_WAV'",
+    'pending': "(transcript_path IS NULL OR transcript_path = '')",
+}
+
+# Колонки звонка, попадающие в выгрузку для аналитиков: их изменение делает выгрузку дня устаревшей
+EXPORT_TRACKED_COLUMNS = CALL_FIELD_COLUMNS + ('transcript_path', 'is_archived')
+
+
+def _bump_export_day_sql(day):
+    """Тело триггера: увеличивает версию дня в export_days (day - SQL-выражение даты)"""
+    return f'''
+        INSERT OR IGNORE INTO export_days (day, version) SELECT {day}, 0 WHERE {day} IS NOT NULL;
+        UPDATE export_days SET version = version + 1 WHERE day = {day};
+    '''
+
+
+# Уровни хранения аудио: hot - WAV в result/, cold - сжатая копия, moving - идет перенос
+AUDIO_TIERS = ('hot', 'cold', 'moving')
+
+# Состояния звонка в очереди обработки call_queue
+QUEUE_STATES = ('queued', 'running', 'done', 'failed')
+
+def _str_or_none(value):
+    return str(value) if value not in (None, '') else None
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def extract_call_fields(call_data: dict) -> dict:
+    """
+    Поля для колонок calls из строки get.calls_report:
+    call_date - start_time, client_phone - contact_phone_number, staff_phone - virtual_phone_number,
+    duration - total_duration, employee_id - последний ответивший сотрудник (или первый из employees)
+    """
+    call_data = call_data or {}
+    employee_id = call_data.get('last_answered_employee_id')
+    if employee_id is None and call_data.get('employees'):
+        employee_id = call_data['employees'][0].get('employee_id')
+    return {
+        'call_date': _str_or_none(call_data.get('start_time')),
+        'client_phone': _str_or_none(call_data.get('contact_phone_number')),
+        'staff_phone': _str_or_none(call_data.get('virtual_phone_number')),
+        'duration': _int_or_none(call_data.get('total_duration')),
+        'direction': _str_or_none(call_data.get('direction')),
+        'employee_id': _int_or_none(employee_id),
+    }
+
 class Database:
     def __init__(self, db_path=None):
         """Инициализация подключения к базе данных"""
@@ -21,14 +160,17 @@ class Database:
         logger.info(f"Используется база данных: {self.db_path}")
         self.init_db()
 
-    def get_connection(self):
+    def get_connection(self, check_same_thread: bool = True):
         """Создает новое подключение к БД"""
-        return sqlite3.connect(self.db_path)
+        # Ждем блокировку вместо немедленной ошибки: с БД работают несколько процессов
+        return sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=check_same_thread)
 
     def init_db(self):
         """Инициализация структуры базы данных"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            # WAL: читатели не блокируют писателя, несколько воркеров пишут без ошибок "database is locked"
+            cursor.execute('PRAGMA journal_mode=WAL')
             
             # Таблица звонков с поддержкой архивирования
             cursor.execute('''
@@ -45,11 +187,223 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     is_archived INTEGER DEFAULT 0,
                     archive_path TEXT,
-                    archive_date TIMESTAMP
+                    archive_date TIMESTAMP,
+                    direction TEXT,
+                    employee_id INTEGER
+                )
+            ''')
+            self._add_missing_columns(cursor, 'calls', {
+                'direction': 'TEXT',
+                'employee_id': 'INTEGER',
+            })
+            # Keyset-пагинация списка звонков по (call_date, communication_id)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_date_id ON calls (call_date, communication_id)')
+            # Фильтры по полям звонка из выгрузки UIS
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_client_phone ON calls (client_phone)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_staff_phone ON calls (staff_phone)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_duration ON calls (duration)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_employee_date ON calls (employee_id, call_date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_direction_date ON calls (direction, call_date)')
+
+            # Метрики разговора, одна строка на звонок
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS call_metrics (
+                    communication_id TEXT PRIMARY KEY,
+                    duration REAL,
+                    client_talk_time REAL,
+                    staff_talk_time REAL,
+                    talk_ratio_client REAL,
+                    longest_monologue REAL,
+                    longest_monologue_speaker TEXT,
+                    silence_share REAL,
+                    interruptions INTEGER,
+                    client_interruptions INTEGER,
+                    staff_interruptions INTEGER,
+                    response_latency_mean REAL,
+                    response_latency_median REAL,
+                    client_wpm REAL,
+                    staff_wpm REAL,
+                    client_rms_db REAL,
+                    staff_rms_db REAL,
+                    client_active_share REAL,
+                    staff_active_share REAL,
+                    client_silent INTEGER,
+                    staff_silent INTEGER,
+                    computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Вердикт проверки каналов на тишину (канал без речи не отправлялся в Whisper)
+            self._add_missing_columns(cursor, 'call_metrics', {
+                'client_silent': 'INTEGER',
+                'staff_silent': 'INTEGER',
+            })
+            for column in CALL_METRICS_INDEXED:
+                cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_call_metrics_{column} ON call_metrics ({column})'
+                )
+
+            # Кэш ответов GPT: один и тот же диалог с той же версией промпта повторно не отправляется
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS gpt_analysis_cache (
+                    transcript_hash TEXT,
+                    prompt_version TEXT,
+                    result JSON,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (transcript_hash, prompt_version)
+                )
+            ''')
+
+            # Результаты GPT-анализа, одна строка на звонок
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS call_analysis (
+                    communication_id TEXT PRIMARY KEY,
+                    prompt_version TEXT,
+                    transcript_hash TEXT,
+                    quality_score INTEGER,
+                    politeness INTEGER,
+                    needs_identified INTEGER,
+                    objection_handling INTEGER,
+                    outcome TEXT,
+                    summary TEXT,
+                    analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_analysis_quality_score ON call_analysis (quality_score)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_analysis_outcome ON call_analysis (outcome)')
+
+            # Звонки, еще не выгруженные в UIS: время следующей проверки (unix time) и число попыток
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pending_calls (
+                    communication_id TEXT PRIMARY KEY,
+                    due_at REAL NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_calls_due_at ON pending_calls (due_at)')
+
+            # Аренда обработки звонка: кто (процесс) и до какого времени (unix time) обрабатывает звонок
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS call_leases (
+                    communication_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+            # Очередь обработки: процессы-воркеры забирают звонки с арендой и продлевают ее heartbeat-ом
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS call_queue (
+                    communication_id TEXT PRIMARY KEY,
+                    call_data JSON,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    claimed_by TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER DEFAULT 0,
+                    enqueued_at REAL NOT NULL,
+                    updated_at REAL,
+                    lane TEXT NOT NULL DEFAULT 'live',
+                    priority REAL
+                )
+            ''')
+            self._add_missing_columns(cursor, 'call_queue', {
+                'lane': "TEXT NOT NULL DEFAULT 'live'",
+                'priority': 'REAL',
+            })
+            cursor.execute('UPDATE call_queue SET priority = enqueued_at WHERE priority IS NULL')
+            # Звонки забираются по ключу приоритета (см. priority_scheduler.priority_key)
+            cursor.execute('DROP INDEX IF EXISTS idx_call_queue_state')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_queue_priority ON call_queue (state, priority)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_call_queue_lease ON call_queue (lease_expires)')
+
+            # Аудиофайлы звонков по уровням хранения; lease_until защищает файл от вытеснения
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS audio_files (
+                    path TEXT PRIMARY KEY,
+                    communication_id TEXT,
+                    tier TEXT NOT NULL DEFAULT 'hot',
+                    size INTEGER NOT NULL DEFAULT 0,
+                    cold_path TEXT,
+                    cold_size INTEGER,
+                    last_access REAL,
+                    lease_until REAL,
+                    moving_since REAL
+                )
+            ''')
+            # moving_since - начало переноса: перенос упавшего процесса находит и чинит AudioStore.repair_moves
+            self._add_missing_columns(cursor, 'audio_files', {'moving_since': 'REAL'})
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_audio_files_lru ON audio_files (tier, last_access)')
+
+            # Версия данных дня (по call_date) для кэша выгрузок: триггеры увеличивают ее при любом
+            # изменении звонка, его метрик или анализа, день с новой версией выгружается заново
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS export_days (
+                    day TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            call_day = 'substr({row}.call_date, 1, 10)'
+            detail_day = '(SELECT substr(call_date, 1, 10) FROM calls WHERE communication_id = {row}.communication_id)'
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS export_days_calls_insert AFTER INSERT ON calls BEGIN
+                    {_bump_export_day_sql(call_day.format(row='NEW'))}
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS export_days_calls_update
+                AFTER UPDATE OF {', '.join(EXPORT_TRACKED_COLUMNS)} ON calls BEGIN
+                    {_bump_export_day_sql(call_day.format(row='OLD'))}
+                    {_bump_export_day_sql(call_day.format(row='NEW'))}
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS export_days_calls_delete AFTER DELETE ON calls BEGIN
+                    {_bump_export_day_sql(call_day.format(row='OLD'))}
+                END
+            ''')
+            for table in ('call_metrics', 'call_analysis'):
+                for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                    cursor.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS export_days_{table}_{event.lower()}
+                        AFTER {event} ON {table} BEGIN
+                            {_bump_export_day_sql(detail_day.format(row=row))}
+                        END
+                    ''')
+
+            # Кэш выгрузок по дням: часть дня (каталог с файлами таблиц) и версия дня, с которой она собрана
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS export_cache (
+                    kind TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    files JSON,
+                    last_access REAL,
+                    PRIMARY KEY (kind, day)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_export_cache_lru ON export_cache (last_access)')
+
+            # Состояние фоновых синхронизаций (high-watermark сверки с UIS и т.п.)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    name TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             conn.commit()
 
+    @staticmethod
+    def _add_missing_columns(cursor, table: str, columns: dict):
+        """Добавляет в существующую таблицу колонки, которых в ней еще нет (columns: имя -> тип)"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, column_type in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
     def add_call(self, communication_id: str, call_data: dict = None):
         """
         Добавление нового звонка в БД
@@ -60,23 +414,64 @@ class Database:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Подготовка данных
-            call_date = datetime.now()  
+            # Подготовка данных: поля выгрузки - в типизированные колонки, строка целиком - в metadata
+            fields = extract_call_fields(call_data)
+            if not fields['call_date']:
+                fields['call_date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             metadata = json.dumps(call_data) if call_data else None
             
-            cursor.execute('''
+            cursor.execute(f'''
                 INSERT OR IGNORE INTO calls (
                     communication_id,
-                    call_date,
+                    {", ".join(CALL_FIELD_COLUMNS)},
                     metadata
-                ) VALUES (?, ?, ?)
+                ) VALUES (?, {", ".join("?" for _ in CALL_FIELD_COLUMNS)}, ?)
             ''', (
                 communication_id,
-                call_date,
+                *(fields[column] for column in CALL_FIELD_COLUMNS),
                 metadata
             ))
             conn.commit()
 
+    def backfill_call_fields(self, batch_size: int = 1000) -> int:
+        """
+        Заполняет типизированные колонки у звонков, сохраненных до их появления
+        (только metadata, call_date - время записи в БД). Идет пачками по communication_id,
+        каждая пачка - отдельная короткая транзакция. Возвращает число обновленных звонков.
+        """
+        after_id = ''
+        total = 0
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT communication_id, metadata FROM calls
+                    WHERE communication_id > ? AND metadata IS NOT NULL AND duration IS NULL
+                    ORDER BY communication_id
+                    LIMIT ?
+                ''', (after_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for communication_id, metadata in rows:
+                    try:
+                        fields = extract_call_fields(json.loads(metadata))
+                    except (ValueError, AttributeError):
+                        continue
+                    updates.append((*(fields[column] for column in CALL_FIELD_COLUMNS), communication_id))
+                cursor.executemany(f'''
+                    UPDATE calls SET
+                        call_date = COALESCE(?, call_date),
+                        {", ".join(f"{column} = COALESCE({column}, ?)" for column in CALL_FIELD_COLUMNS[1:])}
+                    WHERE communication_id = ?
+                ''', updates)
+                conn.commit()
+            after_id = rows[-1][0]
+            total += len(updates)
+            logger.info(f"Backfilled call fields up to {after_id}: {total} calls")
+        return total
+
     def update_call_paths(self, communication_id: str, client_path: str = None, 
                          staff_path: str = None, transcript_path: str = None):
         """Обновление путей к файлам звонка"""
@@ -121,7 +516,9 @@ class Database:
                     staff_audio_path,
                     transcript_path,
                     metadata,
-                    created_at
+                    created_at,
+                    direction,
+                    employee_id
                 FROM calls
                 WHERE communication_id = ?
             ''', (communication_id,))
@@ -138,7 +535,9 @@ class Database:
                     'staff_audio_path': row[6],
                     'transcript_path': row[7],
                     'metadata': json.loads(row[8]) if row[8] else None,
-                    'created_at': row[9]
+                    'created_at': row[9],
+                    'direction': row[10],
+                    'employee_id': row[11]
                 }
             return None
 
@@ -217,5 +616,798 @@ class Database:
                 'archive_date': row[12]
             } for row in rows]
 
+    def iter_calls(self, columns=None, status: str = None, is_archived: bool = None, phone: str = None,
+                   date_from: str = None, date_to: str = None, direction: str = None,
+                   employee_id: int = None, min_duration: int = None, max_duration: int = None,
+                   after: tuple = None, limit: int = None, chunk_size: int = 5000):
+        """
+        Список звонков в порядке (call_date, communication_id) с keyset-пагинацией.
+        Аргументы проверяются сразу (ValueError), строки отдаются генератором: выборка идет
+        порциями по chunk_size от последнего ключа, поэтому память не зависит от числа звонков,
+        а читающая транзакция не держится, пока клиент медленно забирает ответ.
+        Args:
+            columns: колонки из CALL_LIST_COLUMNS (call_date и communication_id добавляются всегда)
+            status: processed, no_wav или pending
+            phone: номер клиента или сотрудника
+            date_from, date_to: границы call_date (время начала звонка в UIS)
+            min_duration, max_duration: границы длительности, секунды
+            after: (call_date, communication_id) последней строки предыдущей страницы
+            limit: максимум строк (None - все)
+        """
+        columns = list(columns or CALL_LIST_DEFAULT_COLUMNS)
+        unknown = [c for c in columns if c not in CALL_LIST_COLUMNS]
+        if unknown:
+            raise ValueError(f"Неизвестные колонки: {', '.join(unknown)}")
+        if status is not None and status not in CALL_STATUS_FILTERS:
+            raise ValueError(f"Неизвестный статус: {status}")
+        for key in ('communication_id', 'call_date'):
+            if key not in columns:
+                columns.insert(0, key)
+
+        where = []
+        params = []
+        if status is not None:
+            where.append(CALL_STATUS_FILTERS[status])
+        if is_archived is not None:
+            where.append('is_archived = ?')
+            params.append(1 if is_archived else 0)
+        if phone:
+            where.append('(client_phone = ? OR staff_phone = ?)')
+            params.extend([phone, phone])
+        if direction:
+            where.append('direction = ?')
+            params.append(direction)
+        if employee_id is not None:
+            where.append('employee_id = ?')
+            params.append(employee_id)
+        if min_duration is not None:
+            where.append('duration >= ?')
+            params.append(min_duration)
+        if max_duration is not None:
+            where.append('duration <= ?')
+            params.append(max_duration)
+        if date_from:
+            where.append('call_date >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('call_date <= ?')
+            params.append(date_to)
+        select = ', '.join(f'{CALL_STATUS_SQL} AS status' if c == 'status' else c for c in columns)
+        return self._iter_calls_query(select, columns, where, params, after, limit, chunk_size)
+
+    def iter_call_details(self, table: str, date_from: str = None, date_to: str = None,
+                          chunk_size: int = 5000):
+        """
+        Строки call_metrics или call_analysis для звонков периода (по call_date), порциями
+        в порядке (call_date, communication_id). Каждая строка - dict c call_date звонка.
+        """
+        detail_columns = {
+            'call_metrics': CALL_METRICS_COLUMNS + ('computed_at',),
+            'call_analysis': ('prompt_version', 'transcript_hash') + CALL_ANALYSIS_COLUMNS + ('analyzed_at',),
+        }[table]
+        columns = ['call_date', 'communication_id'] + list(detail_columns)
+        select = 'c.call_date, c.communication_id, ' + ', '.join(f't.{column}' for column in detail_columns)
+        where = []
+        params = []
+        if date_from:
+            where.append('c.call_date >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('c.call_date <= ?')
+            params.append(date_to)
+        return self._iter_calls_query(
+            select, columns, where, params, None, None, chunk_size,
+            join=f'JOIN {table} t ON t.communication_id = c.communication_id'
+        )
+
+    def table_column_types(self, table: str) -> dict:
+        """Объявленные типы колонок таблицы: {имя: тип}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'PRAGMA table_info({table})')
+            return {row[1]: (row[2] or '').upper() for row in cursor.fetchall()}
+
+    def _iter_calls_query(self, select, columns, where, params, after, limit, chunk_size, join=''):
+        # Генератор могут продолжать из разных потоков (StreamingResponse), но не одновременно
+        conn = self.get_connection(check_same_thread=False)
+        parse_metadata = 'metadata' in columns
+        try:
+            while limit is None or limit > 0:
+                page_where = list(where)
+                page_params = list(params)
+                if after:
+                    page_where.append('(c.call_date, c.communication_id) > (?, ?)')
+                    page_params.extend(after)
+                size = chunk_size if limit is None else min(chunk_size, limit)
+                cursor = conn.execute(f'''
+                    SELECT {select} FROM calls c {join}
+                    {'WHERE ' + ' AND '.join(page_where) if page_where else ''}
+                    ORDER BY c.call_date, c.communication_id
+                    LIMIT ?
+                ''', page_params + [size])
+                fetched = 0
+                while True:
+                    rows = cursor.fetchmany(500)
+                    if not rows:
+                        break
+                    fetched += len(rows)
+                    for row in rows:
+                        item = dict(zip(columns, row))
+                        if parse_metadata and item['metadata']:
+                            item['metadata'] = json.loads(item['metadata'])
+                        yield item
+                if fetched < size:
+                    return
+                after = (item['call_date'], item['communication_id'])
+                if limit is not None:
+                    limit -= fetched
+        finally:
+            conn.close()
+
+    def save_call_metrics(self, metrics: list):
+        """
+        Сохранение метрик разговора пачкой (перезаписывает прежние значения)
+        Args:
+            metrics: список словарей с communication_id и колонками CALL_METRICS_COLUMNS
+        """
+        if not metrics:
+            return
+        columns = ('communication_id',) + CALL_METRICS_COLUMNS
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO call_metrics ({", ".join(columns)}, computed_at)
+                VALUES ({", ".join("?" for _ in columns)}, CURRENT_TIMESTAMP)
+            ''', [tuple(m.get(c) for c in columns) for m in metrics])
+            conn.commit()
+
+    def get_call_metrics(self, communication_id: str) -> dict:
+        """Получение метрик разговора по звонку"""
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM call_metrics WHERE communication_id = ?', (communication_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def get_calls_without_metrics(self, limit: int = 100, after_id: str = ''):
+        """
+        Транскрибированные звонки без метрик, по возрастанию communication_id.
+        after_id - последний ID предыдущей пачки (пропущенные из-за ошибок звонки не зацикливают обход)
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.communication_id, c.transcript_path, c.client_audio_path, c.staff_audio_path
+                FROM calls c
+                LEFT JOIN call_metrics m ON m.communication_id = c.communication_id
+                WHERE m.communication_id IS NULL
+                AND c.transcript_path IS NOT NULL AND c.transcript_path != '' AND c.transcript_path != 'NO_WAV'
+                AND c.communication_id > ?
+                ORDER BY c.communication_id
+                LIMIT ?
+            ''', (after_id, limit))
+            return [{
+                'communication_id': row[0],
+                'transcript_path': row[1],
+                'client_audio_path': row[2],
+                'staff_audio_path': row[3]
+            } for row in cursor.fetchall()]
+
+    def get_cached_analysis(self, hashes: list, prompt_version: str) -> dict:
+        """Закэшированные результаты GPT по хэшам транскриптов: {transcript_hash: result}"""
+        if not hashes:
+            return {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT transcript_hash, result FROM gpt_analysis_cache
+                WHERE prompt_version = ? AND transcript_hash IN ({", ".join("?" for _ in hashes)})
+            ''', [prompt_version] + list(hashes))
+            return {row[0]: json.loads(row[1]) for row in cursor.fetchall()}
+
+    def save_call_analysis(self, results: list, prompt_version: str):
+        """
+        Сохранение результатов GPT-анализа пачкой: в кэш и в call_analysis
+        Args:
+            results: словари с communication_id, transcript_hash и колонками CALL_ANALYSIS_COLUMNS
+        """
+        if not results:
+            return
+        columns = ('communication_id', 'prompt_version', 'transcript_hash') + CALL_ANALYSIS_COLUMNS
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO gpt_analysis_cache (transcript_hash, prompt_version, result)
+                VALUES (?, ?, ?)
+            ''', [(
+                r['transcript_hash'],
+                prompt_version,
+                json.dumps({c: r.get(c) for c in CALL_ANALYSIS_COLUMNS}, ensure_ascii=False)
+            ) for r in results])
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO call_analysis ({", ".join(columns)}, analyzed_at)
+                VALUES ({", ".join("?" for _ in columns)}, CURRENT_TIMESTAMP)
+            ''', [
+                (r['communication_id'], prompt_version, r['transcript_hash'])
+                + tuple(r.get(c) for c in CALL_ANALYSIS_COLUMNS)
+                for r in results
+            ])
+            conn.commit()
+
+    def get_call_analysis(self, communication_id: str) -> dict:
+        """Получение результата GPT-анализа по звонку"""
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM call_analysis WHERE communication_id = ?', (communication_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def get_calls_without_analysis(self, prompt_version: str, limit: int = 100, after_id: str = ''):
+        """Транскрибированные звонки без GPT-анализа текущей версии промпта, по возрастанию communication_id"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.communication_id, c.transcript_path
+                FROM calls c
+                LEFT JOIN call_analysis a
+                    ON a.communication_id = c.communication_id AND a.prompt_version = ?
+                WHERE a.communication_id IS NULL
+                AND c.transcript_path IS NOT NULL AND c.transcript_path != '' AND c.transcript_path != 'NO_WAV'
+                AND c.communication_id > ?
+                ORDER BY c.communication_id
+                LIMIT ?
+            ''', (prompt_version, after_id, limit))
+            return [{
+                'communication_id': row[0],
+                'transcript_path': row[1]
+            } for row in cursor.fetchall()]
+
+    def schedule_pending_call(self, communication_id: str, due_at: float, attempts: int = 0,
+                              replace: bool = False):
+        """
+        Планирует повторную проверку звонка в UIS
+        Args:
+            due_at: время проверки (unix time)
+            replace: перезаписать расписание, если звонок уже ожидает проверки
+        Returns:
+            bool: True, если запись добавлена или обновлена
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                INSERT OR {"REPLACE" if replace else "IGNORE"} INTO pending_calls (communication_id, due_at, attempts)
+                VALUES (?, ?, ?)
+            ''', (communication_id, due_at, attempts))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def claim_due_pending_calls(self, now: float, limit: int = 500, hold: float = 300):
+        """
+        Забирает звонки, время проверки которых наступило: [(communication_id, attempts)].
+        due_at забранных звонков сдвигается на hold секунд в той же транзакции, поэтому
+        планировщики нескольких процессов не проверяют один звонок дважды.
+        """
+        conn = self.get_connection()
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT communication_id, attempts FROM pending_calls
+                WHERE due_at <= ?
+                ORDER BY due_at
+                LIMIT ?
+            ''', (now, limit))
+            rows = cursor.fetchall()
+            cursor.executemany(
+                'UPDATE pending_calls SET due_at = ? WHERE communication_id = ?',
+                [(now + hold, row[0]) for row in rows]
+            )
+            cursor.execute('COMMIT')
+            return rows
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def get_next_pending_due(self):
+        """Ближайшее время проверки (unix time) или None, если ожидающих звонков нет"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MIN(due_at) FROM pending_calls')
+            return cursor.fetchone()[0]
+
+    def reschedule_pending_calls(self, schedule: list):
+        """Переносит проверки пачкой: schedule - список (due_at, attempts, communication_id)"""
+        if not schedule:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'UPDATE pending_calls SET due_at = ?, attempts = ? WHERE communication_id = ?',
+                schedule
+            )
+            conn.commit()
+
+    def remove_pending_calls(self, communication_ids: list):
+        """Удаляет звонки из ожидания"""
+        if not communication_ids:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'DELETE FROM pending_calls WHERE communication_id = ?',
+                [(cid,) for cid in communication_ids]
+            )
+            conn.commit()
+
+    def count_pending_calls(self) -> int:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM pending_calls')
+            return cursor.fetchone()[0]
+
+    def acquire_lease(self, communication_id: str, owner: str, ttl: float) -> bool:
+        """
+        Атомарно берет аренду обработки звонка на ttl секунд.
+        Успешно, если аренды нет, она истекла или уже принадлежит owner.
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO call_leases (communication_id, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(communication_id) DO UPDATE
+                SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE call_leases.expires_at < ? OR call_leases.owner = excluded.owner
+            ''', (communication_id, owner, now + ttl, now))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def renew_lease(self, communication_id: str, owner: str, ttl: float) -> bool:
+        """Продлевает аренду (heartbeat). False, если аренда уже не принадлежит owner."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE call_leases SET expires_at = ?
+                WHERE communication_id = ? AND owner = ?
+            ''', (time.time() + ttl, communication_id, owner))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def release_lease(self, communication_id: str, owner: str):
+        """Освобождает аренду, если она принадлежит owner"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'DELETE FROM call_leases WHERE communication_id = ? AND owner = ?',
+                (communication_id, owner)
+            )
+            conn.commit()
+
+    def get_lease(self, communication_id: str):
+        """Текущая аренда звонка: (owner, expires_at) или None"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT owner, expires_at FROM call_leases WHERE communication_id = ?',
+                (communication_id,)
+            )
+            return cursor.fetchone()
+
+    def enqueue_call(self, communication_id: str, call_data: dict = None, lane: str = 'live',
+                     priority: float = None) -> bool:
+        """
+        Ставит звонок в очередь обработки. Звонок, который уже обрабатывается, не дублируется;
+        завершенный или упавший - ставится заново. Ожидающий звонок только поднимается
+        в приоритете (например, backfill-звонок, по которому пришел webhook).
+        Args:
+            lane: полоса приоритета (live, backfill)
+            priority: ключ порядка выдачи, меньше - раньше (по умолчанию время постановки)
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO call_queue (communication_id, call_data, state, enqueued_at, updated_at, lane, priority)
+                VALUES (?, ?, 'queued', ?, ?, ?, ?)
+                ON CONFLICT(communication_id) DO UPDATE
+                SET call_data = COALESCE(excluded.call_data, call_queue.call_data),
+                    claimed_by = NULL, lease_expires = NULL,
+                    attempts = CASE WHEN call_queue.state = 'queued' THEN call_queue.attempts ELSE 0 END,
+                    enqueued_at = CASE WHEN call_queue.state = 'queued'
+                                       THEN call_queue.enqueued_at ELSE excluded.enqueued_at END,
+                    state = 'queued', updated_at = excluded.updated_at,
+                    lane = excluded.lane, priority = excluded.priority
+                WHERE call_queue.state IN ('done', 'failed')
+                   OR (call_queue.state = 'queued' AND excluded.priority < call_queue.priority)
+            ''', (communication_id, json.dumps(call_data) if call_data else None, now, now,
+                  lane, now if priority is None else priority))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def claim_calls(self, owner: str, ttl: float, limit: int = 1, max_attempts: int = 3,
+                    other_lanes_limit: int = None):
+        """
+        Атомарно забирает звонки из очереди в порядке приоритета: ожидающие и те,
+        чья аренда истекла (воркер упал).
+        other_lanes_limit - сколько из них может быть не из полосы live (None - без ограничения):
+        так воркер держит слоты для live-звонков, пока backfill занимает остальные.
+        Returns:
+            list: [(communication_id, call_data, lane)]
+        """
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Зависшие звонки, исчерпавшие попытки, больше не выдаем
+            cursor.execute('''
+                UPDATE call_queue SET state = 'failed', claimed_by = NULL, updated_at = ?
+                WHERE state = 'running' AND lease_expires < ? AND attempts >= ?
+            ''', (now, now, max_attempts))
+            claimable = "(state = 'queued' OR (state = 'running' AND lease_expires < ?))"
+            if other_lanes_limit is None:
+                cursor.execute(f'''
+                    SELECT communication_id, call_data, lane FROM call_queue
+                    WHERE {claimable}
+                    ORDER BY priority
+                    LIMIT ?
+                ''', (now, limit))
+                rows = cursor.fetchall()
+            else:
+                # Лучшие по приоритету live и не-live (в пределах квоты), затем общий порядок
+                candidates = []
+                for lane_filter, lane_limit in (("lane = 'live'", limit),
+                                                ("lane != 'live'", min(limit, other_lanes_limit))):
+                    if lane_limit <= 0:
+                        continue
+                    cursor.execute(f'''
+                        SELECT communication_id, call_data, lane, priority FROM call_queue
+                        WHERE {claimable} AND {lane_filter}
+                        ORDER BY priority
+                        LIMIT ?
+                    ''', (now, lane_limit))
+                    candidates += cursor.fetchall()
+                rows = [row[:3] for row in sorted(candidates, key=lambda row: row[3])[:limit]]
+            cursor.executemany('''
+                UPDATE call_queue
+                SET state = 'running', claimed_by = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+                WHERE communication_id = ?
+            ''', [(owner, now + ttl, now, row[0]) for row in rows])
+            cursor.execute('COMMIT')
+            return [(row[0], json.loads(row[1]) if row[1] else None, row[2]) for row in rows]
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat_claims(self, owner: str, communication_ids: list, ttl: float):
+        """Продлевает аренду забранных воркером звонков"""
+        if not communication_ids:
+            return
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE call_queue SET lease_expires = ?, updated_at = ?
+                WHERE communication_id = ? AND claimed_by = ? AND state = 'running'
+            ''', [(now + ttl, now, cid, owner) for cid in communication_ids])
+            conn.commit()
+
+    def complete_claim(self, communication_id: str, owner: str, state: str = 'done'):
+        """Завершает обработку звонка из очереди (state: done, failed или queued для повтора)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE call_queue SET state = ?, claimed_by = NULL, lease_expires = NULL, updated_at = ?
+                WHERE communication_id = ? AND claimed_by = ?
+            ''', (state, time.time(), communication_id, owner))
+            conn.commit()
+
+    def get_queue_stats(self) -> dict:
+        """Количество звонков в очереди по состояниям, просроченные аренды и глубина/ожидание по полосам"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT state, COUNT(*) FROM call_queue GROUP BY state')
+            stats = {state: 0 for state in QUEUE_STATES}
+            stats.update(dict(cursor.fetchall()))
+            cursor.execute(
+                "SELECT COUNT(*) FROM call_queue WHERE state = 'running' AND lease_expires < ?",
+                (time.time(),)
+            )
+            stats['expired_leases'] = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT lane, COUNT(*), MIN(enqueued_at) FROM call_queue
+                WHERE state = 'queued'
+                GROUP BY lane
+            ''')
+            now = time.time()
+            stats['lanes'] = {
+                lane: {'queued': count, 'max_wait': round(now - oldest, 1)}
+                for lane, count, oldest in cursor.fetchall()
+            }
+            return stats
+
+    def register_audio_file(self, path: str, communication_id: str, size: int, lease_until: float = None):
+        """Файл в горячем уровне (новый или скачанный заново). Возвращает прежний cold_path или None."""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT cold_path FROM audio_files WHERE path = ?', (path,))
+            row = cursor.fetchone()
+            cursor.execute('''
+                INSERT INTO audio_files (path, communication_id, tier, size, last_access, lease_until)
+                VALUES (?, ?, 'hot', ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE
+                SET tier = 'hot', size = excluded.size, cold_path = NULL, cold_size = NULL,
+                    communication_id = COALESCE(excluded.communication_id, audio_files.communication_id),
+                    last_access = excluded.last_access, lease_until = excluded.lease_until
+            ''', (path, communication_id, size, now, lease_until))
+            conn.commit()
+            return row[0] if row else None
+
+    def register_untracked_audio_files(self, files: list):
+        """Учитывает уже лежащие на диске файлы: files - список (path, size, mtime)"""
+        if not files:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR IGNORE INTO audio_files (path, tier, size, last_access) VALUES (?, 'hot', ?, ?)
+            ''', files)
+            conn.commit()
+
+    def get_audio_file(self, path: str) -> dict:
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM audio_files WHERE path = ?', (path,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def touch_audio_files(self, paths: list, lease_until: float = None):
+        """Отмечает обращение к файлам (LRU) и задает аренду (None - снять)"""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'UPDATE audio_files SET last_access = ?, lease_until = ? WHERE path = ?',
+                [(now, lease_until, path) for path in paths]
+            )
+            conn.commit()
+
+    def claim_audio_move(self, path: str, from_tier: str, ignore_lease: bool = False) -> bool:
+        """
+        Атомарно переводит файл из from_tier в moving. Горячий файл с действующей
+        арендой не забирается, если не задан ignore_lease.
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                UPDATE audio_files SET tier = 'moving', moving_since = ?
+                WHERE path = ? AND tier = ?
+                {'' if ignore_lease else 'AND (lease_until IS NULL OR lease_until < ?)'}
+            ''', (now, path, from_tier) if ignore_lease else (now, path, from_tier, now))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def finish_audio_move(self, path: str, tier: str, cold_path: str = None, cold_size: int = None,
+                          size: int = None, lease_until: float = None):
+        """Завершает перенос файла (или откатывает его в прежний уровень при ошибке)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE audio_files
+                SET tier = ?, cold_path = COALESCE(?, cold_path), cold_size = COALESCE(?, cold_size),
+                    size = COALESCE(?, size), last_access = ?, lease_until = ?, moving_since = NULL
+                WHERE path = ? AND tier = 'moving'
+            ''', (tier, cold_path, cold_size, size, time.time(), lease_until, path))
+            conn.commit()
+
+    def get_stale_audio_moves(self, started_before: float) -> list:
+        """Переносы, начатые раньше started_before (или без отметки начала), - процесс упал посреди переноса"""
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM audio_files
+                WHERE tier = 'moving' AND (moving_since IS NULL OR moving_since < ?)
+            ''', (started_before,))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def repair_audio_move(self, path: str, started_before: float, tier: str = None, size: int = None,
+                          cold_path: str = None, cold_size: int = None) -> bool:
+        """
+        Возвращает зависший перенос в tier по состоянию файлов на диске; tier=None - удалить запись
+        (файла нет ни в одном уровне). Запись меняется, только если перенос все еще зависший.
+        """
+        stale = "path = ? AND tier = 'moving' AND (moving_since IS NULL OR moving_since < ?)"
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if tier is None:
+                cursor.execute(f'DELETE FROM audio_files WHERE {stale}', (path, started_before))
+            else:
+                cursor.execute(f'''
+                    UPDATE audio_files
+                    SET tier = ?, size = COALESCE(?, size), cold_path = COALESCE(?, cold_path),
+                        cold_size = COALESCE(?, cold_size), last_access = ?, lease_until = NULL,
+                        moving_since = NULL
+                    WHERE {stale}
+                ''', (tier, size, cold_path, cold_size, time.time(), path, started_before))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def get_lru_hot_audio(self, limit: int = 100, accessed_before: float = None):
+        """Горячие файлы без аренды, от давно не использованных: [(path, size)]"""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT path, size FROM audio_files
+                WHERE tier = 'hot' AND (lease_until IS NULL OR lease_until < ?) AND last_access < ?
+                ORDER BY last_access
+                LIMIT ?
+            ''', (now, now if accessed_before is None else accessed_before, limit))
+            return cursor.fetchall()
+
+    def get_audio_usage(self) -> dict:
+        """Число файлов и байты по уровням хранения"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT tier, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(cold_size), 0)
+                FROM audio_files GROUP BY tier
+            ''')
+            usage = {tier: {'files': 0, 'bytes': 0} for tier in AUDIO_TIERS}
+            for tier, files, size, cold_size in cursor.fetchall():
+                usage[tier] = {'files': files, 'bytes': cold_size if tier == 'cold' else size}
+            return usage
+
+    def get_export_day_versions(self, day_from: str, day_to: str) -> dict:
+        """Версии данных дней периода: {YYYY-MM-DD: version}; дней без изменений в словаре нет"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT day, version FROM export_days WHERE day BETWEEN ? AND ?', (day_from, day_to)
+            )
+            return dict(cursor.fetchall())
+
+    def get_export_cache(self, kind: str, day_from: str, day_to: str) -> dict:
+        """Закэшированные части выгрузки за период: {day: {version, path, size, files}}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT day, version, path, size, files FROM export_cache
+                WHERE kind = ? AND day BETWEEN ? AND ?
+            ''', (kind, day_from, day_to))
+            return {
+                row[0]: {'version': row[1], 'path': row[2], 'size': row[3], 'files': json.loads(row[4] or '{}')}
+                for row in cursor.fetchall()
+            }
+
+    def put_export_cache(self, kind: str, day: str, version: int, path: str, size: int, files: dict):
+        """Сохраняет часть выгрузки дня. Возвращает путь вытесненной прежней части или None."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT path FROM export_cache WHERE kind = ? AND day = ?', (kind, day))
+            row = cursor.fetchone()
+            cursor.execute('''
+                INSERT INTO export_cache (kind, day, version, path, size, files, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(kind, day) DO UPDATE
+                SET version = excluded.version, path = excluded.path, size = excluded.size,
+                    files = excluded.files, last_access = excluded.last_access
+            ''', (kind, day, version, path, size, json.dumps(files), time.time()))
+            conn.commit()
+            return row[0] if row and row[0] != path else None
+
+    def touch_export_cache(self, kind: str, days: list):
+        """Отмечает использование частей выгрузки (LRU)"""
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'UPDATE export_cache SET last_access = ? WHERE kind = ? AND day = ?',
+                [(now, kind, day) for day in days]
+            )
+            conn.commit()
+
+    def get_export_cache_size(self) -> tuple:
+        """Число частей в кэше выгрузок и их суммарный размер в байтах"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM export_cache')
+            return cursor.fetchone()
+
+    def get_lru_export_cache(self, limit: int = 100) -> list:
+        """Части выгрузки от давно не использованных: [(kind, day, path, size)]"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT kind, day, path, size FROM export_cache ORDER BY last_access LIMIT ?', (limit,)
+            )
+            return cursor.fetchall()
+
+    def delete_export_cache(self, kind: str, day: str, path: str) -> bool:
+        """Удаляет запись о части, если ее не успели заменить новой"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'DELETE FROM export_cache WHERE kind = ? AND day = ? AND path = ?', (kind, day, path)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def get_sync_state(self, name: str):
+        """Значение состояния синхронизации или None"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM sync_state WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def advance_sync_state(self, name: str, value: str) -> bool:
+        """
+        Сдвигает high-watermark вперед. Меньшее значение не записывается,
+        поэтому несколько процессов не откатывают отметку друг друга.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO sync_state (name, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(name) DO UPDATE
+                SET value = excluded.value, updated_at = excluded.updated_at
+                WHERE excluded.value > sync_state.value
+            ''', (name, value))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def find_untracked_calls(self, communication_ids: list) -> set:
+        """
+        Звонки из списка, о которых пайплайн не знает: не обработаны (нет transcript_path),
+        не стоят в call_queue, не ожидают повторной проверки и не обрабатываются по аренде.
+        Сравнение выполняется одним запросом через временную таблицу.
+        """
+        if not communication_ids:
+            return set()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('CREATE TEMP TABLE report_ids (communication_id TEXT PRIMARY KEY)')
+            cursor.executemany(
+                'INSERT OR IGNORE INTO report_ids (communication_id) VALUES (?)',
+                [(str(cid),) for cid in communication_ids]
+            )
+            cursor.execute('''
+                SELECT r.communication_id FROM report_ids r
+                LEFT JOIN calls c ON c.communication_id = r.communication_id
+                LEFT JOIN call_queue q ON q.communication_id = r.communication_id
+                LEFT JOIN pending_calls p ON p.communication_id = r.communication_id
+                LEFT JOIN call_leases l ON l.communication_id = r.communication_id AND l.expires_at >= ?
+                WHERE c.transcript_path IS NULL
+                  AND q.communication_id IS NULL
+                  AND p.communication_id IS NULL
+                  AND l.communication_id IS NULL
+            ''', (time.time(),))
+            return {row[0] for row in cursor.fetchall()}
+
 # Создаем экземпляр базы данных
-db = Database() 
\ No newline at end of file
+db = Database()
+
+if __name__ == "__main__":
+    # python database.py backfill [batch_size] - заполнение полей звонков из metadata
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill':
+        updated = db.backfill_call_fields(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+        logger.info(f"Call fields backfill finished, updated: {updated}")
+    else:
+        print("Использование: python database.py backfill [batch_size]") 
\ No newline at end of file
@@ -0,0 +1,221 @@
+"""
+Колоночная выгрузка для аналитиков: звонки, реплики диалогов, метрики разговора и GPT-анализ
+в Parquet (zstd) или Arrow IPC - по файлу на таблицу (архив по дням собирает export_cache).
+
+Данные читаются из SQLite порциями (Database.iter_calls / iter_call_details) и пишутся
+группами строк по EXPORT_BATCH_ROWS, поэтому память не зависит от размера периода.
+"""
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from transcribe_calls import merge_transcripts
+
+logger = logging.getLogger(__name__)
+
+# Строк в одной группе Parquet / пакете Arrow
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 50000))
+EXPORT_FORMATS = ('parquet', 'arrow')
+
+# Объявленный тип колонки SQLite -> тип Arrow
+SQLITE_ARROW_TYPES = {
+    'INTEGER': 'int64',
+    'REAL': 'float64',
+    'TEXT': 'string',
+    'TIMESTAMP': 'timestamp',
+}
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _arrow_type(name):
+    return pa.timestamp('us') if name == 'timestamp' else pa.type_for_alias(name)
+
+
+def calls_schema():
+    return pa.schema([
+        pa.field('communication_id', pa.string()),
+        pa.field('call_date', pa.timestamp('us')),
+        pa.field('client_phone', pa.string()),
+        pa.field('staff_phone', pa.string()),
+        pa.field('duration', pa.int32()),
+        pa.field('direction', pa.string()),
+        pa.field('employee_id', pa.int64()),
+        pa.field('status', pa.string()),
+        pa.field('transcript_path', pa.string()),
+        pa.field('is_archived', pa.bool_()),
+        pa.field('created_at', pa.timestamp('us')),
+    ])
+
+
+def segments_schema():
+    return pa.schema([
+        pa.field('communication_id', pa.string()),
+        pa.field('call_date', pa.timestamp('us')),
+        pa.field('turn', pa.int32()),
+        pa.field('speaker', pa.string()),
+        pa.field('start', pa.float32()),
+        pa.field('end', pa.float32()),
+        pa.field('overlap', pa.bool_()),
+        pa.field('text', pa.string()),
+    ])
+
+
+def details_schema(database, table, columns):
+    """Схема call_metrics / call_analysis по объявленным типам колонок SQLite"""
+    declared = database.table_column_types(table)
+    fields = [pa.field('communication_id', pa.string()), pa.field('call_date', pa.timestamp('us'))]
+    for column in columns:
+        if column in ('call_date', 'communication_id'):
+            continue
+        fields.append(pa.field(column, _arrow_type(SQLITE_ARROW_TYPES.get(declared.get(column), 'string'))))
+    return pa.schema(fields)
+
+
+class TableWriter:
+    """Запись строк (dict) в Parquet или Arrow IPC группами по batch_rows"""
+
+    def __init__(self, path, schema, fmt, batch_rows=EXPORT_BATCH_ROWS):
+        self.path = path
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._buffer = []
+        self._timestamps = [f.name for f in schema if pa.types.is_timestamp(f.type)]
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(path, schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_file(
+                path, schema, options=pa.ipc.IpcWriteOptions(compression='zstd')
+            )
+
+    def write(self, row):
+        for name in self._timestamps:
+            row[name] = _parse_timestamp(row.get(name))
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._writer.write_batch(pa.RecordBatch.from_pylist(self._buffer, schema=self.schema))
+            self.rows += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def _load_transcript(folder, name):
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def call_turns(call):
+    """Реплики диалога звонка из client_transcript.json и staff_transcript.json"""
+    folder = call.get('transcript_path')
+    if not folder or not os.path.isdir(folder):
+        return
+    client = _load_transcript(folder, 'client_transcript.json')
+    staff = _load_transcript(folder, 'staff_transcript.json')
+    if client is None and staff is None:
+        return
+    for index, turn in enumerate(merge_transcripts(client or {}, staff or {})):
+        yield {
+            'communication_id': call['communication_id'],
+            'call_date': call['call_date'],
+            'turn': index,
+            'speaker': turn.speaker,
+            'start': turn.start,
+            'end': turn.end,
+            'overlap': turn.overlap,
+            'text': turn.text,
+        }
+
+
+def export_tables(database, date_from, date_to, output_dir, fmt='parquet'):
+    """
+    Пишет calls, segments, metrics и analysis за период в output_dir.
+    Returns:
+        dict: {имя файла: число строк}
+    """
+    if pa is None:
+        raise RuntimeError("Для колоночной выгрузки нужен пакет pyarrow")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    ext = 'parquet' if fmt == 'parquet' else 'arrow'
+    result = {}
+
+    calls_writer = TableWriter(os.path.join(output_dir, f'calls.{ext}'), calls_schema(), fmt)
+    segments_writer = TableWriter(os.path.join(output_dir, f'segments.{ext}'), segments_schema(), fmt)
+    try:
+        for call in database.iter_calls(columns=calls_schema().names, date_from=date_from, date_to=date_to):
+            if call['status'] == 'processed':
+                try:
+                    for turn in call_turns(call):
+                        segments_writer.write(turn)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Could not export transcript of call {call['communication_id']}: {e}")
+            call['is_archived'] = bool(call['is_archived'])
+            calls_writer.write(call)
+    finally:
+        calls_writer.close()
+        segments_writer.close()
+    result[os.path.basename(calls_writer.path)] = calls_writer.rows
+    result[os.path.basename(segments_writer.path)] = segments_writer.rows
+
+    for table, name in (('call_metrics', 'metrics'), ('call_analysis', 'analysis')):
+        rows = database.iter_call_details(table, date_from, date_to)
+        writer = None
+        try:
+            for row in rows:
+                if writer is None:
+                    schema = details_schema(database, table, list(row))
+                    writer = TableWriter(os.path.join(output_dir, f'{name}.{ext}'), schema, fmt)
+                writer.write(row)
+        finally:
+            if writer:
+                writer.close()
+                result[os.path.basename(writer.path)] = writer.rows
+    return result
+
+
+def day_bounds(date_from, date_to):
+    """Границы периода для call_date: дата без времени в date_to включает весь день"""
+    if len(date_to) == 10:
+        date_to += ' 23:59:59.999999'
+    return date_from, date_to
+
+
+if __name__ == "__main__":
+    # python columnar_export.py 2024-01-01 2024-01-31 [parquet|arrow] [output_dir]
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    from database import db
+
+    fmt = sys.argv[3] if len(sys.argv) > 3 else 'parquet'
+    output_dir = sys.argv[4] if len(sys.argv) > 4 else '.'
+    os.makedirs(output_dir, exist_ok=True)
+    print(export_tables(db, *day_bounds(sys.argv[1], sys.argv[2]), output_dir, fmt))
@@ -0,0 +1,165 @@
+"""
+Кэш колоночных выгрузок по дням.
+
+Выгрузка периода собирается из частей по одному дню (export_tables за день). Часть хранится
+в EXPORT_CACHE_DIR вместе с версией дня из таблицы export_days: триггеры БД увеличивают версию
+при изменении звонков дня, их метрик и анализа. Пока версия дня не изменилась, часть используется
+повторно, поэтому повторные и пересекающиеся выгрузки пересобирают только измененные дни.
+Общий объем кэша ограничен EXPORT_CACHE_MB, вытесняются давно не использованные части.
+
+В архиве таблицы разбиты по дням в формате hive (calls/day=2024-01-01/part-0.parquet):
+pyarrow.dataset и pandas.read_parquet читают каталог таблицы как одну таблицу с колонкой day.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+from columnar_export import EXPORT_FORMATS, day_bounds, export_tables
+
+logger = logging.getLogger(__name__)
+
+# Каталог частей выгрузок и его предельный объем, МБ
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', 'export_cache')
+EXPORT_CACHE_BUDGET = int(float(os.environ.get('EXPORT_CACHE_MB', 1024)) * 1024 * 1024)
+# Самый длинный период одной выгрузки, дней
+EXPORT_MAX_DAYS = int(os.environ.get('EXPORT_MAX_DAYS', 366))
+# Версия содержимого частей: увеличить при изменении схем export_tables, старые части не будут использоваться
+EXPORT_CACHE_LAYOUT = 2
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def export_days(date_from, date_to):
+    """Дни периода (YYYY-MM-DD, включительно). ValueError при неверных датах."""
+    start = datetime.strptime(date_from, DAY_FORMAT).date()
+    end = datetime.strptime(date_to, DAY_FORMAT).date()
+    if end < start:
+        raise ValueError("date_to раньше date_from")
+    if (end - start).days >= EXPORT_MAX_DAYS:
+        raise ValueError(f"Период выгрузки больше {EXPORT_MAX_DAYS} дней")
+    return [(start + timedelta(days=i)).strftime(DAY_FORMAT) for i in range((end - start).days + 1)]
+
+
+class ExportCache:
+    def __init__(self, database, cache_dir=EXPORT_CACHE_DIR, budget=EXPORT_CACHE_BUDGET):
+        self.database = database
+        self.cache_dir = cache_dir
+        self.budget = budget
+        # Сборка частей в процессе последовательная: одновременные выгрузки одного периода
+        # не собирают одни и те же дни дважды
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def export(self, date_from, date_to, fmt='parquet', export_dir=None):
+        """
+        Собирает выгрузку за период в zip из частей по дням.
+        Returns:
+            str: путь к архиву (во временном каталоге, который удаляет вызывающий)
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        days = export_days(date_from, date_to)
+        kind = f'{fmt}.v{EXPORT_CACHE_LAYOUT}'
+        with self._lock:
+            parts, built = self._parts(kind, fmt, days)
+
+        work_dir = tempfile.mkdtemp(prefix='columnar_export_', dir=export_dir)
+        archive_path = os.path.join(work_dir, f'analysis_export.{fmt}.zip')
+        try:
+            with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for day in days:
+                    try:
+                        self._add_part(archive, day, parts[day])
+                    except FileNotFoundError:
+                        # Часть вытеснил или заменил другой процесс - собираем день заново
+                        with self._lock:
+                            part = self._build(kind, fmt, day)
+                        self._add_part(archive, day, part)
+        except Exception:
+            shutil.rmtree(work_dir, True)
+            raise
+        self.database.touch_export_cache(kind, days)
+        self.enforce_budget()
+        logger.info(f"Columnar export {date_from} - {date_to} ({fmt}): {len(days)} days, {built} rebuilt")
+        return archive_path
+
+    def _parts(self, kind, fmt, days):
+        """Части дней периода: из кэша, если версия дня не изменилась, иначе собранные заново"""
+        versions = self.database.get_export_day_versions(days[0], days[-1])
+        cached = self.database.get_export_cache(kind, days[0], days[-1])
+        parts = {}
+        built = 0
+        for day in days:
+            version = versions.get(day, 0)
+            part = cached.get(day)
+            if part and part['version'] == version and os.path.isdir(part['path']):
+                self.hits += 1
+                parts[day] = part
+            else:
+                parts[day] = self._build(kind, fmt, day, version)
+                built += 1
+        return parts, built
+
+    def _build(self, kind, fmt, day, version=None):
+        """Выгружает день в новый каталог кэша и заменяет им прежнюю часть"""
+        # Версию читаем до выгрузки: изменения во время выгрузки пересоберут день в следующий раз
+        if version is None:
+            version = self.database.get_export_day_versions(day, day).get(day, 0)
+        kind_dir = os.path.join(self.cache_dir, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f'{day}.', dir=kind_dir)
+        try:
+            counts = export_tables(self.database, *day_bounds(day, day), path, fmt)
+        except Exception:
+            shutil.rmtree(path, True)
+            raise
+        files = {}
+        size = 0
+        for name, rows in counts.items():
+            file_path = os.path.join(path, name)
+            if rows:
+                files[name] = rows
+                size += os.path.getsize(file_path)
+            else:
+                os.remove(file_path)
+        old_path = self.database.put_export_cache(kind, day, version, path, size, files)
+        if old_path:
+            shutil.rmtree(old_path, True)
+        self.builds += 1
+        return {'version': version, 'path': path, 'size': size, 'files': files}
+
+    def _add_part(self, archive, day, part):
+        # Сначала открываем все файлы части: если части уже нет, в архив ничего не попадет
+        with ExitStack() as stack:
+            sources = {
+                name: stack.enter_context(open(os.path.join(part['path'], name), 'rb'))
+                for name in part['files']
+            }
+            for name, source in sources.items():
+                table, ext = os.path.splitext(name)
+                with archive.open(f'{table}/day={day}/part-0{ext}', 'w', force_zip64=True) as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+
+    def enforce_budget(self):
+        """Удаляет давно не использованные части, пока кэш больше бюджета"""
+        _, size = self.database.get_export_cache_size()
+        while size > self.budget:
+            removed = False
+            for kind, day, path, part_size in self.database.get_lru_export_cache():
+                if size <= self.budget:
+                    break
+                if self.database.delete_export_cache(kind, day, path):
+                    shutil.rmtree(path, True)
+                    size -= part_size
+                    removed = True
+            if not removed:
+                return
+
+    def stats(self):
+        parts, size = self.database.get_export_cache_size()
+        return {'parts': parts, 'bytes': size, 'budget': self.budget, 'hits': self.hits, 'builds': self.builds}
@@ -0,0 +1,360 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limiter import get_limiter
+from transcribe_calls import OPENAI_API_KEY, create_session
+
+logger = logging.getLogger(__name__)
+
+OPENAI_CHAT_URL = os.environ.get('OPENAI_CHAT_URL', 'https://api.openai.com/v1/chat/completions')
+GPT_MODEL = os.environ.get('GPT_MODEL', 'gpt-4o-mini')
+
+# При изменении промпта или схемы ответа версию нужно поднять - иначе ответы возьмутся из кэша
+PROMPT_VERSION = 'v1'
+
+# Бюджет входных токенов на один запрос и максимум диалогов в запросе
+GPT_TOKEN_BUDGET = int(os.environ.get('GPT_TOKEN_BUDGET', 6000))
+GPT_MAX_DIALOGS_PER_REQUEST = int(os.environ.get('GPT_MAX_DIALOGS_PER_REQUEST', 8))
+# Максимум одновременных запросов к OpenAI
+GPT_CONCURRENCY = int(os.environ.get('GPT_CONCURRENCY', 4))
+# Сколько ждать, добирая пачку из очереди, секунды
+GPT_BATCH_WAIT = float(os.environ.get('GPT_BATCH_WAIT', 2.0))
+# Попыток анализа звонка, если OpenAI не ответил по нему или не удалось прочитать кэш, и пауза перед повтором
+GPT_MAX_ATTEMPTS = int(os.environ.get('GPT_MAX_ATTEMPTS', 3))
+GPT_RETRY_DELAY = float(os.environ.get('GPT_RETRY_DELAY', 30))
+
+SYSTEM_PROMPT = """Ты анализируешь телефонные разговоры клиента и сотрудника отдела продаж.
+Тебе передается JSON-массив объектов {"id": ..., "dialog": ...}.
+Для каждого диалога верни оценки в JSON вида:
+{"results": [{"id": "<id>", "quality_score": 0-10, "politeness": 0-10,
+"needs_identified": 0-10, "objection_handling": 0-10,
+"outcome": "sale" | "callback" | "refusal" | "info" | "other",
+"summary": "<краткое резюме, до 2 предложений>"}]}
+Верни результат для каждого id, без пояснений вне JSON."""
+
+# Служебные токены промпта и ответа на один диалог
+PROMPT_OVERHEAD_TOKENS = 250
+PER_DIALOG_OVERHEAD_TOKENS = 80
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов для русского текста (~3 символа на токен)"""
+    return len(text) // 3 + 1
+
+
+def transcript_hash(dialog_text):
+    return hashlib.sha256(dialog_text.encode('utf-8')).hexdigest()
+
+
+def load_dialog(transcript_path):
+    """Текст dialog.txt из папки транскрипции или None"""
+    if not transcript_path:
+        return None
+    path = os.path.join(transcript_path, 'dialog.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def make_item(call):
+    """Элемент очереди анализа из строки БД (communication_id, transcript_path) или None"""
+    dialog = load_dialog(call.get('transcript_path'))
+    if not dialog or not dialog.strip():
+        return None
+    budget_chars = (GPT_TOKEN_BUDGET - PROMPT_OVERHEAD_TOKENS - PER_DIALOG_OVERHEAD_TOKENS) * 3
+    return {
+        'communication_id': str(call['communication_id']),
+        'transcript_hash': transcript_hash(dialog),
+        # Слишком длинный диалог обрезаем, чтобы он поместился в один запрос
+        'dialog': dialog[:budget_chars],
+        'tokens': estimate_tokens(dialog[:budget_chars]) + PER_DIALOG_OVERHEAD_TOKENS
+    }
+
+
+def pack_batches(items, token_budget=GPT_TOKEN_BUDGET, max_dialogs=GPT_MAX_DIALOGS_PER_REQUEST):
+    """Жадная упаковка диалогов в запросы в пределах бюджета токенов, с сохранением порядка"""
+    batches = []
+    current = []
+    used = PROMPT_OVERHEAD_TOKENS
+    for item in items:
+        if current and (used + item['tokens'] > token_budget or len(current) >= max_dialogs):
+            batches.append(current)
+            current = []
+            used = PROMPT_OVERHEAD_TOKENS
+        current.append(item)
+        used += item['tokens']
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _clamp_score(value):
+    try:
+        return max(0, min(10, int(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def request_analysis(batch):
+    """
+    Синхронный запрос к Chat Completions для пачки диалогов.
+    Returns:
+        list: результаты для Database.save_call_analysis (диалоги без ответа пропускаются)
+    """
+    session = create_session()
+    payload = {
+        'model': GPT_MODEL,
+        'temperature': 0,
+        'response_format': {'type': 'json_object'},
+        'messages': [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': json.dumps(
+                [{'id': item['communication_id'], 'dialog': item['dialog']} for item in batch],
+                ensure_ascii=False
+            )}
+        ]
+    }
+    response = get_limiter('openai').request(
+        session.post,
+        OPENAI_CHAT_URL,
+        headers={'Authorization': f'Bearer {OPENAI_API_KEY}'},
+        json=payload,
+        timeout=120
+    )
+    if response.status_code != 200:
+        logger.error(f"GPT analysis error: {response.status_code} {response.text[:500]}")
+        return []
+
+    try:
+        content = response.json()['choices'][0]['message']['content']
+        answers = {str(r.get('id')): r for r in json.loads(content).get('results', [])}
+    except (KeyError, IndexError, ValueError, AttributeError) as e:
+        logger.error(f"Could not parse GPT analysis response: {e}")
+        return []
+
+    results = []
+    for item in batch:
+        answer = answers.get(item['communication_id'])
+        if not answer:
+            logger.warning(f"No GPT analysis result for call {item['communication_id']}")
+            continue
+        results.append({
+            'communication_id': item['communication_id'],
+            'transcript_hash': item['transcript_hash'],
+            'quality_score': _clamp_score(answer.get('quality_score')),
+            'politeness': _clamp_score(answer.get('politeness')),
+            'needs_identified': _clamp_score(answer.get('needs_identified')),
+            'objection_handling': _clamp_score(answer.get('objection_handling')),
+            'outcome': answer.get('outcome'),
+            'summary': answer.get('summary'),
+        })
+    return results
+
+
+def missing_ids(batch, results):
+    """communication_id диалогов пачки, по которым нет результата"""
+    answered = {result['communication_id'] for result in results}
+    return [item['communication_id'] for item in batch if item['communication_id'] not in answered]
+
+
+def split_cached(items, database):
+    """Разделяет элементы на закэшированные (готовые результаты) и требующие запроса"""
+    cached = database.get_cached_analysis([item['transcript_hash'] for item in items], PROMPT_VERSION)
+    hits = []
+    misses = []
+    for item in items:
+        result = cached.get(item['transcript_hash'])
+        if result is not None:
+            hits.append(dict(result, communication_id=item['communication_id'],
+                             transcript_hash=item['transcript_hash']))
+        else:
+            misses.append(item)
+    return hits, misses
+
+
+class AnalysisQueue:
+    """
+    Очередь GPT-анализа внутри сервера: собирает диалоги в пачки по бюджету токенов,
+    отправляет их не более чем в GPT_CONCURRENCY параллельных запросов
+    и пишет результаты в БД. Повторный анализ того же диалога берется из кэша.
+
+    Запросы к OpenAI идут в собственном пуле потоков, чтение dialog.txt и работа с БД - в отдельном,
+    поэтому долгие запросы не задерживают ни постановку в очередь, ни сохранение результатов.
+    Звонки, по которым ответа нет, повторяются до GPT_MAX_ATTEMPTS раз.
+    """
+
+    def __init__(self, database, concurrency=GPT_CONCURRENCY, batch_wait=GPT_BATCH_WAIT,
+                 max_attempts=GPT_MAX_ATTEMPTS, retry_delay=GPT_RETRY_DELAY):
+        self.database = database
+        self.batch_wait = batch_wait
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='gpt')
+        self.io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='gpt-io')
+        self._task = None
+        self._inflight = set()
+        self._retries = set()
+        self.requeued = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for handle in self._retries:
+            handle.cancel()
+        self._retries.clear()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=False)
+
+    def enqueue(self, communication_id, transcript_path, attempts=0):
+        """Ставит звонок в очередь анализа без ожидания (dialog.txt читает обработчик очереди)"""
+        self.queue.put_nowait({
+            'communication_id': str(communication_id),
+            'transcript_path': transcript_path,
+            'attempts': attempts,
+        })
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'inflight_requests': len(self._inflight),
+            'retry_pending': len(self._retries),
+            'requeued': self.requeued,
+            'dropped': self.dropped,
+        }
+
+    async def _collect(self):
+        """Ждет первый звонок и добирает очередь до предела пачек или таймаута"""
+        entries = [await self.queue.get()]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.batch_wait
+        while len(entries) < GPT_MAX_DIALOGS_PER_REQUEST * GPT_CONCURRENCY:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entries.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return entries
+
+    @staticmethod
+    def _make_items(entries):
+        items = []
+        for entry in entries:
+            item = make_item(entry)
+            if item:
+                item['transcript_path'] = entry['transcript_path']
+                item['attempts'] = entry['attempts']
+                items.append(item)
+        return items
+
+    def _retry(self, items, reason):
+        """Повторяет звонки через retry_delay; исчерпавшие попытки - в лог"""
+        retry = [item for item in items if item['attempts'] + 1 < self.max_attempts]
+        dropped = [item['communication_id'] for item in items if item['attempts'] + 1 >= self.max_attempts]
+        if dropped:
+            self.dropped += len(dropped)
+            logger.error(f"GPT analysis dropped after {self.max_attempts} attempts ({reason}): {dropped}")
+        if not retry:
+            return
+        self.requeued += len(retry)
+        logger.warning(f"GPT analysis will retry in {self.retry_delay:.0f} s ({reason}): "
+                       f"{[item['communication_id'] for item in retry]}")
+
+        def requeue():
+            self._retries.discard(handle)
+            for item in retry:
+                self.enqueue(item['communication_id'], item['transcript_path'], item['attempts'] + 1)
+
+        handle = asyncio.get_event_loop().call_later(self.retry_delay, requeue)
+        self._retries.add(handle)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            entries = await self._collect()
+            items = []
+            try:
+                items = await loop.run_in_executor(self.io_executor, self._make_items, entries)
+                hits, misses = await loop.run_in_executor(self.io_executor, split_cached, items, self.database)
+                if hits:
+                    await loop.run_in_executor(self.io_executor, self.database.save_call_analysis, hits, PROMPT_VERSION)
+                    logger.info(f"GPT analysis cache hits: {len(hits)}")
+            except Exception as e:
+                logger.error(f"GPT analysis cache lookup failed: {e}")
+                self._retry(items or entries, 'cache lookup failed')
+                continue
+            for batch in pack_batches(misses):
+                await self.semaphore.acquire()
+                task = asyncio.ensure_future(self._process_batch(batch))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _process_batch(self, batch):
+        loop = asyncio.get_event_loop()
+        results = []
+        try:
+            results = await loop.run_in_executor(self.executor, request_analysis, batch)
+            await loop.run_in_executor(self.io_executor, self.database.save_call_analysis, results, PROMPT_VERSION)
+            logger.info(f"GPT analysis saved for {len(results)}/{len(batch)} calls")
+        except Exception as e:
+            logger.error(f"GPT analysis batch failed: {e}")
+            results = []
+        finally:
+            self.semaphore.release()
+        missing = set(missing_ids(batch, results))
+        if missing:
+            self._retry([item for item in batch if item['communication_id'] in missing], 'no result from OpenAI')
+
+
+def main(batch_size=200):
+    """Анализ всех транскрибированных звонков без результатов текущей версии промпта"""
+    from database import db
+
+    after_id = ''
+    total = 0
+    with ThreadPoolExecutor(max_workers=GPT_CONCURRENCY) as pool:
+        while True:
+            calls = db.get_calls_without_analysis(PROMPT_VERSION, batch_size, after_id)
+            if not calls:
+                break
+            after_id = calls[-1]['communication_id']
+            items = [item for item in map(make_item, calls) if item]
+            hits, misses = split_cached(items, db)
+            db.save_call_analysis(hits, PROMPT_VERSION)
+            saved = len(hits)
+            batches = pack_batches(misses)
+            for batch, results in zip(batches, pool.map(request_analysis, batches)):
+                db.save_call_analysis(results, PROMPT_VERSION)
+                saved += len(results)
+                missing = missing_ids(batch, results)
+                if missing:
+                    # Повторит следующий запуск: звонки остаются без анализа текущей версии
+                    logger.warning(f"No GPT analysis for calls: {missing}")
+            total += saved
+            logger.info(f"Analyzed up to {after_id}: {saved} saved ({len(hits)} from cache)")
+    logger.info(f"GPT analysis finished, saved: {total}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,521 @@
+import asyncio
+import logging
+import os
+import traceback
+from datetime import datetime, timedelta
+from typing import Optional
+
+from get_calls import download_call, find_call_report, iter_calls_report
+from transcribe_calls import process_call, find_transcription_folder
+from database import db
+from audio_store import AudioStore, AUDIO_SWEEP_INTERVAL
+from call_analytics import analyze_and_store
+from gpt_analysis import AnalysisQueue
+from rate_limiter import limiter_metrics
+from reconcile_poller import ReconcilePoller
+from retry_scheduler import RETRY_DELAYS, RetryScheduler
+from priority_scheduler import (
+    BACKFILL_LANE,
+    LIVE_LANE,
+    LIVE_RESERVED_SLOTS,
+    PriorityScheduler,
+    call_duration,
+    priority_key,
+)
+from single_flight import SingleFlight, WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# Режим процесса:
+#   all    - webhook обрабатывает звонок сразу, фоновые задачи и воркер очереди в том же процессе
+#   ingest - webhook только ставит звонок в call_queue, обработкой занимаются отдельные воркеры
+#   worker - процесс call_worker.py: забирает звонки из call_queue и обрабатывает их
+SERVICE_MODE = os.environ.get('SERVICE_MODE', 'all')
+# Число процессов uvicorn. Режим all запускает фоновые задачи (сверка, отложенные проверки, очереди)
+# и свои лимитеры UIS/OpenAI в каждом процессе, поэтому несколько процессов допустимы только в ingest
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Сколько звонков воркер обрабатывает одновременно
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 4))
+# Пауза между опросами пустой очереди, секунды
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 1.0))
+# Аренда звонка в очереди: без heartbeat-а воркера звонок вернется в очередь через QUEUE_LEASE_TTL
+QUEUE_LEASE_TTL = float(os.environ.get('QUEUE_LEASE_TTL', 120))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', 3))
+# Период выгрузки для отложенных проверок: весь горизонт повторов плюс запас
+# (start_time звонка раньше webhook-а на его длительность), секунды
+RETRY_REPORT_WINDOW = sum(RETRY_DELAYS) + float(os.environ.get('RETRY_REPORT_MARGIN', 3600))
+# Фоновая сверка с выгрузкой UIS для звонков с потерянными webhook-ами
+RECONCILE_ENABLED = os.environ.get('RECONCILE_ENABLED', '1') == '1'
+
+# Одна обработка на communication_id - внутри процесса и между процессами (аренда в БД)
+single_flight = SingleFlight(db)
+# Очередность скачивания и транскрипции в процессе по полосам (live, backfill)
+scheduler = PriorityScheduler()
+# Горячий (result/) и холодный уровни хранения аудио
+audio_store = AudioStore(db)
+RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result')
+
+# Фоновые задачи процесса, создаются в start_services внутри event loop
+analysis_queue: Optional[AnalysisQueue] = None
+retry_scheduler: Optional[RetryScheduler] = None
+queue_worker = None
+reconcile_poller: Optional[ReconcilePoller] = None
+audio_sweep_task: Optional[asyncio.Task] = None
+running_mode = SERVICE_MODE
+
+async def process_unprocessed_calls_from_data(data, exclude=None):
+    """
+    Ставит в backfill звонки выгрузки с аудиозаписями, о которых пайплайн не знает: не обработаны,
+    не стоят в call_queue, не ожидают повторной проверки (как в ReconcilePoller.poll)
+    """
+    if not data or 'result' not in data or 'data' not in data['result']:
+        logger.info("Нет данных для сверки необработанных звонков.")
+        return
+    exclude = exclude or set()
+    # Звонки без записей не ставим: иначе каждый из них начал бы новый цикл отложенных проверок
+    calls_by_id = {
+        str(call.get('communication_id')): call for call in data['result']['data']
+        if call.get('communication_id') and call.get('wav_call_records')
+        and str(call.get('communication_id')) not in exclude
+    }
+    untracked = await asyncio.get_event_loop().run_in_executor(
+        None, db.find_untracked_calls, list(calls_by_id)
+    )
+    to_process = [cid for cid in calls_by_id if cid in untracked]
+    if to_process:
+        logger.info(f"Найдены необработанные звонки: {to_process}. Ставлю в очередь backfill...")
+    for comm_id in to_process:
+        await enqueue_call(comm_id, calls_by_id[comm_id], lane=BACKFILL_LANE)
+
+def find_calls_in_report(comm_ids):
+    """
+    Ищет звонки в выгрузке UIS за RETRY_REPORT_WINDOW (все страницы) - для пачки отложенных
+    проверок RetryScheduler; выгрузка нужна и для сверки после исчерпания проверок.
+    Returns:
+        (found, report): found - {communication_id: call_data}, report - выгрузка или None при ошибке
+    """
+    date_till = datetime.now()
+    calls = iter_calls_report(date_till - timedelta(seconds=RETRY_REPORT_WINDOW), date_till)
+    if calls is None:
+        return {}, None
+    report = {'result': {'data': calls}}
+    wanted = set(str(cid) for cid in comm_ids)
+    found = {}
+    for call in calls:
+        cid = str(call.get('communication_id'))
+        if cid in wanted:
+            found[cid] = call
+    return found, report
+
+def find_call_in_report(comm_id):
+    """
+    Ищет один звонок (webhook) за RETRY_REPORT_WINDOW запросом с фильтром по communication_id.
+    Returns:
+        dict: строка выгрузки или None, если звонка нет или выгрузку получить не удалось
+    """
+    date_till = datetime.now()
+    _, call = find_call_report(comm_id, date_till - timedelta(seconds=RETRY_REPORT_WINDOW), date_till)
+    return call
+
+async def mark_no_wav(comm_id: str, report: dict = None):
+    """Помечает звонок как NO_WAV после всех отложенных проверок и сверяет остальные звонки выгрузки"""
+    logger.error(f"No call data or wav_call_records for {comm_id} after all retries. Marking as NO_WAV.")
+    # Обновляем БД
+    await asyncio.get_event_loop().run_in_executor(
+        None, db.update_call_paths, comm_id, None, None, 'NO_WAV'
+    )
+    # Создаём папку с меткой NO_WAV
+    result_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result')
+    folder_name = f'transcribed_call{comm_id}_NO_WAV'
+    folder_path = os.path.join(result_dir, folder_name)
+    os.makedirs(folder_path, exist_ok=True)
+    info_path = os.path.join(folder_path, 'info.txt')
+    with open(info_path, 'w', encoding='utf-8') as f:
+        f.write(f'Звонок {comm_id}: нет аудиозаписей (wav_call_records) для транскрипции или не найден в API.')
+
+    # Сверяем и обрабатываем необработанные звонки из этой выгрузки
+    await process_unprocessed_calls_from_data(report, exclude={str(comm_id)})
+
+async def process_found_call(comm_id: str, call_data: dict):
+    """Обработка звонка, найденного отложенной проверкой"""
+    result = await process_call_single_flight(comm_id, call_data)
+    if not result["success"]:
+        logger.error(f"Deferred processing failed for call {comm_id}: {result['message']}")
+
+def completed_call_result(comm_id: str):
+    """Результат для уже обработанного звонка или None"""
+    call = db.get_call(comm_id)
+    if call and call.get('transcript_path') and call['transcript_path'] != 'NO_WAV':
+        return {
+            "success": True,
+            "message": "Звонок уже был обработан ранее"
+        }
+    return None
+
+async def process_call_single_flight(comm_id: str, call_data: dict = None, lane: str = LIVE_LANE) -> dict:
+    """Обработка звонка без дублей: повторные запросы по тому же ID получают результат идущей обработки"""
+    return await single_flight.run(
+        str(comm_id),
+        lambda: process_call_async(comm_id, call_data, lane),
+        completed_call_result
+    )
+
+async def process_call_async(comm_id: str, call_data: dict = None, lane: str = LIVE_LANE) -> dict:
+    """
+    Асинхронная обработка звонка.
+    call_data - строка выгрузки UIS, если звонок уже найден (иначе ищется в выгрузке).
+    lane - полоса приоритета для скачивания и транскрипции (live или backfill).
+    Если звонка или его записей в UIS еще нет, повторная проверка ставится в RetryScheduler.
+    """
+    logger.debug(f"Function process_call_async called with comm_id={comm_id}")
+    try:
+        logger.info(f"Starting call processing for {comm_id}")
+        start_time = datetime.now()
+        
+        if call_data is None:
+            # Получаем общую выгрузку и ищем нужный звонок в ней
+            logger.debug(f"Searching calls report for {comm_id}")
+            call_data = await asyncio.get_event_loop().run_in_executor(
+                None, find_call_in_report, comm_id
+            )
+        
+        logger.debug(f"Call data: {call_data}")
+
+        # Звонок еще не выгружен в UIS или без дорожек - проверим позже, не занимая поток
+        if not call_data or not call_data.get('wav_call_records'):
+            logger.warning(f"No call data or wav_call_records for {comm_id}. Deferring.")
+            await retry_scheduler.schedule(comm_id)
+            return {
+                "success": True,
+                "deferred": True,
+                "message": "Звонок еще не выгружен в UIS, повторная проверка запланирована"
+            }
+
+        logger.info(f"Call data received for {comm_id}")
+        
+        # Сохраняем информацию о звонке в БД
+        logger.debug(f"Saving call {comm_id} to database")
+        await asyncio.get_event_loop().run_in_executor(
+            None, db.add_call, comm_id, call_data
+        )
+        logger.info(f"Call {comm_id} saved to database")
+
+        wav_ids = call_data.get('wav_call_records', [])
+        logger.debug(f"wav_ids for {comm_id}: {wav_ids}")
+        if len(wav_ids) < 2:
+            logger.warning(f"Not enough audio tracks for call {comm_id}")
+            return {
+                "success": False,
+                "message": "Для этого звонка нет двух аудиодорожек"
+            }
+
+        # Скачивание и транскрипция - через приоритетный планировщик: live-звонки не ждут backfill
+        async with scheduler.slot(lane, call_duration(call_data)):
+            result_dir = RESULT_DIR
+            client_file = os.path.join(result_dir, f'client_{comm_id}.wav')
+            staff_file = os.path.join(result_dir, f'staff_{comm_id}.wav')
+            # Записи, уже перенесенные в холодный уровень, восстанавливаем вместо повторного скачивания
+            for fpath in (client_file, staff_file):
+                await asyncio.get_event_loop().run_in_executor(None, audio_store.ensure_hot, fpath)
+
+            # Скачиваем файлы
+            logger.info(f"Starting download for call {comm_id}")
+            download_start = datetime.now()
+            success = await asyncio.get_event_loop().run_in_executor(
+                None, download_call, comm_id, wav_ids
+            )
+            download_elapsed = (datetime.now() - download_start).total_seconds()
+            logger.info(f"Download time for {comm_id}: {download_elapsed:.2f} seconds")
+
+            if not success:
+                logger.error(f"Failed to download files for call {comm_id}")
+                return {
+                    "success": False,
+                    "message": "Ошибка при скачивании файлов"
+                }
+
+            logger.info(f"Files downloaded successfully for call {comm_id}")
+        
+            # Учитываем файлы в горячем уровне: до конца обработки они не вытесняются
+            await asyncio.get_event_loop().run_in_executor(
+                None, audio_store.register, [client_file, staff_file], comm_id
+            )
+
+            # Проверяем состояние файлов
+            for fpath, label in [(client_file, 'client'), (staff_file, 'staff')]:
+                if os.path.exists(fpath):
+                    logger.info(f"{label.capitalize()} file exists: {fpath}, size: {os.path.getsize(fpath)} bytes")
+                else:
+                    logger.warning(f"{label.capitalize()} file missing: {fpath}")
+
+            # Обновляем пути к аудиофайлам в БД
+            await asyncio.get_event_loop().run_in_executor(
+                None, db.update_call_paths,
+                comm_id,
+                client_file,
+                staff_file
+            )
+
+            logger.info(f"Starting transcription for call {comm_id}")
+            transcribe_start = datetime.now()
+
+            # Запускаем транскрипцию
+            success = await asyncio.get_event_loop().run_in_executor(
+                None, process_call, comm_id, client_file, staff_file
+            )
+            transcribe_elapsed = (datetime.now() - transcribe_start).total_seconds()
+            logger.info(f"Transcription time for {comm_id}: {transcribe_elapsed:.2f} seconds")
+
+        if success:
+            logger.info(f"Transcription completed for call {comm_id}")
+            # Обновляем путь к транскрипции в БД (папку создает process_call со своей меткой времени)
+            transcript_dir = await asyncio.get_event_loop().run_in_executor(
+                None, find_transcription_folder, result_dir, comm_id
+            )
+            
+            await asyncio.get_event_loop().run_in_executor(
+                None, db.update_call_paths,
+                comm_id,
+                None,
+                None,
+                transcript_dir
+            )
+
+            # Метрики разговора считаем сразу, сбой аналитики не влияет на результат обработки
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, analyze_and_store, [{
+                        'communication_id': comm_id,
+                        'transcript_path': transcript_dir,
+                        'client_audio_path': client_file,
+                        'staff_audio_path': staff_file
+                    }], db
+                )
+            except Exception as e:
+                logger.error(f"Analytics failed for call {comm_id}: {e}")
+
+            # Транскрипция и метрики готовы - записи больше не нужны в горячем уровне
+            await asyncio.get_event_loop().run_in_executor(
+                None, audio_store.release, [client_file, staff_file], True
+            )
+
+            # GPT-анализ идет в фоне через очередь, ответ на webhook его не ждет
+            if analysis_queue and transcript_dir:
+                analysis_queue.enqueue(comm_id, transcript_dir)
+
+            elapsed = (datetime.now() - start_time).total_seconds()
+            logger.info(f"Total process_call_async time for {comm_id}: {elapsed:.2f} seconds")
+            return {
+                "success": True,
+                "message": "Звонок успешно обработан и транскрибирован"
+            }
+        else:
+            logger.error(f"Transcription failed for call {comm_id}")
+            # Файлы остаются в горячем уровне для повтора, но снова подлежат вытеснению
+            await asyncio.get_event_loop().run_in_executor(
+                None, audio_store.release, [client_file, staff_file]
+            )
+            return {
+                "success": False,
+                "message": "Ошибка при транскрибации"
+            }
+
+    except Exception as e:
+        logger.error(f"Error processing call {comm_id}: {str(e)}\n{traceback.format_exc()}", exc_info=True)
+        return {
+            "success": False,
+            "message": f"Ошибка при обработке: {str(e)}"
+        }
+
+
+class QueueWorker:
+    """
+    Воркер очереди call_queue: забирает до concurrency звонков с арендой, продлевает аренду,
+    пока звонки обрабатываются, и отмечает результат. Звонки упавшего воркера возвращаются
+    в очередь после истечения аренды. live_reserved слотов забираются только live-звонками,
+    как и в PriorityScheduler.
+    """
+
+    def __init__(self, database, concurrency=WORKER_CONCURRENCY, owner=WORKER_ID,
+                 ttl=QUEUE_LEASE_TTL, poll_interval=WORKER_POLL_INTERVAL, live_reserved=LIVE_RESERVED_SLOTS):
+        self.database = database
+        self.concurrency = concurrency
+        # Слоты только для live-звонков: backfill не забирает все слоты воркера
+        self.live_reserved = min(live_reserved, max(concurrency - 1, 0))
+        self._lanes = {}
+        self.owner = owner
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._active = {}
+        self._wakeup = None
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._tasks:
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.ensure_future(self._run()), asyncio.ensure_future(self._heartbeat())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._active:
+            await asyncio.gather(*self._active.values(), return_exceptions=True)
+
+    def wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            'owner': self.owner,
+            'concurrency': self.concurrency,
+            'live_reserved': self.live_reserved,
+            'active': len(self._active),
+            'processed': self.processed,
+            'failed': self.failed
+        }
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            self._wakeup.clear()
+            claimed = []
+            free = self.concurrency - len(self._active)
+            if free > 0:
+                other_active = sum(1 for lane in self._lanes.values() if lane != LIVE_LANE)
+                try:
+                    claimed = await loop.run_in_executor(
+                        None, self.database.claim_calls, self.owner, self.ttl, free, QUEUE_MAX_ATTEMPTS,
+                        self.concurrency - self.live_reserved - other_active
+                    )
+                except Exception as e:
+                    logger.error(f"Queue claim failed: {e}")
+                for comm_id, call_data, lane in claimed:
+                    task = asyncio.ensure_future(self._process(comm_id, call_data, lane))
+                    self._active[comm_id] = task
+                    self._lanes[comm_id] = lane
+            if claimed and len(self._active) < self.concurrency:
+                continue
+            # Ждем освобождения слота, нового звонка в этом процессе или следующего опроса
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, comm_id, call_data, lane):
+        loop = asyncio.get_event_loop()
+        state = 'failed'
+        try:
+            result = await process_call_single_flight(comm_id, call_data, lane)
+            if result["success"]:
+                state = 'done'
+            else:
+                logger.error(f"Queued call {comm_id} failed: {result['message']}")
+        except Exception as e:
+            logger.error(f"Queued call {comm_id} crashed: {e}", exc_info=True)
+        finally:
+            self._active.pop(comm_id, None)
+            self._lanes.pop(comm_id, None)
+            if state == 'done':
+                self.processed += 1
+            else:
+                self.failed += 1
+            await loop.run_in_executor(None, self.database.complete_claim, comm_id, self.owner, state)
+            self.wake()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await loop.run_in_executor(
+                    None, self.database.heartbeat_claims, self.owner, list(self._active), self.ttl
+                )
+            except Exception as e:
+                logger.error(f"Queue heartbeat failed: {e}")
+
+async def enqueue_call(comm_id: str, call_data: dict = None, lane: str = LIVE_LANE) -> bool:
+    """Ставит звонок в общую очередь обработки (call_queue) с ключом приоритета полосы"""
+    added = await asyncio.get_event_loop().run_in_executor(
+        None, db.enqueue_call, comm_id, call_data, lane, priority_key(lane, call_duration(call_data))
+    )
+    if queue_worker:
+        queue_worker.wake()
+    return added
+
+async def enqueue_backfill(comm_id: str, call_data: dict = None) -> bool:
+    """Постановка пропущенного звонка в полосу backfill"""
+    return await enqueue_call(comm_id, call_data, lane=BACKFILL_LANE)
+
+async def audio_sweep_loop():
+    """Периодически переносит старые записи в холодный уровень и держит горячий в бюджете"""
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, audio_store.scan, RESULT_DIR)
+    while True:
+        try:
+            await loop.run_in_executor(None, audio_store.sweep)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Audio sweep error: {e}", exc_info=True)
+        await asyncio.sleep(AUDIO_SWEEP_INTERVAL)
+
+def check_web_concurrency(web_workers: int = WEB_CONCURRENCY, mode: str = SERVICE_MODE):
+    """Несколько процессов uvicorn - только в режиме ingest, обработку масштабируют воркеры очереди"""
+    if web_workers > 1 and mode != 'ingest':
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={web_workers} requires SERVICE_MODE=ingest: in '{mode}' mode every process "
+            f"would run its own background services and rate limiters. Scale processing with call_worker.py"
+        )
+
+async def start_services(mode: str = SERVICE_MODE):
+    """Запуск фоновых задач процесса в зависимости от режима"""
+    if mode != 'worker':
+        check_web_concurrency(WEB_CONCURRENCY, mode)
+    global analysis_queue, retry_scheduler, queue_worker, reconcile_poller, audio_sweep_task, running_mode
+    running_mode = mode
+    if mode == 'ingest':
+        logger.info("Ingest mode: calls are queued for separate workers")
+        return
+    analysis_queue = AnalysisQueue(db)
+    analysis_queue.start()
+    retry_scheduler = RetryScheduler(db, find_calls_in_report, process_found_call, mark_no_wav)
+    retry_scheduler.start()
+    queue_worker = QueueWorker(db)
+    queue_worker.start()
+    if RECONCILE_ENABLED:
+        reconcile_poller = ReconcilePoller(db, iter_calls_report, enqueue_backfill)
+        reconcile_poller.start()
+    audio_sweep_task = asyncio.ensure_future(audio_sweep_loop())
+    logger.info(f"Pipeline services started in {mode} mode, worker {WORKER_ID}")
+
+async def stop_services():
+    if audio_sweep_task:
+        audio_sweep_task.cancel()
+    if reconcile_poller:
+        await reconcile_poller.stop()
+    if queue_worker:
+        await queue_worker.stop()
+    if analysis_queue:
+        await analysis_queue.stop()
+    if retry_scheduler:
+        await retry_scheduler.stop()
+
+async def pipeline_metrics() -> dict:
+    """Метрики процесса: лимиты внешних сервисов, очереди и фоновые задачи"""
+    return {
+        "mode": running_mode,
+        "limiters": limiter_metrics(),
+        "analysis_queue": analysis_queue.stats() if analysis_queue else None,
+        "retry_scheduler": await retry_scheduler.stats() if retry_scheduler else None,
+        "single_flight": single_flight.stats(),
+        "scheduler": scheduler.stats(),
+        "call_queue": await asyncio.get_event_loop().run_in_executor(None, db.get_queue_stats),
+        "queue_worker": queue_worker.stats() if queue_worker else None,
+        "reconcile_poller": reconcile_poller.stats() if reconcile_poller else None,
+        "audio_store": await asyncio.get_event_loop().run_in_executor(None, audio_store.stats),
+    }
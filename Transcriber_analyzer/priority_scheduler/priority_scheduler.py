@@ -0,0 +1,146 @@
+"""
+Приоритетное планирование тяжелой работы (скачивание и транскрипция звонка).
+
+Звонки делятся на полосы: live - звонки из webhook-ов, backfill - дообработка пропущенных
+(сверка с UIS, звонки выгрузки после NO_WAV). Порядок задает ключ
+    priority = enqueued_at + LANE_DELAY[lane] + duration * DURATION_WEIGHT (кроме live)
+то есть звонок backfill обслуживается так, будто пришел на LANE_DELAY + duration * DURATION_WEIGHT
+секунд позже: короткие звонки идут первыми, а длинный звонок после такого ожидания обгоняет
+новые live-звонки (защита от голодания). Ключ не меняется со временем, поэтому тот же порядок
+дает индекс по call_queue.priority.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+LIVE_LANE = 'live'
+BACKFILL_LANE = 'backfill'
+
+
+def _parse_lane_delays(value):
+    delays = {}
+    for part in value.split(','):
+        lane, _, delay = part.partition(':')
+        delays[lane.strip()] = float(delay)
+    return delays
+
+
+# Задержка полосы, секунды: насколько раньше live звонок backfill может быть обслужен без учета длительности
+LANE_DELAYS = _parse_lane_delays(os.environ.get('PRIORITY_LANE_DELAYS', 'live:0,backfill:1800'))
+# Секунд ожидания за секунду длительности звонка в не-live полосах (shortest-first)
+DURATION_WEIGHT = float(os.environ.get('PRIORITY_DURATION_WEIGHT', 1.0))
+# Длительность звонка, если UIS ее не прислал, секунды
+DEFAULT_DURATION = float(os.environ.get('PRIORITY_DEFAULT_DURATION', 300))
+# Одновременных скачиваний и транскрипций в процессе
+PROCESSING_CONCURRENCY = int(os.environ.get('PROCESSING_CONCURRENCY', 4))
+# Слоты, которые не-live полосы не занимают - live-звонок не ждет окончания backfill
+LIVE_RESERVED_SLOTS = int(os.environ.get('PRIORITY_LIVE_RESERVED', 1))
+
+
+def call_duration(call_data):
+    """Длительность звонка из строки выгрузки UIS или None"""
+    if not call_data:
+        return None
+    try:
+        return float(call_data.get('total_duration'))
+    except (TypeError, ValueError):
+        return None
+
+
+def priority_key(lane, duration=None, enqueued_at=None):
+    """Ключ приоритета: меньше - раньше"""
+    if enqueued_at is None:
+        enqueued_at = time.time()
+    key = enqueued_at + LANE_DELAYS.get(lane, LANE_DELAYS.get(BACKFILL_LANE, 0.0))
+    if lane != LIVE_LANE:
+        key += (DEFAULT_DURATION if duration is None else duration) * DURATION_WEIGHT
+    return key
+
+
+class PriorityScheduler:
+    """
+    Ограничивает число одновременных тяжелых задач процесса и выдает освободившиеся слоты
+    по ключу priority_key. Для каждой полосы своя куча; LIVE_RESERVED_SLOTS слотов
+    доступны только live-полосе.
+    """
+
+    def __init__(self, concurrency=PROCESSING_CONCURRENCY, live_reserved=LIVE_RESERVED_SLOTS):
+        self.concurrency = concurrency
+        self.live_reserved = min(live_reserved, max(concurrency - 1, 0))
+        self._heaps = {}
+        self._running = {}
+        self._seq = itertools.count()
+        self._granted = {}
+        self._wait_total = {}
+
+    @asynccontextmanager
+    async def slot(self, lane=LIVE_LANE, duration=None):
+        enqueued_at = time.time()
+        if not self._heaps.get(lane) and self._can_run(lane):
+            self._start(lane, enqueued_at)
+        else:
+            future = asyncio.get_event_loop().create_future()
+            entry = (priority_key(lane, duration, enqueued_at), next(self._seq), enqueued_at, future)
+            heapq.heappush(self._heaps.setdefault(lane, []), entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Слот уже выдан - возвращаем его следующему
+                    self._finish(lane)
+                raise
+        try:
+            yield
+        finally:
+            self._finish(lane)
+
+    def _can_run(self, lane):
+        total = sum(self._running.values())
+        if total >= self.concurrency:
+            return False
+        if lane == LIVE_LANE:
+            return True
+        return total - self._running.get(LIVE_LANE, 0) < self.concurrency - self.live_reserved
+
+    def _start(self, lane, enqueued_at):
+        self._running[lane] = self._running.get(lane, 0) + 1
+        self._granted[lane] = self._granted.get(lane, 0) + 1
+        self._wait_total[lane] = self._wait_total.get(lane, 0.0) + time.time() - enqueued_at
+
+    def _finish(self, lane):
+        self._running[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Выдает свободные слоты ожидающим с наименьшим ключом среди допустимых полос"""
+        while True:
+            best = None
+            for lane, heap in self._heaps.items():
+                while heap and heap[0][3].done():
+                    heapq.heappop(heap)
+                if heap and self._can_run(lane) and (best is None or heap[0] < self._heaps[best][0]):
+                    best = lane
+            if best is None:
+                return
+            _, _, enqueued_at, future = heapq.heappop(self._heaps[best])
+            self._start(best, enqueued_at)
+            future.set_result(None)
+
+    def stats(self):
+        """Глубина очереди, число выполняемых задач и ожидание по полосам"""
+        now = time.time()
+        lanes = {}
+        for lane in set(self._heaps) | set(self._running):
+            waiting = [entry for entry in self._heaps.get(lane, []) if not entry[3].done()]
+            granted = self._granted.get(lane, 0)
+            lanes[lane] = {
+                'waiting': len(waiting),
+                'running': self._running.get(lane, 0),
+                'max_wait': round(now - min(entry[2] for entry in waiting), 1) if waiting else 0.0,
+                'avg_wait': round(self._wait_total.get(lane, 0.0) / granted, 2) if granted else 0.0,
+                'started': granted,
+            }
+        return {'concurrency': self.concurrency, 'live_reserved': self.live_reserved, 'lanes': lanes}
@@ -0,0 +1,206 @@
+"""
+Адаптивное ограничение параллельности запросов к внешним сервисам (OpenAI, UIS Data API, медиасервер UIS).
+
+Лимит параллельных запросов меняется по схеме AIMD: после успешного ответа растет аддитивно
+(примерно +1 за «окно» запросов), при 429/5xx и сетевых ошибках уменьшается мультипликативно.
+Retry-After приостанавливает новые запросы к сервису на указанное время.
+Временные ошибки повторяются с экспоненциальной задержкой и случайным разбросом (full jitter).
+Сервисы, которые сообщают об ошибках в теле ответа с HTTP 200 (JSON-RPC UIS), передают
+в request классификатор ответа.
+Все вызовы синхронные - лимитеры используются из потоков пула (requests).
+"""
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Коды, означающие перегрузку сервиса (кроме них снижаем лимит и на сетевых ошибках)
+THROTTLE_STATUSES = {429, 503}
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах (число или HTTP-дата) или None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class AdaptiveLimiter:
+    """Лимитер одного внешнего сервиса"""
+
+    def __init__(self, name, initial=4, min_limit=1, max_limit=32, increase=1.0, decrease=0.5,
+                 max_retries=4, base_delay=1.0, max_delay=60.0, decrease_cooldown=1.0):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Несколько ошибок одной «волны» снижают лимит один раз
+        self.decrease_cooldown = decrease_cooldown
+
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._waiting = 0
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._counters = {'requests': 0, 'successes': 0, 'throttled': 0, 'errors': 0, 'retries': 0}
+
+    def acquire(self):
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    pause = self._blocked_until - time.monotonic()
+                    if pause <= 0 and self._inflight < int(self.limit):
+                        break
+                    self._cond.wait(timeout=pause if pause > 0 else None)
+            finally:
+                self._waiting -= 1
+            self._inflight += 1
+            self._counters['requests'] += 1
+
+    def release(self, outcome, retry_after=None):
+        """
+        outcome: 'success', 'throttled' или 'error'
+        retry_after: пауза в секундах из заголовка Retry-After
+        """
+        with self._cond:
+            self._inflight -= 1
+            now = time.monotonic()
+            if outcome == 'success':
+                self._counters['successes'] += 1
+                self.limit = min(self.max_limit, self.limit + self.increase / max(self.limit, 1.0))
+            else:
+                self._counters['throttled' if outcome == 'throttled' else 'errors'] += 1
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._last_decrease = now
+                    logger.warning(f"Rate limiter {self.name}: {outcome}, limit lowered to {self.limit:.2f}")
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Слот для произвольной операции. Исход по умолчанию - success,
+        исключение внутри блока считается ошибкой.
+        """
+        self.acquire()
+        try:
+            yield
+        except Exception:
+            self.release('error')
+            raise
+        self.release('success')
+
+    def backoff(self, attempt, retry_after=None):
+        """Задержка перед повтором: Retry-After, если сервис его прислал, иначе full jitter"""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def request(self, func, *args, classify=None, **kwargs):
+        """
+        Выполняет func(*args, **kwargs), возвращающую requests.Response, с повторами.
+        classify(response) - исход ответа с HTTP-кодом не из RETRYABLE_STATUSES: 'success',
+        'throttled' или 'error' (два последних повторяются); None - по HTTP-коду.
+        Если все попытки неудачны, возвращает последний ответ или пробрасывает последнее исключение.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = func(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.release('error')
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"{self.name}: {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+            except Exception:
+                self.release('error')
+                raise
+            else:
+                status = response.status_code
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if status in RETRYABLE_STATUSES:
+                    outcome = 'throttled' if status in THROTTLE_STATUSES else 'error'
+                    reason = f"HTTP {status}"
+                else:
+                    outcome = (classify and classify(response)) or 'success'
+                    reason = f"{outcome} response with HTTP {status}"
+                if outcome == 'success':
+                    self.release('success')
+                    return response
+                self.release(outcome, retry_after)
+                if attempt >= self.max_retries:
+                    return response
+                delay = self.backoff(attempt, retry_after)
+                logger.warning(f"{self.name}: {reason}, retry {attempt + 1} in {delay:.1f}s")
+            with self._cond:
+                self._counters['retries'] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def snapshot(self):
+        with self._cond:
+            return dict(
+                self._counters,
+                name=self.name,
+                limit=round(self.limit, 2),
+                inflight=self._inflight,
+                waiting=self._waiting,
+                blocked_for=round(max(self._blocked_until - time.monotonic(), 0.0), 2),
+            )
+
+
+def _limiter_from_env(name, initial, max_limit):
+    prefix = f'RATE_LIMIT_{name.upper()}'
+    return AdaptiveLimiter(
+        name,
+        initial=int(os.environ.get(f'{prefix}_INITIAL', initial)),
+        max_limit=int(os.environ.get(f'{prefix}_MAX', max_limit)),
+        max_retries=int(os.environ.get(f'{prefix}_RETRIES', 4)),
+    )
+
+
+# Лимитеры процесса, по одному на внешний сервис
+LIMITERS = {
+    'openai': _limiter_from_env('openai', initial=4, max_limit=16),
+    'uis_data': _limiter_from_env('uis_data', initial=2, max_limit=4),
+    'uis_media': _limiter_from_env('uis_media', initial=4, max_limit=16),
+}
+
+
+def get_limiter(name):
+    return LIMITERS[name]
+
+
+def limiter_metrics():
+    """Текущие лимиты и счетчики всех лимитеров"""
+    return {name: limiter.snapshot() for name, limiter in LIMITERS.items()}
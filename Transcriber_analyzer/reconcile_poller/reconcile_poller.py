@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from single_flight import WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# Как часто сверять выгрузку UIS с БД, секунды
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', 300))
+# Насколько раньше high-watermark начинать выгрузку: записи звонка в UIS появляются с задержкой
+RECONCILE_LOOKBACK = float(os.environ.get('RECONCILE_LOOKBACK', 3600))
+# Период первой сверки, когда отметки в БД еще нет, секунды
+RECONCILE_INITIAL_WINDOW = float(os.environ.get('RECONCILE_INITIAL_WINDOW', 86400))
+# Сколько звонков может ждать в call_queue, прежде чем сверка перестанет добавлять новые
+RECONCILE_MAX_QUEUED = int(os.environ.get('RECONCILE_MAX_QUEUED', 20))
+# Как часто подкладывать найденные звонки в очередь, пока она заполнена, секунды
+RECONCILE_FEED_INTERVAL = float(os.environ.get('RECONCILE_FEED_INTERVAL', 5))
+RECONCILE_PAGE_SIZE = int(os.environ.get('RECONCILE_PAGE_SIZE', 1000))
+# Аренда сверки: сверку ведет один процесс, остальные подхватывают ее, если он упал, секунды
+RECONCILE_LEASE_TTL = float(os.environ.get('RECONCILE_LEASE_TTL', 300))
+# Ключ аренды в таблице call_leases
+RECONCILE_LEASE_KEY = 'reconcile_poller'
+
+# Имя high-watermark в таблице sync_state
+WATERMARK_NAME = 'uis_calls_report'
+UIS_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ReconcilePoller:
+    """
+    Периодическая сверка выгрузки UIS с БД - подбирает звонки, webhook которых потерялся
+    (например, пока сервер перезапускался).
+
+    Выгрузка get.calls_report запрашивается не за сутки, а от high-watermark из таблицы
+    sync_state (минус RECONCILE_LOOKBACK на запаздывающие записи). Звонки с аудиозаписями
+    сверяются с БД одним запросом, неизвестные пайплайну ставятся в call_queue по мере
+    ее освобождения - не больше RECONCILE_MAX_QUEUED ожидающих. Отметка сдвигается
+    только до последнего поставленного в очередь звонка, поэтому после перезапуска
+    сверка продолжается с того же места.
+
+    Сверку ведет только процесс, который держит аренду RECONCILE_LEASE_KEY в call_leases
+    (продлевается каждые RECONCILE_LEASE_TTL / 3), поэтому N процессов call_worker.py
+    не запрашивают одну и ту же выгрузку N раз. Остальные процессы ждут и забирают аренду,
+    когда она истечет.
+
+    fetch_calls(date_from, date_till, page_size): синхронная функция, все звонки периода или None
+    enqueue(comm_id, call_data): корутина постановки звонка в очередь
+    """
+
+    def __init__(self, database, fetch_calls, enqueue, interval=RECONCILE_INTERVAL,
+                 lookback=RECONCILE_LOOKBACK, max_queued=RECONCILE_MAX_QUEUED,
+                 owner=WORKER_ID, lease_ttl=RECONCILE_LEASE_TTL):
+        self.database = database
+        self.fetch_calls = fetch_calls
+        self.enqueue = enqueue
+        self.interval = interval
+        self.lookback = lookback
+        self.max_queued = max_queued
+        self.owner = owner
+        self.lease_ttl = lease_ttl
+        self.leader = False
+        self._task = None
+        self._backlog = deque()
+        self._poll_till = None
+        self._next_poll = 0.0
+        self._watermark = None
+        self._last_poll = None
+        self.enqueued = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.leader:
+            self.leader = False
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.database.release_lease, RECONCILE_LEASE_KEY, self.owner
+            )
+
+    def stats(self):
+        return {
+            'leader': self.leader,
+            'watermark': self._watermark,
+            'last_poll': self._last_poll,
+            'backlog': len(self._backlog),
+            'enqueued': self.enqueued,
+            'next_poll_in': round(max(self._next_poll - time.time(), 0), 1) if not self._backlog else None
+        }
+
+    async def _hold_lease(self):
+        """Берет или продлевает аренду сверки. False - сверку ведет другой процесс."""
+        leader = await asyncio.get_event_loop().run_in_executor(
+            None, self.database.acquire_lease, RECONCILE_LEASE_KEY, self.owner, self.lease_ttl
+        )
+        if leader != self.leader:
+            logger.info(f"Reconcile poller {'acquired' if leader else 'lost'} the lease ({self.owner})")
+            if leader:
+                # Опрос сразу: прежний владелец мог упасть посреди сверки
+                self._next_poll = 0.0
+            else:
+                # Найденное продолжит новый владелец от отметки в sync_state
+                self._backlog.clear()
+        self.leader = leader
+        return leader
+
+    async def _run(self):
+        while True:
+            try:
+                if not await self._hold_lease():
+                    await asyncio.sleep(self.lease_ttl / 3)
+                    continue
+                if not self._backlog and time.time() >= self._next_poll:
+                    self._next_poll = time.time() + self.interval
+                    await self.poll()
+                if self._backlog:
+                    await self._feed()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Reconcile poller error: {e}", exc_info=True)
+            # Просыпаемся не реже трети срока аренды, чтобы продлить ее
+            pause = RECONCILE_FEED_INTERVAL if self._backlog else max(self._next_poll - time.time(), 0)
+            await asyncio.sleep(min(pause, self.lease_ttl / 3))
+
+    async def poll(self):
+        """Выгрузка от high-watermark и поиск звонков, о которых пайплайн не знает"""
+        loop = asyncio.get_event_loop()
+        date_till = datetime.now().replace(microsecond=0)
+        watermark = await loop.run_in_executor(None, self.database.get_sync_state, WATERMARK_NAME)
+        if watermark:
+            date_from = datetime.strptime(watermark, UIS_TIME_FORMAT) - timedelta(seconds=self.lookback)
+        else:
+            date_from = date_till - timedelta(seconds=RECONCILE_INITIAL_WINDOW)
+        self._watermark = watermark
+
+        calls = await loop.run_in_executor(None, self.fetch_calls, date_from, date_till, RECONCILE_PAGE_SIZE)
+        self._last_poll = date_till.strftime(UIS_TIME_FORMAT)
+        if calls is None:
+            logger.warning("Reconcile poll: calls report unavailable, will retry on next poll")
+            return
+
+        # Звонки без записей пропускаем: если записи появятся позже, их подберет следующая сверка
+        ready = {
+            str(call.get('communication_id')): call
+            for call in calls if call.get('communication_id') and call.get('wav_call_records')
+        }
+        untracked = await loop.run_in_executor(None, self.database.find_untracked_calls, list(ready))
+        missing = sorted((ready[cid] for cid in untracked), key=lambda call: call.get('start_time') or '')
+        logger.info(
+            f"Reconcile poll {date_from.strftime(UIS_TIME_FORMAT)} - {self._last_poll}: "
+            f"{len(calls)} calls in report, {len(missing)} missing"
+        )
+        self._backlog = deque(missing)
+        self._poll_till = self._last_poll
+        if not self._backlog:
+            await self._advance(self._poll_till)
+
+    async def _feed(self):
+        """Ставит найденные звонки в очередь, пока в ней меньше max_queued ожидающих"""
+        loop = asyncio.get_event_loop()
+        stats = await loop.run_in_executor(None, self.database.get_queue_stats)
+        free = self.max_queued - stats['queued']
+        last_start = None
+        while free > 0 and self._backlog:
+            call = self._backlog.popleft()
+            comm_id = str(call['communication_id'])
+            if await self.enqueue(comm_id, call):
+                free -= 1
+                self.enqueued += 1
+                logger.info(f"Reconcile: queued missed call {comm_id}")
+            last_start = call.get('start_time') or last_start
+        if not self._backlog:
+            await self._advance(self._poll_till)
+        elif last_start:
+            await self._advance(last_start)
+
+    async def _advance(self, value):
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.database.advance_sync_state, WATERMARK_NAME, value
+        )
+        self._watermark = max(self._watermark or value, value)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Задержки повторных проверок звонка в UIS, секунды (n-я проверка через RETRY_DELAYS[n])
+RETRY_DELAYS = [
+    int(d) for d in os.environ.get('PENDING_RETRY_DELAYS', '60,120,300,600,1200,1800').split(',')
+]
+# Сколько ожидающих звонков проверять за один проход
+RETRY_BATCH_SIZE = 500
+
+
+class RetryScheduler:
+    """
+    Отложенные повторные проверки звонков, которых еще нет в выгрузке UIS.
+
+    Расписание хранится в таблице pending_calls (индекс по due_at), поэтому переживает
+    перезапуск сервера. Один асинхронный цикл спит до ближайшего due_at и за проход
+    сверяет все наступившие звонки с одной выгрузкой get.calls_report - ожидающие
+    звонки не занимают ни потоков, ни задач event loop. Наступившие проверки забираются
+    атомарно, поэтому планировщик может работать в нескольких процессах.
+
+    lookup(comm_ids) -> (found, report): синхронная функция, found - {communication_id: call_data}
+    on_found(comm_id, call_data): корутина, запускается для звонков с аудиозаписями
+    on_give_up(comm_id, report): корутина, вызывается после исчерпания всех проверок
+    """
+
+    def __init__(self, database, lookup, on_found, on_give_up, delays=None):
+        self.database = database
+        self.lookup = lookup
+        self.on_found = on_found
+        self.on_give_up = on_give_up
+        self.delays = delays or RETRY_DELAYS
+        self._wakeup = None
+        self._task = None
+        self._spawned = set()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def schedule(self, comm_id: str) -> bool:
+        """Ставит звонок на первую повторную проверку. False, если он уже ожидает."""
+        due_at = time.time() + self.delays[0]
+        added = await asyncio.get_event_loop().run_in_executor(
+            None, self.database.schedule_pending_call, comm_id, due_at
+        )
+        if added:
+            logger.info(f"Call {comm_id} deferred, next check in {self.delays[0]}s")
+            if self._wakeup:
+                self._wakeup.set()
+        return added
+
+    async def stats(self):
+        loop = asyncio.get_event_loop()
+        pending = await loop.run_in_executor(None, self.database.count_pending_calls)
+        next_due = await loop.run_in_executor(None, self.database.get_next_pending_due)
+        return {
+            'pending': pending,
+            'next_check_in': round(max(next_due - time.time(), 0), 1) if next_due else None
+        }
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                next_due = await loop.run_in_executor(None, self.database.get_next_pending_due)
+                delay = None if next_due is None else next_due - time.time()
+                if delay is None or delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._check_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Retry scheduler error: {e}", exc_info=True)
+                await asyncio.sleep(self.delays[0])
+
+    async def _check_due(self):
+        loop = asyncio.get_event_loop()
+        now = time.time()
+        due = await loop.run_in_executor(None, self.database.claim_due_pending_calls, now, RETRY_BATCH_SIZE)
+        if not due:
+            return
+        found, report = await loop.run_in_executor(None, self.lookup, [cid for cid, _ in due])
+        if report is None:
+            # UIS недоступен - переносим всю пачку, не расходуя попытки
+            await loop.run_in_executor(
+                None, self.database.reschedule_pending_calls,
+                [(now + self.delays[0], attempts, cid) for cid, attempts in due]
+            )
+            return
+
+        ready, retry, expired = [], [], []
+        for comm_id, attempts in due:
+            call_data = found.get(comm_id)
+            if call_data and call_data.get('wav_call_records'):
+                ready.append((comm_id, call_data))
+            elif attempts + 1 < len(self.delays):
+                retry.append((now + self.delays[attempts + 1], attempts + 1, comm_id))
+            else:
+                expired.append(comm_id)
+
+        await loop.run_in_executor(None, self.database.reschedule_pending_calls, retry)
+        await loop.run_in_executor(
+            None, self.database.remove_pending_calls, [cid for cid, _ in ready] + expired
+        )
+        logger.info(f"Retry check: {len(ready)} found, {len(retry)} rescheduled, {len(expired)} given up")
+
+        for comm_id, call_data in ready:
+            self._spawn(self.on_found(comm_id, call_data))
+        for comm_id in expired:
+            self._spawn(self.on_give_up(comm_id, report))
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._spawned.add(task)
+        task.add_done_callback(self._spawned.discard)
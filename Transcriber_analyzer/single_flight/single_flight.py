@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# Время аренды обработки звонка, секунды (продлевается каждую треть срока)
+LEASE_TTL = float(os.environ.get('CALL_LEASE_TTL', 120))
+# Как часто проверять звонок, который обрабатывает другой процесс
+LEASE_POLL_INTERVAL = float(os.environ.get('CALL_LEASE_POLL_INTERVAL', 2))
+
+# Идентификатор процесса-владельца аренды
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SingleFlight:
+    """
+    Схлопывание одновременных запросов на обработку одного звонка.
+
+    Внутри процесса повторный запрос присоединяется к уже идущей задаче и получает ее результат.
+    Между процессами (несколько воркеров uvicorn или контейнеров) обработку защищает аренда
+    в таблице call_leases: ее держит один процесс и продлевает, пока работает. Остальные
+    ждут освобождения аренды и читают результат из БД; если владелец упал, аренда истекает
+    и звонок забирает следующий процесс.
+    """
+
+    def __init__(self, database, owner=WORKER_ID, ttl=LEASE_TTL, poll_interval=LEASE_POLL_INTERVAL):
+        self.database = database
+        self.owner = owner
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._inflight = {}
+
+    def stats(self):
+        return {'owner': self.owner, 'inflight': len(self._inflight)}
+
+    async def run(self, key, func, completed_result):
+        """
+        Args:
+            key: communication_id
+            func: функция без аргументов, возвращающая корутину обработки (результат - dict)
+            completed_result: синхронная функция (key) -> dict, если звонок уже обработан, иначе None
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_with_lease(key, func, completed_result))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.info(f"Call {key} is already being processed, attaching to the running job")
+        # shield: отключение одного клиента не отменяет общую задачу
+        return await asyncio.shield(task)
+
+    async def _run_with_lease(self, key, func, completed_result):
+        loop = asyncio.get_event_loop()
+        while True:
+            acquired = await loop.run_in_executor(
+                None, self.database.acquire_lease, key, self.owner, self.ttl
+            )
+            if acquired:
+                break
+            logger.info(f"Call {key} is leased by another worker, waiting for its result")
+            result = await self._wait_for_remote(key, completed_result)
+            if result is not None:
+                return result
+
+        heartbeat = asyncio.ensure_future(self._heartbeat(key))
+        try:
+            # Пока ждали аренду, звонок мог обработать другой процесс
+            result = await loop.run_in_executor(None, completed_result, key)
+            if result is not None:
+                return result
+            return await func()
+        finally:
+            heartbeat.cancel()
+            await loop.run_in_executor(None, self.database.release_lease, key, self.owner)
+
+    async def _wait_for_remote(self, key, completed_result):
+        """Ждет освобождения или истечения чужой аренды. Результат из БД или None, если звонок не обработан."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            lease = await loop.run_in_executor(None, self.database.get_lease, key)
+            if lease is None or lease[1] < time.time():
+                return await loop.run_in_executor(None, completed_result, key)
+
+    async def _heartbeat(self, key):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            renewed = await loop.run_in_executor(
+                None, self.database.renew_lease, key, self.owner, self.ttl
+            )
+            if not renewed:
+                logger.warning(f"Lease for call {key} was lost by {self.owner}")
+                return
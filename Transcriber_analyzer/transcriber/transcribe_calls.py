@@ -6,6 +6,8 @@ import numpy as np
 from datetime import datetime
 import re
 
+from rate_limiter import get_limiter
+
 # OpenAI API Key
 OPENAI_API_KEY = "*"
 
@@ -21,47 +23,158 @@ SOCKS5_PROXY = {
 }
 
 
-CURRENT_PROXY = HTTP_PROXY
+# OPENAI_USE_PROXY=0 отключает прокси (локальные заглушки Whisper в benchmarks/)
+CURRENT_PROXY = HTTP_PROXY if os.environ.get('OPENAI_USE_PROXY', '1') == '1' else {}
+
+OPENAI_TRANSCRIPTIONS_URL = os.environ.get(
+    'OPENAI_TRANSCRIPTIONS_URL',
+    'https://api.openai.com/v1/audio/transcriptions'
+)
+
+# Предварительная проверка каналов: канал без речи (тишина, шум линии) не отправляется в Whisper
+SILENCE_SCREEN_ENABLED = os.environ.get('SILENCE_SCREEN', '1') == '1'
+# Длина кадра для оценки уровня, секунды, и размер блока чтения WAV в кадрах.
+# Проход screen_channel - единственное чтение уровня канала, его статистику берут и метрики (call_analytics)
+SCREEN_FRAME = 0.02
+SCREEN_BLOCK_FRAMES = 500
+# Кадр активен (active_ratio в статистике), если его уровень выше порога (dBFS)
+ACTIVE_THRESHOLD_DB = -40.0
+# Гистограмма уровней кадров: от SCREEN_DB_MIN до 0 dBFS шагом SCREEN_DB_STEP
+SCREEN_DB_MIN = -120.0
+SCREEN_DB_STEP = 0.5
+# Уровень шума канала - этот перцентиль уровней кадров
+SCREEN_NOISE_PERCENTILE = 10
+# Кадр речи: громче шума на SCREEN_SPEECH_MARGIN_DB и не тише SCREEN_MIN_SPEECH_DB (dBFS)
+SCREEN_SPEECH_MARGIN_DB = float(os.environ.get('SCREEN_SPEECH_MARGIN_DB', 12))
+SCREEN_MIN_SPEECH_DB = float(os.environ.get('SCREEN_MIN_SPEECH_DB', -45))
+# Канал мертвый, если речи меньше SCREEN_MIN_SPEECH_SECONDS секунд. Доля речи вердикт только смягчает:
+# короткий канал с речью не меньше SCREEN_MIN_SPEECH_RATIO записи отправляется в Whisper. В длинном канале
+# решают абсолютные секунды - короткий ответ клиента («да», «нет») при долгом разговоре сотрудника не теряется
+SCREEN_MIN_SPEECH_SECONDS = float(os.environ.get('SCREEN_MIN_SPEECH_SECONDS', 1.5))
+SCREEN_MIN_SPEECH_RATIO = float(os.environ.get('SCREEN_MIN_SPEECH_RATIO', 0.005))
 
 def create_session():
     session = requests.Session()
     session.proxies = CURRENT_PROXY
     return session
 
+def _post_audio(session, audio_file):
+    """Отправка файла в Whisper; файл открывается заново на каждую попытку"""
+    with open(audio_file, 'rb') as f:
+        return session.post(
+            OPENAI_TRANSCRIPTIONS_URL,
+            headers={'Authorization': f'Bearer {OPENAI_API_KEY}'},
+            files={'file': f},
+            data={
+                'model': 'whisper-1',
+                'response_format': 'verbose_json',
+                'language': 'ru'
+            },
+            timeout=30
+        )
+
 def transcribe_audio(audio_file):
     try:
         session = create_session()
         
-        # Prepare the audio file
-        with open(audio_file, 'rb') as f:
-            files = {'file': f}
-            headers = {
-                'Authorization': f'Bearer {OPENAI_API_KEY}'
-            }
-            
-            # отправляем запрос через прокси 
-            response = session.post(
-                'https://api.openai.com/v1/audio/transcriptions',
-                headers=headers,
-                files=files,
-                data={
-                    'model': 'whisper-1',
-                    'response_format': 'verbose_json',
-                    'language': 'ru'
-                },
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print(f"Error: {response.status_code}")
-                print(f"Response: {response.text}")
-                return None
+        # отправляем запрос через прокси; 429/5xx повторяются лимитером с учетом Retry-After
+        response = get_limiter('openai').request(_post_audio, session, audio_file)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Error: {response.status_code}")
+            print(f"Response: {response.text}")
+            return None
     except Exception as e:
         print(f"Error transcribing {audio_file}: {str(e)}")
         return None
 
+def screen_channel(audio_file):
+    """
+    Статистика уровня канала без загрузки файла целиком: WAV читается блоками, по кадрам
+    SCREEN_FRAME считается RMS, уровни кадров копятся в гистограмме. Речь - кадры заметно
+    громче уровня шума канала, поэтому ровный шум линии речью не считается.
+    Returns:
+        dict: duration, rms_db, peak_db, noise_floor_db, speech_seconds, speech_ratio, active_ratio
+        (доля кадров громче ACTIVE_THRESHOLD_DB) и вердикт silent
+    """
+    info = sf.info(audio_file)
+    frame = max(int(info.samplerate * SCREEN_FRAME), 1)
+    bins = int(-SCREEN_DB_MIN / SCREEN_DB_STEP) + 1
+    histogram = np.zeros(bins, dtype=np.int64)
+    sum_squares = 0.0
+    samples = 0
+    peak = 0.0
+    for block in sf.blocks(audio_file, blocksize=frame * SCREEN_BLOCK_FRAMES, dtype='float32'):
+        if block.ndim > 1:
+            block = block.mean(axis=1)
+        usable = len(block) - len(block) % frame
+        if not usable:
+            continue
+        block = block[:usable]
+        squares = np.square(block, dtype=np.float64)
+        sum_squares += squares.sum()
+        samples += usable
+        peak = max(peak, float(np.abs(block).max()))
+        frame_db = 10 * np.log10(np.maximum(squares.reshape(-1, frame).mean(axis=1), 1e-12))
+        index = np.clip(((frame_db - SCREEN_DB_MIN) / SCREEN_DB_STEP).astype(np.int64), 0, bins - 1)
+        histogram += np.bincount(index, minlength=bins)
+
+    stats = {
+        'duration': round(info.frames / info.samplerate, 2),
+        'rms_db': None,
+        'peak_db': None,
+        'noise_floor_db': None,
+        'speech_seconds': 0.0,
+        'speech_ratio': 0.0,
+        'active_ratio': 0.0,
+        'silent': True,
+    }
+    frames = int(histogram.sum())
+    if not frames:
+        return stats
+    floor_bin = int(np.searchsorted(np.cumsum(histogram), frames * SCREEN_NOISE_PERCENTILE / 100))
+    noise_floor = SCREEN_DB_MIN + floor_bin * SCREEN_DB_STEP
+    threshold = max(noise_floor + SCREEN_SPEECH_MARGIN_DB, SCREEN_MIN_SPEECH_DB)
+    speech_frames = int(histogram[int(np.ceil((threshold - SCREEN_DB_MIN) / SCREEN_DB_STEP)):].sum())
+    speech_seconds = speech_frames * frame / info.samplerate
+    speech_ratio = speech_frames / frames
+    # Порог кратен шагу гистограммы, поэтому доля активных кадров считается по ней точно
+    active_frames = int(histogram[int(np.ceil((ACTIVE_THRESHOLD_DB - SCREEN_DB_MIN) / SCREEN_DB_STEP)):].sum())
+    stats.update({
+        'rms_db': round(10 * float(np.log10(max(sum_squares / samples, 1e-12))), 2),
+        'peak_db': round(20 * float(np.log10(max(peak, 1e-6))), 2),
+        'noise_floor_db': noise_floor,
+        'speech_seconds': round(speech_seconds, 2),
+        'speech_ratio': round(speech_ratio, 4),
+        'active_ratio': round(active_frames / frames, 4),
+        'silent': speech_seconds < SCREEN_MIN_SPEECH_SECONDS and speech_ratio < SCREEN_MIN_SPEECH_RATIO,
+    })
+    return stats
+
+def transcribe_channel(audio_file):
+    """
+    Транскрипция канала с предварительной проверкой: для канала без речи Whisper не вызывается,
+    возвращается пустой транскрипт. Вердикт проверки сохраняется в транскрипте (ключ screening).
+    """
+    if not SILENCE_SCREEN_ENABLED:
+        return transcribe_audio(audio_file)
+    try:
+        screening = screen_channel(audio_file)
+    except Exception as e:
+        # Файл не читается как звук - решение оставляем за Whisper
+        print(f"Could not screen {audio_file}: {str(e)}")
+        return transcribe_audio(audio_file)
+    if screening['silent']:
+        print(f"  {os.path.basename(audio_file)}: no speech "
+              f"({screening['speech_seconds']} s, noise {screening['noise_floor_db']} dB), skipping Whisper")
+        return {'text': '', 'duration': screening['duration'], 'segments': [], 'screening': screening}
+    transcript = transcribe_audio(audio_file)
+    if transcript is not None:
+        transcript['screening'] = screening
+    return transcript
+
 def format_time(seconds):
     minutes = int(seconds // 60)
     seconds_part = seconds % 60
@@ -85,6 +198,16 @@ def check_existing_transcription(result_dir, comm_id):
                 print("    Transcription appears incomplete, will retranscribe...")
     return False
 
+def find_transcription_folder(result_dir, comm_id):
+    """Путь к последней полной транскрипции звонка или None"""
+    prefix = f'transcribed_call{comm_id}_'
+    # Суффикс - метка времени %Y%m%d_%H%M%S, поэтому лексикографический порядок совпадает с хронологическим
+    for folder in sorted((d for d in os.listdir(result_dir) if d.startswith(prefix)), reverse=True):
+        folder_path = os.path.join(result_dir, folder)
+        if os.path.isfile(os.path.join(folder_path, 'dialog.txt')):
+            return folder_path
+    return None
+
 def create_call_folder(comm_id):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     folder_name = f"transcribed_call{comm_id}_{timestamp}"
@@ -92,35 +215,94 @@ def create_call_folder(comm_id):
     os.makedirs(folder_path, exist_ok=True)
     return folder_path
 
-def merge_transcripts(client_transcript, staff_transcript):
-    segments = []
-    
-    if client_transcript and 'segments' in client_transcript:
-        for segment in client_transcript['segments']:
-            segments.append({
-                'start': segment['start'],
-                'text': segment['text'].strip(),
-                'speaker': 'Клиент'
-            })
-    
-    if staff_transcript and 'segments' in staff_transcript:
-        for segment in staff_transcript['segments']:
-            segments.append({
-                'start': segment['start'],
-                'text': segment['text'].strip(),
-                'speaker': 'Сотрудник'
-            })
-    
-    segments.sort(key=lambda x: x['start'])
+CLIENT_SPEAKER = 'Клиент'
+STAFF_SPEAKER = 'Сотрудник'
+
+# Максимальная пауза (секунды), при которой соседние фрагменты одного говорящего склеиваются в реплику
+TURN_MAX_GAP = 2.0
+
+
+class Segment:
+    """Фрагмент речи (сегмент Whisper или склеенная реплика)"""
+    __slots__ = ('start', 'end', 'text', 'speaker', 'overlap')
+
+    def __init__(self, start, end, text, speaker, overlap=False):
+        self.start = start
+        self.end = end
+        self.text = text
+        self.speaker = speaker
+        # True, если реплика началась до окончания реплики собеседника (перебивание)
+        self.overlap = overlap
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"Segment({self.start!r}, {self.end!r}, {self.speaker!r}, overlap={self.overlap!r})"
+
+
+def channel_segments(transcript, speaker):
+    """Сегменты одного канала по возрастанию start"""
+    if not transcript or 'segments' not in transcript:
+        return []
+    segments = [
+        Segment(s['start'], s.get('end', s['start']), s['text'].strip(), speaker)
+        for s in transcript['segments']
+    ]
+    # Whisper отдает сегменты по порядку, сортируем только если порядок нарушен
+    if any(a.start > b.start for a, b in zip(segments, segments[1:])):
+        segments.sort(key=lambda x: x.start)
     return segments
 
+
+def merge_transcripts(client_transcript, staff_transcript, max_gap=TURN_MAX_GAP):
+    """
+    Слияние двух отсортированных каналов в список реплик за линейное время.
+    Подряд идущие фрагменты одного говорящего с паузой не больше max_gap склеиваются в одну реплику.
+    Реплика, начавшаяся раньше окончания реплики собеседника, помечается overlap=True.
+    """
+    client = channel_segments(client_transcript, CLIENT_SPEAKER)
+    staff = channel_segments(staff_transcript, STAFF_SPEAKER)
+
+    turns = []
+    texts = []  # части текста каждой реплики, склеиваются один раз в конце
+    speaker_end = {CLIENT_SPEAKER: float('-inf'), STAFF_SPEAKER: float('-inf')}
+    i = j = 0
+    while i < len(client) or j < len(staff):
+        if j >= len(staff) or (i < len(client) and client[i].start <= staff[j].start):
+            segment = client[i]
+            i += 1
+        else:
+            segment = staff[j]
+            j += 1
+        if not segment.text:
+            continue
+
+        last = turns[-1] if turns else None
+        if last is not None and last.speaker == segment.speaker and segment.start - last.end <= max_gap:
+            last.end = max(last.end, segment.end)
+            texts[-1].append(segment.text)
+        else:
+            other = STAFF_SPEAKER if segment.speaker == CLIENT_SPEAKER else CLIENT_SPEAKER
+            turns.append(Segment(segment.start, segment.end, None, segment.speaker,
+                                 overlap=segment.start < speaker_end[other]))
+            texts.append([segment.text])
+        speaker_end[segment.speaker] = max(speaker_end[segment.speaker], segment.end)
+
+    for turn, parts in zip(turns, texts):
+        turn.text = ' '.join(parts)
+    return turns
+
+
 def save_dialog_format(client_transcript, staff_transcript, output_file):
-    segments = merge_transcripts(client_transcript, staff_transcript)
-    
+    turns = merge_transcripts(client_transcript, staff_transcript)
+
     with open(output_file, 'w', encoding='utf-8') as f:
-        for segment in segments:
-            timestamp = format_time(segment['start'])
-            f.write(f"[{timestamp}] {segment['speaker']}: {segment['text']}\n")
+        f.writelines(
+            f"[{format_time(turn.start)}] {turn.speaker}{' (перебивает)' if turn.overlap else ''}: {turn.text}\n"
+            for turn in turns
+        )
 
 def get_comm_id_from_filename(filename):
     match = re.search(r'(?:client|staff)_(\d+)\.wav', filename)
@@ -152,8 +334,8 @@ def process_call(comm_id, client_file, staff_file):
     call_folder = create_call_folder(comm_id)
     
 
-    client_transcript = transcribe_audio(client_file)
-    staff_transcript = transcribe_audio(staff_file)
+    client_transcript = transcribe_channel(client_file)
+    staff_transcript = transcribe_channel(staff_file)
     
     if client_transcript and staff_transcript:
         with open(os.path.join(call_folder, 'client_transcript.json'), 'w', encoding='utf-8') as f:
@@ -2,21 +2,31 @@ import os
 import sys
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, Depends, Header
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import logging
 import asyncio
+import json
 from datetime import datetime
-import traceback
 import shutil
-from archive_system import ArchiveSystem
 from typing import Optional
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from get_calls import get_call_data, download_call
-from transcribe_calls import process_call
 from database import db
+from columnar_export import EXPORT_FORMATS, day_bounds
+from export_cache import ExportCache
+from call_pipeline import (
+    SERVICE_MODE,
+    audio_store,
+    check_web_concurrency,
+    enqueue_call,
+    pipeline_metrics,
+    process_call_single_flight,
+    start_services,
+    stop_services,
+)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,6 +42,9 @@ API_KEY = ""
 
 app = FastAPI(title="UIS Webhook Server")
 
+# Кэш колоночных выгрузок по дням
+export_cache = ExportCache(db)
+
 # Подключаем статические файлы
 if os.path.exists("static"):
     app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -39,12 +52,18 @@ if os.path.exists("static"):
 @app.on_event("startup")
 async def startup_event():
     """Выполняется при запуске сервера"""
-    logger.info("Webhook server started")
+    await start_services()
+    logger.info(f"Webhook server started (mode: {SERVICE_MODE}, pid: {os.getpid()})")
     logger.info(f"Allowed IP: {ALLOWED_IP}")
     logger.info(f"Current directory: {os.getcwd()}")
     logger.info(f"Result directory exists: {os.path.exists('/app/result')}")
     logger.info(f"Data directory exists: {os.path.exists('/app/data')}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Выполняется при остановке сервера"""
+    await stop_services()
+
 class CallNotification(BaseModel):
     """Модель для входящих данных."""
     communication_id: str
@@ -57,170 +76,6 @@ async def verify_uis_ip(request: Request):
     
  
 
-async def process_unprocessed_calls_from_data(data):
-    """Обрабатывает все звонки из выгрузки, которые еще не обработаны (нет transcript_path)"""
-    if not data or 'result' not in data or 'data' not in data['result']:
-        logger.info("Нет данных для сверки необработанных звонков.")
-        return
-    all_comm_ids = [str(call.get('communication_id')) for call in data['result']['data']]
-    processed_ids = await asyncio.get_event_loop().run_in_executor(None, db.get_processed_communication_ids)
-    to_process = [cid for cid in all_comm_ids if cid and cid not in processed_ids]
-    if to_process:
-        logger.info(f"Найдены необработанные звонки: {to_process}. Запускаю обработку...")
-    for comm_id in to_process:
-        logger.info(f"Автоматически обрабатываю необработанный звонок {comm_id}")
-        await process_call_async(comm_id)
-
-async def process_call_async(comm_id: str, attempt: int = 1) -> dict:
-    """Асинхронная обработка звонка. attempt - номер попытки."""
-    logger.debug(f"Function process_call_async called with comm_id={comm_id}, attempt={attempt}")
-    try:
-        logger.info(f"Starting call processing for {comm_id}, attempt {attempt}")
-        start_time = datetime.now()
-        
-        # Получаем общую выгрузку за 2 часа и ищем нужный звонок в ней
-        logger.debug(f"Calling get_call_data(None, 120) to get all calls")
-        all_calls_data = await asyncio.get_event_loop().run_in_executor(
-            None, get_call_data, None, 120
-        )
-        
-        # Ищем нужный звонок в общей выгрузке
-        call_data = None
-        if all_calls_data and 'result' in all_calls_data and 'data' in all_calls_data['result']:
-            for call in all_calls_data['result']['data']:
-                if str(call.get('communication_id')) == str(comm_id):
-                    call_data = call
-                    break
-        
-        logger.debug(f"Call data: {call_data}")
-
-        # Если звонок не найден или нет дорожек, пробуем повторно (до 2 раз)
-        if not call_data or not call_data.get('wav_call_records'):
-            if attempt < 2:
-                logger.warning(f"No call data or wav_call_records for {comm_id} (attempt {attempt}). Retrying...")
-                await asyncio.sleep(2)  # небольшая задержка
-                return await process_call_async(comm_id, attempt=attempt+1)
-            # После двух попыток — помечаем звонок как NO_WAV
-            logger.error(f"No call data or wav_call_records for {comm_id} after 2 attempts. Marking as NO_WAV.")
-            # Обновляем БД
-            await asyncio.get_event_loop().run_in_executor(
-                None, db.update_call_paths, comm_id, None, None, 'NO_WAV'
-            )
-            # Создаём папку с меткой NO_WAV
-            result_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result')
-            folder_name = f'transcribed_call{comm_id}_NO_WAV'
-            folder_path = os.path.join(result_dir, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            info_path = os.path.join(folder_path, 'info.txt')
-            with open(info_path, 'w', encoding='utf-8') as f:
-                f.write(f'Звонок {comm_id}: нет аудиозаписей (wav_call_records) для транскрипции или не найден в API.')
-            
-            # Сверяем и обрабатываем необработанные звонки из этой выгрузки
-            await process_unprocessed_calls_from_data(all_calls_data)
-            
-            return {
-                "success": False,
-                "message": "Нет аудиозаписей для транскрипции (NO_WAV)"
-            }
-
-        logger.info(f"Call data received for {comm_id}")
-        
-        # Сохраняем информацию о звонке в БД
-        logger.debug(f"Saving call {comm_id} to database")
-        await asyncio.get_event_loop().run_in_executor(
-            None, db.add_call, comm_id, call_data
-        )
-        logger.info(f"Call {comm_id} saved to database")
-
-        wav_ids = call_data.get('wav_call_records', [])
-        logger.debug(f"wav_ids for {comm_id}: {wav_ids}")
-        if len(wav_ids) < 2:
-            logger.warning(f"Not enough audio tracks for call {comm_id}")
-            return {
-                "success": False,
-                "message": "Для этого звонка нет двух аудиодорожек"
-            }
-
-        # Скачиваем файлы
-        logger.info(f"Starting download for call {comm_id}")
-        download_start = datetime.now()
-        success = await asyncio.get_event_loop().run_in_executor(
-            None, download_call, comm_id, wav_ids
-        )
-        download_elapsed = (datetime.now() - download_start).total_seconds()
-        logger.info(f"Download time for {comm_id}: {download_elapsed:.2f} seconds")
-
-        if not success:
-            logger.error(f"Failed to download files for call {comm_id}")
-            return {
-                "success": False,
-                "message": "Ошибка при скачивании файлов"
-            }
-
-        logger.info(f"Files downloaded successfully for call {comm_id}")
-        
-        # Проверяем состояние файлов
-        result_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result')
-        client_file = os.path.join(result_dir, f'client_{comm_id}.wav')
-        staff_file = os.path.join(result_dir, f'staff_{comm_id}.wav')
-        for fpath, label in [(client_file, 'client'), (staff_file, 'staff')]:
-            if os.path.exists(fpath):
-                logger.info(f"{label.capitalize()} file exists: {fpath}, size: {os.path.getsize(fpath)} bytes")
-            else:
-                logger.warning(f"{label.capitalize()} file missing: {fpath}")
-
-        # Обновляем пути к аудиофайлам в БД
-        await asyncio.get_event_loop().run_in_executor(
-            None, db.update_call_paths,
-            comm_id,
-            client_file,
-            staff_file
-        )
-
-        logger.info(f"Starting transcription for call {comm_id}")
-        transcribe_start = datetime.now()
-
-        # Запускаем транскрипцию
-        success = await asyncio.get_event_loop().run_in_executor(
-            None, process_call, comm_id, client_file, staff_file
-        )
-        transcribe_elapsed = (datetime.now() - transcribe_start).total_seconds()
-        logger.info(f"Transcription time for {comm_id}: {transcribe_elapsed:.2f} seconds")
-
-        if success:
-            logger.info(f"Transcription completed for call {comm_id}")
-            # Обновляем путь к транскрипции в БД
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            transcript_dir = os.path.join(result_dir, f'transcribed_call{comm_id}_{timestamp}')
-            
-            await asyncio.get_event_loop().run_in_executor(
-                None, db.update_call_paths,
-                comm_id,
-                None,
-                None,
-                transcript_dir
-            )
-
-            elapsed = (datetime.now() - start_time).total_seconds()
-            logger.info(f"Total process_call_async time for {comm_id}: {elapsed:.2f} seconds")
-            return {
-                "success": True,
-                "message": "Звонок успешно обработан и транскрибирован"
-            }
-        else:
-            logger.error(f"Transcription failed for call {comm_id}")
-            return {
-                "success": False,
-                "message": "Ошибка при транскрибации"
-            }
-
-    except Exception as e:
-        logger.error(f"Error processing call {comm_id}: {str(e)}\n{traceback.format_exc()}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Ошибка при обработке: {str(e)}"
-        }
-
 @app.post("/webhook/call")
 async def webhook_handler(
     request: Request,
@@ -259,10 +114,20 @@ async def webhook_handler(
             "call_info": existing_call
         }
     
+    if SERVICE_MODE == 'ingest':
+        # Обработкой занимаются воркеры call_worker.py, здесь только ставим звонок в очередь
+        await enqueue_call(comm_id)
+        logger.info(f"Call {comm_id} queued for processing")
+        return JSONResponse(status_code=202, content={
+            "success": True,
+            "queued": True,
+            "message": "Звонок поставлен в очередь обработки"
+        })
+
     # Запускаем обработку
     logger.info(f"Starting async processing for call {comm_id}")
     start_time = datetime.now()
-    result = await process_call_async(comm_id)
+    result = await process_call_single_flight(comm_id)
     elapsed = (datetime.now() - start_time).total_seconds()
     logger.info(f"Total processing time for {comm_id}: {elapsed:.2f} seconds")
     
@@ -272,6 +137,14 @@ async def webhook_handler(
             status_code=500,
             detail=result["message"]
         )
+
+    if result.get("deferred"):
+        # Звонок еще не в UIS: обработка продолжится по расписанию, повторный webhook не нужен
+        return JSONResponse(status_code=202, content={
+            "success": True,
+            "deferred": True,
+            "message": result["message"]
+        })
     
     # Получаем обновленную информацию о звонке
     call_info = await asyncio.get_event_loop().run_in_executor(
@@ -324,20 +197,84 @@ async def verify_api_key(x_api_key: Optional[str] = Header(None)):
         )
     return x_api_key
 
+@app.get("/call/{comm_id}/audio/{channel}")
+async def get_call_audio(comm_id: str, channel: str, api_key: str = Depends(verify_api_key)):
+    """Запись канала звонка (client или staff); из холодного уровня файл восстанавливается"""
+    if channel not in ('client', 'staff'):
+        raise HTTPException(status_code=400, detail="channel должен быть client или staff")
+    call_info = await asyncio.get_event_loop().run_in_executor(None, db.get_call, comm_id)
+    path = call_info and call_info[f'{channel}_audio_path']
+    if path:
+        path = await asyncio.get_event_loop().run_in_executor(None, audio_store.ensure_hot, path)
+    if not path:
+        raise HTTPException(status_code=404, detail="Запись не найдена")
+    return FileResponse(path, filename=os.path.basename(path), media_type='audio/wav')
+
+def restore_calls_audio(calls):
+    """
+    Возвращает записи звонков в горячий уровень с арендой на чтение: ArchiveSystem читает WAV
+    по client_audio_path/staff_audio_path, а обработанные звонки хранятся в холодном уровне.
+    Returns:
+        list: пути восстановленных записей (после работы ArchiveSystem - в audio_store.release)
+    """
+    paths = [call[key] for call in calls for key in ('client_audio_path', 'staff_audio_path') if call.get(key)]
+    return audio_store.ensure_hot_many(paths)
+
 @app.get("/api/export/analysis/{date_from}/{date_to}")
 async def export_analysis_data(
     date_from: str, 
     date_to: str, 
     include_audio: bool = True,
+    format: str = "tar.gz",
     api_key: str = Depends(verify_api_key)
 ):
-    """Экспорт данных для анализа за период"""
+    """
+    Экспорт данных для анализа за период.
+    format=tar.gz - архив папок звонков (ArchiveSystem), parquet или arrow - колоночные файлы
+    calls, segments, metrics и analysis по дням в zip (include_audio не используется).
+    Колоночная выгрузка собирается из кэша дней, заново выгружаются только измененные дни.
+    """
+    if format in EXPORT_FORMATS:
+        logger.info(f"Запрос на колоночный экспорт ({format}) с {date_from} по {date_to} (авторизован)")
+        try:
+            export_path = await asyncio.get_event_loop().run_in_executor(
+                None, export_cache.export, date_from, date_to, format
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error(f"Ошибка при создании экспорта: {e}")
+            raise HTTPException(status_code=500, detail=f"Ошибка при создании экспорта: {str(e)}")
+        return FileResponse(
+            export_path,
+            filename=f"analysis_export_{date_from}_{date_to}.{format}.zip",
+            media_type='application/zip',
+            background=BackgroundTask(shutil.rmtree, os.path.dirname(export_path), True)
+        )
+    if format != "tar.gz":
+        raise HTTPException(status_code=400, detail="format должен быть tar.gz, parquet или arrow")
+
     try:
         logger.info(f"Запрос на экспорт данных с {date_from} по {date_to} (авторизован)")
         
-        archive_system = ArchiveSystem()
-        export_path = archive_system.create_analysis_export(date_from, date_to, include_audio)
-        
+        # archive_system нужен только архивным ручкам: без модуля сервер запускается, а они отвечают 500
+        from archive_system import ArchiveSystem
+        loop = asyncio.get_event_loop()
+        audio_paths = []
+        if include_audio:
+            period_from, period_to = day_bounds(date_from, date_to)
+            calls = db.iter_calls(
+                columns=['client_audio_path', 'staff_audio_path'], date_from=period_from, date_to=period_to
+            )
+            audio_paths = await loop.run_in_executor(None, restore_calls_audio, calls)
+        try:
+            archive_system = ArchiveSystem()
+            export_path = await loop.run_in_executor(
+                None, archive_system.create_analysis_export, date_from, date_to, include_audio
+            )
+        finally:
+            await loop.run_in_executor(None, audio_store.release, audio_paths)
+
         return FileResponse(
             export_path,
             filename=f"analysis_export_{date_from}_{date_to}.tar.gz",
@@ -356,8 +293,15 @@ async def archive_old_calls(
     try:
         logger.info(f"Запрос на архивирование звонков старше {days_old} дней (авторизован)")
         
-        archive_system = ArchiveSystem()
-        archive_system.archive_old_calls(days_old)
+        from archive_system import ArchiveSystem
+        loop = asyncio.get_event_loop()
+        calls = await loop.run_in_executor(None, db.get_calls_older_than, days_old)
+        audio_paths = await loop.run_in_executor(None, restore_calls_audio, calls)
+        try:
+            archive_system = ArchiveSystem()
+            await loop.run_in_executor(None, archive_system.archive_old_calls, days_old)
+        finally:
+            await loop.run_in_executor(None, audio_store.release, audio_paths)
         
         return {
             "success": True,
@@ -385,6 +329,82 @@ async def get_stats(api_key: str = Depends(verify_api_key)):
         logger.error(f"Ошибка при получении статистики: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при получении статистики: {str(e)}")
 
+# Максимальный размер страницы /api/calls в режиме JSON
+CALLS_PAGE_MAX = 1000
+
+@app.get("/api/calls")
+async def list_calls(
+    limit: Optional[int] = None,
+    after_date: Optional[str] = None,
+    after_id: Optional[str] = None,
+    columns: Optional[str] = None,
+    status: Optional[str] = None,
+    archived: Optional[bool] = None,
+    phone: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    direction: Optional[str] = None,
+    employee_id: Optional[int] = None,
+    min_duration: Optional[int] = None,
+    max_duration: Optional[int] = None,
+    format: str = "json",
+    api_key: str = Depends(verify_api_key)
+):
+    """
+    Список звонков в порядке (call_date, communication_id).
+    Следующая страница - по after_date и after_id последней строки (поле next в ответе).
+    columns - колонки через запятую; format=ndjson отдает все подходящие звонки
+    (или limit) потоком, по одному JSON-объекту в строке.
+    """
+    if (after_date is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="after_date и after_id передаются вместе")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format должен быть json или ndjson")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit должен быть положительным")
+    if format == "json":
+        limit = min(limit or 100, CALLS_PAGE_MAX)
+
+    try:
+        rows = db.iter_calls(
+            columns=[c.strip() for c in columns.split(',') if c.strip()] if columns else None,
+            status=status,
+            is_archived=archived,
+            phone=phone,
+            date_from=date_from,
+            date_to=date_to,
+            direction=direction,
+            employee_id=employee_id,
+            min_duration=min_duration,
+            max_duration=max_duration,
+            after=(after_date, after_id) if after_date is not None else None,
+            # Лишняя строка показывает, есть ли следующая страница
+            limit=limit + 1 if format == "json" else limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if format == "ndjson":
+        return StreamingResponse(
+            (json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows),
+            media_type="application/x-ndjson"
+        )
+
+    items = await asyncio.get_event_loop().run_in_executor(None, list, rows)
+    next_page = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_page = {"after_date": items[-1]["call_date"], "after_id": items[-1]["communication_id"]}
+    return {"items": items, "next": next_page}
+
+@app.get("/api/metrics")
+async def get_metrics(api_key: str = Depends(verify_api_key)):
+    """Текущие лимиты внешних сервисов и состояние очередей и фоновых задач"""
+    metrics = await pipeline_metrics()
+    metrics["export_cache"] = await asyncio.get_event_loop().run_in_executor(None, export_cache.stats)
+    metrics["timestamp"] = datetime.now().isoformat()
+    return metrics
+
 @app.get("/", response_class=HTMLResponse)
 async def get_web_interface():
     """Главная страница веб-интерфейса"""
@@ -403,9 +423,15 @@ async def get_web_interface():
         """, status_code=404)
 
 if __name__ == "__main__":
+    # WEB_CONCURRENCY - число процессов uvicorn; автоперезагрузка (UVICORN_RELOAD=1) только для разработки
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    reload = os.environ.get("UVICORN_RELOAD", "0") == "1"
+    # Несколько процессов - только с SERVICE_MODE=ingest (см. check_web_concurrency)
+    check_web_concurrency(workers, SERVICE_MODE)
     uvicorn.run(
         "webhook_server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True  
+        reload=reload,
+        workers=None if reload else workers
     ) 
\ No newline at end of file
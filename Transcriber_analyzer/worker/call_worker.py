@@ -0,0 +1,37 @@
+"""
+Отдельный процесс обработки звонков: забирает звонки из call_queue и выполняет
+скачивание, транскрипцию, аналитику и GPT-анализ. Webhook-сервер при этом работает
+в режиме SERVICE_MODE=ingest и только ставит звонки в очередь.
+
+Запуск (несколько процессов/контейнеров с общей БД):
+    SERVICE_MODE=ingest WEB_CONCURRENCY=2 python webhook_server.py
+    WORKER_CONCURRENCY=4 python call_worker.py
+"""
+import asyncio
+import logging
+import signal
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+import call_pipeline  # noqa: E402
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await call_pipeline.start_services(mode='worker')
+    logger.info("Call worker started")
+    await stop.wait()
+    logger.info("Call worker stopping, waiting for active calls...")
+    await call_pipeline.stop_services()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())